@@ -1,22 +1,107 @@
 import os
+import sys
+import abc
 import logging
 import asyncio
-from telegram import Update, ReplyKeyboardMarkup, KeyboardButton
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, ConversationHandler
+from telegram import Bot, Update, ReplyKeyboardMarkup, KeyboardButton
+from telegram.error import NetworkError, RetryAfter, TelegramError
+from telegram.request import HTTPXRequest
+from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, ConversationHandler, BaseUpdateProcessor, BaseRateLimiter
 import pandas as pd
 import io
 import numpy as np
 from datetime import datetime
 import re
 import json
+import concurrent.futures
+import collections
+import collections.abc
+import functools
+import hashlib
+import time
+import openpyxl
+import sqlite3
+import struct
+import threading
+import zlib
+import zipfile
+import shutil
+import tempfile
+import atexit
+import signal
+import bisect
+import operator
+import string
+import multiprocessing
+import random
+import contextlib
+import contextvars
+from queue import Empty as QueueEmpty
 
-# Настройка логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Настройка логирования: json - по одному JSON-объекту на строку, text - как раньше
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json')
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+# Доля подробных (DEBUG, построчных) событий, попадающих в лог
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', 0.01))
+
+class JsonLogFormatter(logging.Formatter):
+    """Одна запись лога - одна строка JSON; поля события - на верхнем уровне"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'event': getattr(record, 'event', None) or record.getMessage(),
+            'pid': record.process,
+        }
+        fields = getattr(record, 'fields', None)
+        if fields:
+            entry.update(fields)
+        elif getattr(record, 'event', None) is None:
+            entry.pop('event')
+            entry['msg'] = record.getMessage()
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class TextLogFormatter(logging.Formatter):
+    """Прежний текстовый формат, поля события дописываются как key=value"""
+
+    def format(self, record):
+        line = super().format(record)
+        fields = getattr(record, 'fields', None)
+        if fields:
+            line += ' ' + ' '.join(f"{key}={value}" for key, value in fields.items())
+        return line
+
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(
+    JsonLogFormatter() if LOG_FORMAT == 'json'
+    else TextLogFormatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 )
+logging.basicConfig(level=getattr(logging, LOG_LEVEL, logging.INFO), handlers=[_log_handler])
 logger = logging.getLogger(__name__)
 
+def log_event(event, level=logging.INFO, sample_rate=1.0, **fields):
+    """Структурированное событие: имя вида 'stage.what' и поля.
+
+    Уровень проверяется до сборки записи, так что отключенные события почти
+    ничего не стоят; sample_rate < 1 пропускает в лог лишь долю событий.
+    """
+    if not logger.isEnabledFor(level):
+        return
+    if sample_rate < 1.0 and random.random() >= sample_rate:
+        return
+    logger.log(level, event, extra={'event': event, 'fields': fields})
+    if level >= logging.WARNING:
+        ERRORS_TOTAL.inc(type=event)
+
 # Получаем токен из переменных окружения
 TELEGRAM_BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN')
 
@@ -30,6 +115,98 @@ print("🚀 БУХГАЛТЕРСКИЙ АНАЛИЗАТОР ЗАПУЩЕН...")
 # Создаем папку для временных файлов
 os.makedirs("temp_files", exist_ok=True)
 
+# Адрес Bot API; для нагрузочных тестов можно указать локальную замену (fake_telegram.py)
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org/bot')
+TELEGRAM_FILE_URL = os.environ.get('TELEGRAM_FILE_URL', 'https://api.telegram.org/file/bot')
+
+# Режим получения обновлений: polling | webhook
+BOT_MODE = os.environ.get('BOT_MODE', 'polling')
+# Сколько обновлений разных пользователей обрабатывается одновременно.
+# Обновления одного пользователя всегда обрабатываются по порядку, и
+# ожидающие своей очереди обновления слотов не занимают.
+CONCURRENT_UPDATES = int(os.environ.get('CONCURRENT_UPDATES', 64))
+
+# Настройки webhook: локальный HTTP-сервер принимает обновления от Telegram
+# (или от балансировщика перед несколькими воркерами бота)
+WEBHOOK_LISTEN = os.environ.get('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', os.environ.get('PORT', 8443)))
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', '/telegram')
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')  # публичный URL; если задан, регистрируется через setWebhook
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET')
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get('WEBHOOK_MAX_CONNECTIONS', 40))
+WEBHOOK_MAX_PENDING = int(os.environ.get('WEBHOOK_MAX_PENDING', 1000))
+
+# Горизонтальное масштабирование: число процессов-воркеров бота (1 - без шардирования)
+BOT_WORKERS = int(os.environ.get('BOT_WORKERS', 1))
+SHARD_VIRTUAL_NODES = int(os.environ.get('SHARD_VIRTUAL_NODES', 64))
+# Сколько ждать, пока воркеры передадут пользователей новому воркеру, секунд
+SHARD_HANDOFF_TIMEOUT = float(os.environ.get('SHARD_HANDOFF_TIMEOUT', 30))
+
+# Настройки пула вычислений (парсинг Excel и построение отчетов)
+ANALYSIS_EXECUTOR = os.environ.get('ANALYSIS_EXECUTOR', 'process')  # process | thread
+# Способ запуска процессов пула и воркеров бота: spawn | forkserver. fork не
+# используется: он копирует потоки записи состояния, HTTP-клиент бота и цикл событий
+PROCESS_START_METHOD = os.environ.get('PROCESS_START_METHOD', 'spawn')
+ANALYSIS_WORKERS = int(os.environ.get('ANALYSIS_WORKERS', os.cpu_count() or 2))
+ANALYSIS_QUEUE_LIMIT = int(os.environ.get('ANALYSIS_QUEUE_LIMIT', 20))
+ANALYSIS_JOB_TIMEOUT = float(os.environ.get('ANALYSIS_JOB_TIMEOUT', 60))
+
+# Файлы .xlsx от этого размера читаются потоково (только нужные столбцы)
+EXCEL_STREAMING_THRESHOLD = int(os.environ.get('EXCEL_STREAMING_THRESHOLD', 0))
+
+# Ограничения на загружаемые файлы: проверяются до разбора, чтобы
+# патологический файл не занял память воркера пула
+MAX_UPLOAD_MB = float(os.environ.get('MAX_UPLOAD_MB', 20))  # заявленный размер документа
+MAX_UNCOMPRESSED_MB = float(os.environ.get('MAX_UNCOMPRESSED_MB', 300))  # сумма распакованных частей .xlsx
+MAX_COMPRESSION_RATIO = float(os.environ.get('MAX_COMPRESSION_RATIO', 200))  # защита от zip-бомб
+MAX_SHEET_ROWS = int(os.environ.get('MAX_SHEET_ROWS', 100000))  # строки сверх предела отбрасываются
+MAX_SHEET_COLUMNS = int(os.environ.get('MAX_SHEET_COLUMNS', 2000))  # лист шире предела отклоняется
+
+# Файлы до этого размера держатся в памяти одним буфером, крупнее - пишутся на диск,
+# и в пул вычислений передается путь, а не содержимое
+UPLOAD_SPOOL_THRESHOLD_MB = float(os.environ.get('UPLOAD_SPOOL_THRESHOLD_MB', 4))
+UPLOAD_SPOOL_DIR = os.environ.get('UPLOAD_SPOOL_DIR', 'temp_files/uploads')
+# Сохранять ли загруженные файлы в temp_files/user_<id>
+ARCHIVE_UPLOADS = os.environ.get('ARCHIVE_UPLOADS', '0') == '1'
+
+# Хранилище состояния пользователей: sqlite (файл, переживает перезапуск) | memory
+STATE_BACKEND = os.environ.get('STATE_BACKEND', 'sqlite')
+STATE_DB_PATH = os.environ.get('STATE_DB_PATH', 'temp_files/state.db')
+STATE_FLUSH_INTERVAL = float(os.environ.get('STATE_FLUSH_INTERVAL', 1.0))
+
+# Настройки кэша разобранных файлов и готовых отчетов
+REPORT_CACHE_SIZE = int(os.environ.get('REPORT_CACHE_SIZE', 256))
+REPORT_CACHE_TTL = float(os.environ.get('REPORT_CACHE_TTL', 3600))
+
+# Ограничение частоты запросов: корзина токенов на пользователя для каждого
+# вида действий - (емкость, пополнение токенов в минуту)
+RATE_LIMITS = {
+    'menu': (int(os.environ.get('RATE_MENU_BURST', 10)), float(os.environ.get('RATE_MENU_PER_MIN', 60))),
+    'analysis': (int(os.environ.get('RATE_ANALYSIS_BURST', 3)), float(os.environ.get('RATE_ANALYSIS_PER_MIN', 10))),
+    'upload': (int(os.environ.get('RATE_UPLOAD_BURST', 3)), float(os.environ.get('RATE_UPLOAD_PER_MIN', 5))),
+}
+# Сколько файлов одновременно скачивается и разбирается (на процесс бота)
+MAX_CONCURRENT_PARSES = int(os.environ.get('MAX_CONCURRENT_PARSES', ANALYSIS_WORKERS))
+
+# Отправка сообщений: размер части длинного отчета (Telegram принимает до
+# 4096 единиц UTF-16), темп отправки в один чат и во все чаты процесса бота,
+# число повторов после flood control (RetryAfter)
+MESSAGE_MAX_LENGTH = int(os.environ.get('MESSAGE_MAX_LENGTH', 4000))
+SEND_CHAT_BURST = int(os.environ.get('SEND_CHAT_BURST', 20))
+SEND_CHAT_PER_SEC = float(os.environ.get('SEND_CHAT_PER_SEC', 1))
+SEND_GLOBAL_PER_SEC = float(os.environ.get('SEND_GLOBAL_PER_SEC', 30))
+SEND_MAX_RETRIES = int(os.environ.get('SEND_MAX_RETRIES', 3))
+
+# Пакетный анализ (zip с книгами или книга "по листу на компанию"): предел
+# числа компаний и как часто обновлять сообщение о ходе обработки, секунд
+MAX_BATCH_COMPANIES = int(os.environ.get('MAX_BATCH_COMPANIES', 50))
+BATCH_PROGRESS_INTERVAL = float(os.environ.get('BATCH_PROGRESS_INTERVAL', 2))
+
+# Метрики в формате Prometheus на локальном порту (0 - не публиковать).
+# При шардировании маршрутизатор слушает METRICS_PORT, воркер #N - METRICS_PORT + N + 1
+METRICS_LISTEN = os.environ.get('METRICS_LISTEN', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 9108))
+
 # Состояния для ConversationHandler
 SELECT_ANALYSIS, SELECT_INDICATORS, SELECT_INDUSTRY = range(3)
 
@@ -64,6 +241,9 @@ BALANCE_ITEMS = {
     'чистая прибыль': ['чистая прибыль', 'net profit', 'net income', 'прибыль чистая']
 }
 
+# Статьи отчета о финансовых результатах (форма 2); остальные - статьи баланса (форма 1)
+PNL_ITEMS = {'выручка', 'себестоимость', 'валовая прибыль', 'операционные расходы', 'прибыль до налогообложения', 'чистая прибыль'}
+
 # Отраслевые нормативы
 INDUSTRY_STANDARDS = {
     'retail': {
@@ -111,58 +291,919 @@ INDICATOR_GROUPS = {
     'Оборачиваемость': ['выручка', 'запасы', 'дебиторская задолженность', 'активы всего']
 }
 
+# === МЕТРИКИ ===
+
+def format_labels(names, values, extra=''):
+    pairs = [
+        f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34)).replace(chr(10), " ")}"'
+        for name, value in zip(names, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class Counter:
+    """Монотонный счетчик с метками"""
+
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        self.values = collections.defaultdict(float)
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self.lock:
+            self.values[key] += amount
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, format_labels(self.labelnames, key), value) for key, value in self.values.items()]
+
+class Histogram:
+    """Гистограмма длительностей с накопительными корзинами (как в Prometheus)"""
+
+    kind = 'histogram'
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [[0] * len(self.buckets), 0.0, 0]
+            idx = bisect.bisect_left(self.buckets, value)
+            if idx < len(self.buckets):
+                series[0][idx] += 1
+            series[1] += value
+            series[2] += 1
+
+    def samples(self):
+        result = []
+        with self.lock:
+            for key, (counts, total, count) in self.series.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    result.append((f"{self.name}_bucket", format_labels(self.labelnames, key, f'le="{bound}"'), cumulative))
+                result.append((f"{self.name}_bucket", format_labels(self.labelnames, key, 'le="+Inf"'), count))
+                result.append((f"{self.name}_sum", format_labels(self.labelnames, key), total))
+                result.append((f"{self.name}_count", format_labels(self.labelnames, key), count))
+        return result
+
+class CallbackMetric:
+    """Значение, вычисляемое при каждом опросе: глубины очередей, размеры кэшей.
+
+    func возвращает число или словарь {значения меток: число}.
+    """
+
+    def __init__(self, name, help_text, func, labelnames=(), kind='gauge'):
+        self.name = name
+        self.help = help_text
+        self.func = func
+        self.labelnames = labelnames
+        self.kind = kind
+
+    def samples(self):
+        try:
+            value = self.func()
+        except Exception:
+            return []
+        if isinstance(value, dict):
+            return [
+                (self.name, format_labels(self.labelnames, key if isinstance(key, tuple) else (key,)), number)
+                for key, number in value.items()
+            ]
+        return [(self.name, '', value)]
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        """Текстовый формат экспозиции Prometheus"""
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {value:g}" if isinstance(value, float) else f"{name}{labels} {value}")
+        return '\n'.join(lines) + '\n'
+
+METRICS = MetricsRegistry()
+STAGE_SECONDS = METRICS.register(Histogram(
+    'balance_stage_seconds', 'Длительность этапов обработки', ('stage',)
+))
+TELEGRAM_REQUEST_SECONDS = METRICS.register(Histogram(
+    'balance_telegram_request_seconds', 'Длительность запросов к Bot API', ('method',)
+))
+UPLOADS_TOTAL = METRICS.register(Counter('balance_uploads_total', 'Загруженные файлы', ('result',)))
+REPORTS_TOTAL = METRICS.register(Counter('balance_reports_total', 'Запрошенные отчеты', ('report', 'cache')))
+ERRORS_TOTAL = METRICS.register(Counter('balance_errors_total', 'Ошибки и отказы по типу события', ('type',)))
+
+_stage_local = threading.local()
+
+@contextlib.contextmanager
+def stage_timer(stage):
+    """Замеряет этап. Внутри задачи пула замер копится и возвращается вместе с результатом"""
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started_at
+        timings = getattr(_stage_local, 'timings', None)
+        if timings is not None:
+            timings.append((stage, elapsed))
+        else:
+            STAGE_SECONDS.observe(elapsed, stage=stage)
+
+def timed_stage(stage):
+    """Декоратор: вызов функции - один замер этапа stage"""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage_timer(stage):
+                return func(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+def run_timed(func, *args):
+    """Выполняется в воркере пула: возвращает (результат, замеры этапов).
+
+    Процесс-воркер не видит реестр метрик бота, поэтому замеры передаются
+    обратно с результатом и учитываются в run_in_analysis_pool.
+    """
+    _stage_local.timings = []
+    try:
+        return func(*args), _stage_local.timings
+    finally:
+        _stage_local.timings = None
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest, замеряющий каждый запрос к Bot API (отправка сообщений, файлов)"""
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        api_method = 'file' if '/file/bot' in url else url.rsplit('/', 1)[-1]
+        started_at = time.perf_counter()
+        try:
+            return await super().do_request(
+                url, method, request_data=request_data, read_timeout=read_timeout,
+                write_timeout=write_timeout, connect_timeout=connect_timeout, pool_timeout=pool_timeout
+            )
+        finally:
+            TELEGRAM_REQUEST_SECONDS.observe(time.perf_counter() - started_at, method=api_method)
+
+async def metrics_handler(headers, body):
+    return 200, 'text/plain; version=0.0.4; charset=utf-8', METRICS.render().encode('utf-8')
+
+async def start_metrics_server(port_offset=0):
+    """Публикует /metrics на METRICS_PORT + port_offset, если порт задан"""
+    if not METRICS_PORT:
+        return None
+    try:
+        return await start_http_server(
+            {('GET', '/metrics'): metrics_handler}, METRICS_LISTEN, METRICS_PORT + port_offset
+        )
+    except OSError as e:
+        log_event('metrics.listen_failed', logging.WARNING, port=METRICS_PORT + port_offset, error=str(e))
+        return None
+
+# === ПУЛ ВЫЧИСЛЕНИЙ ===
+
+class AnalysisQueueFull(Exception):
+    """Очередь пула вычислений переполнена"""
+
+_analysis_pool = None
+_analysis_jobs_in_flight = 0
+
+class SpoolCleanup:
+    """Удаляет временный файл загрузки после завершения всех задач пула, читающих его.
+
+    Задачи листов из неудачного или прерванного по таймауту gather могут еще
+    стоять в очереди пула, когда обработчик уже вышел: файл удаляется только
+    после того, как последняя из них завершится или будет отменена.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.pending = set()
+        self.released = False
+        self.lock = threading.Lock()
+
+    def track(self, job):
+        with self.lock:
+            self.pending.add(job)
+        job.add_done_callback(self._job_done)
+
+    def _job_done(self, job):
+        with self.lock:
+            self.pending.discard(job)
+            remove = self.released and not self.pending
+        if remove:
+            self._remove()
+
+    def release(self):
+        """Вызывается обработчиком по завершении: файл больше не нужен ему самому"""
+        with self.lock:
+            self.released = True
+            pending = len(self.pending)
+        if pending:
+            log_event('upload.spool_deferred', jobs=pending)
+        else:
+            self._remove()
+
+    def _remove(self):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.path)
+
+# Временный файл текущей загрузки: задачи пула, запущенные обработчиком, регистрируются в нем
+_spool_cleanup = contextvars.ContextVar('spool_cleanup', default=None)
+
+def get_analysis_pool():
+    """Возвращает пул для CPU-тяжелых задач, создавая его при первом обращении"""
+    global _analysis_pool
+    if _analysis_pool is None:
+        if ANALYSIS_EXECUTOR == 'thread':
+            _analysis_pool = concurrent.futures.ThreadPoolExecutor(max_workers=ANALYSIS_WORKERS)
+        else:
+            _analysis_pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=ANALYSIS_WORKERS, mp_context=multiprocessing.get_context(PROCESS_START_METHOD)
+            )
+    return _analysis_pool
+
+def start_analysis_pool():
+    """Создает пул и запускает его процессы заранее, до первого файла.
+
+    Вызывается при старте бота, до потока записи состояния: процессы
+    пула не должны застать в родителе уже работающие потоки.
+    """
+    pool = get_analysis_pool()
+    for _ in range(ANALYSIS_WORKERS):
+        pool.submit(os.getpid)
+
+def release_analysis_slot(loop, job):
+    """Колбэк завершения задачи пула (поток пула): освобождает ее место в цикле событий"""
+    try:
+        loop.call_soon_threadsafe(_analysis_slot_released)
+    except RuntimeError:
+        # Цикл событий уже закрыт - счетчик больше никто не меняет
+        _analysis_slot_released()
+
+def _analysis_slot_released():
+    global _analysis_jobs_in_flight
+    _analysis_jobs_in_flight -= 1
+
+async def run_in_analysis_pool(func, *args, update=None):
+    """Выполняет func(*args) в пуле с ограничением очереди и таймаутом.
+
+    Если все воркеры заняты, пользователю сообщается его место в очереди.
+    При переполнении очереди выбрасывается AnalysisQueueFull, при превышении
+    ANALYSIS_JOB_TIMEOUT - asyncio.TimeoutError. Задача в воркере при этом
+    досчитывается в фоне и до своего завершения занимает место в очереди.
+    """
+    global _analysis_pool, _analysis_jobs_in_flight
+
+    if _analysis_jobs_in_flight >= ANALYSIS_WORKERS + ANALYSIS_QUEUE_LIMIT:
+        log_event('pool.queue_full', logging.WARNING, in_flight=_analysis_jobs_in_flight)
+        raise AnalysisQueueFull()
+
+    queue_position = _analysis_jobs_in_flight - ANALYSIS_WORKERS + 1
+    _analysis_jobs_in_flight += 1
+    submitted = False
+    try:
+        if update is not None and queue_position > 0:
+            await update.message.reply_text(f"⏳ Сервер загружен, вы #{queue_position} в очереди...")
+
+        job = get_analysis_pool().submit(run_timed, func, *args)
+        # Место освобождает завершение самой задачи, а не конец ожидания
+        job.add_done_callback(functools.partial(release_analysis_slot, asyncio.get_running_loop()))
+        submitted = True
+        spool = _spool_cleanup.get()
+        if spool is not None:
+            spool.track(job)
+        result, timings = await asyncio.wait_for(asyncio.wrap_future(job), timeout=ANALYSIS_JOB_TIMEOUT)
+        for stage, elapsed in timings:
+            STAGE_SECONDS.observe(elapsed, stage=stage)
+        return result
+    except asyncio.TimeoutError:
+        log_event('pool.timeout', logging.WARNING, job=getattr(func, '__name__', str(func)))
+        raise
+    except concurrent.futures.BrokenExecutor:
+        # Воркер упал (например, по памяти) - пересоздадим пул при следующем вызове
+        log_event('pool.broken', logging.ERROR)
+        _analysis_pool = None
+        raise
+    finally:
+        if not submitted:
+            _analysis_jobs_in_flight -= 1
+
+async def run_report_job(update, func, *args, cache_key=None):
+    """Строит отчет в пуле; при перегрузке или таймауте отвечает пользователю и возвращает None.
+
+    Если передан cache_key, готовый отчет берется из REPORT_CACHE и сохраняется в него.
+    """
+    report_name = func.__name__
+    if cache_key is not None:
+        report = REPORT_CACHE.get(cache_key)
+        if report is not None:
+            REPORTS_TOTAL.inc(report=report_name, cache='hit')
+            return report
+    REPORTS_TOTAL.inc(report=report_name, cache='miss' if cache_key is not None else 'none')
+
+    try:
+        report = await run_in_analysis_pool(func, *args, update=update)
+    except AnalysisQueueFull:
+        await update.message.reply_text("🚦 Сервер перегружен, повторите запрос через минуту")
+        return None
+    except asyncio.TimeoutError:
+        await update.message.reply_text("⌛ Анализ занял слишком много времени, попробуйте позже")
+        return None
+
+    if cache_key is not None:
+        REPORT_CACHE.put(cache_key, report)
+    return report
+
+# === КЭШ ПО СОДЕРЖИМОМУ ФАЙЛА ===
+
+class ContentCache:
+    """LRU-кэш с ограничением числа записей, временем жизни и счетчиками попаданий"""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            stored_at, value = entry
+            if time.monotonic() - stored_at <= self.ttl:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return value
+            del self.entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        self.entries[key] = (time.monotonic(), value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def items(self):
+        """Живые (не истекшие) записи; счетчики попаданий не меняются"""
+        now = time.monotonic()
+        return [(key, value) for key, (stored_at, value) in self.entries.items() if now - stored_at <= self.ttl]
+
+    def stats(self):
+        return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+REPORT_CACHE = ContentCache(REPORT_CACHE_SIZE, REPORT_CACHE_TTL)
+
+def file_content_hash(source):
+    """Хэш содержимого загруженного файла (байты или путь к файлу) - ключ кэша"""
+    if isinstance(source, str):
+        digest = hashlib.sha256()
+        with open(source, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+    return hashlib.sha256(source).hexdigest()
+
+def report_cache_key(context, analysis_type, *params):
+    """Ключ кэша отчета: хэш файла пользователя, тип анализа и его параметры"""
+    file_hash = context.user_data.get('file_hash')
+    if file_hash is None:
+        return None
+    return (file_hash, analysis_type) + params
+
+# === ОГРАНИЧЕНИЕ ЧАСТОТЫ ЗАПРОСОВ ===
+
+class TokenBucket:
+    """Корзина токенов: capacity запросов подряд, далее rate_per_min в минуту"""
+
+    __slots__ = ('capacity', 'rate', 'tokens', 'updated', 'notified_at')
+
+    def __init__(self, capacity, rate_per_min):
+        self.capacity = capacity
+        self.rate = rate_per_min / 60.0
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.notified_at = None
+
+    def consume(self):
+        """Забирает токен; возвращает 0, если запрос разрешен, иначе сколько секунд ждать"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        if self.rate <= 0:
+            return float('inf')
+        return (1 - self.tokens) / self.rate
+
+    def should_notify(self):
+        """Отвечать ли на отказ: не чаще раза за время пополнения одного токена (при rate 0 - однажды)"""
+        now = time.monotonic()
+        if self.notified_at is not None and (self.rate <= 0 or (now - self.notified_at) * self.rate < 1):
+            return False
+        self.notified_at = now
+        return True
+
+class RateLimiter:
+    """Корзины токенов по (пользователь, вид действия) с вытеснением давно неактивных"""
+
+    def __init__(self, limits, max_buckets=100000):
+        self.limits = limits
+        self.max_buckets = max_buckets
+        self.buckets = collections.OrderedDict()
+        self.rejected = collections.Counter()
+
+    def bucket(self, user_id, kind):
+        key = (user_id, kind)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(*self.limits[kind])
+            if len(self.buckets) > self.max_buckets:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+        return bucket
+
+RATE_LIMITER = RateLimiter(RATE_LIMITS)
+_parses_in_flight = 0
+
+async def check_rate_limit(update, kind):
+    """Пропускает запрос или сразу отвечает отказом, не ставя его в очередь.
+
+    Ответ на отказ отправляется не чаще раза за время пополнения одного
+    токена, чтобы поток отказов не превращался в поток сообщений.
+    """
+    user = update.effective_user
+    if user is None:
+        return True
+
+    bucket = RATE_LIMITER.bucket(user.id, kind)
+    wait = bucket.consume()
+    if not wait:
+        return True
+
+    RATE_LIMITER.rejected[kind] += 1
+    if bucket.should_notify():
+        seconds = int(wait) + 1 if wait != float('inf') else None
+        hint = f" через {seconds} с" if seconds else " позже"
+        await update.message.reply_text(f"🐢 Слишком много запросов, повторите{hint}")
+    return False
+
+# === КОЛОНОЧНОЕ ХРАНЕНИЕ ПЕРИОДОВ ===
+
+# Наборы периодов и статей (коэффициентов), общие для всех таблиц: одинаковый
+# набор хранится один раз вместе с индексом название -> номер строки (столбца)
+_LABEL_TABLES = {}
+LABEL_TABLES_LIMIT = 10000
+
+def intern_labels(labels):
+    """(кортеж названий, индекс название -> номер), общий для таблиц с тем же набором.
+
+    Известный набор находится одним поиском в словаре; sys.intern и построение
+    индекса выполняются только для нового набора.
+    """
+    labels = tuple(labels)
+    table = _LABEL_TABLES.get(labels)
+    if table is None:
+        labels = tuple(sys.intern(label) for label in labels)
+        table = (labels, {label: idx for idx, label in enumerate(labels)})
+        if len(_LABEL_TABLES) < LABEL_TABLES_LIMIT:
+            _LABEL_TABLES[labels] = table
+    return table
+
+class PeriodColumn(collections.abc.Mapping):
+    """Значения одного периода PeriodsFrame: словарь статья -> значение только для чтения"""
+
+    __slots__ = ('frame', 'col')
+
+    def __init__(self, frame, col):
+        self.frame = frame
+        self.col = col
+
+    def __getitem__(self, item):
+        value = self.frame.matrix[self.frame.item_index[item], self.col]
+        if value != value:  # NaN - нет значения
+            raise KeyError(item)
+        return float(value)
+
+    def __contains__(self, item):
+        idx = self.frame.item_index.get(item)
+        return idx is not None and not np.isnan(self.frame.matrix[idx, self.col])
+
+    def __iter__(self):
+        names = self.frame.item_names
+        return (names[idx] for idx in np.flatnonzero(~np.isnan(self.frame.matrix[:, self.col])))
+
+    def __len__(self):
+        return int(np.count_nonzero(~np.isnan(self.frame.matrix[:, self.col])))
+
+    def to_dict(self):
+        column = self.frame.matrix[:, self.col].tolist()
+        return {item: value for item, value in zip(self.frame.item_names, column) if value == value}
+
+    def items(self):
+        return self.to_dict().items()
+
+    def values(self):
+        return self.to_dict().values()
+
+class PeriodsFrame(collections.abc.Mapping):
+    """Колоночное представление periods_data (и periods_ratios).
+
+    Вместо словаря период -> {статья: значение} хранит общие наборы периодов
+    и статей (intern_labels) и одну матрицу float64 статьи × периоды, NaN -
+    нет значения. Для отчетов выглядит как тот же словарь словарей, только
+    для чтения; расчет коэффициентов и ряды для отчетов берут строки матрицы
+    напрямую.
+    """
+
+    __slots__ = ('periods', 'period_index', 'item_names', 'item_index', 'matrix')
+
+    def __init__(self, periods, items, matrix):
+        self.periods, self.period_index = intern_labels(periods)
+        self.item_names, self.item_index = intern_labels(items)
+        self.matrix = matrix
+
+    @classmethod
+    def from_mapping(cls, periods_data):
+        """Таблица из словаря период -> {статья: значение}; таблица возвращается как есть"""
+        if isinstance(periods_data, cls):
+            return periods_data
+        items, item_index = intern_labels(dict.fromkeys(item for data in periods_data.values() for item in data))
+        matrix = np.full((len(items), len(periods_data)), np.nan)
+        for col, data in enumerate(periods_data.values()):
+            for item, value in data.items():
+                matrix[item_index[item], col] = value
+        return cls(periods_data, items, matrix)
+
+    def __reduce__(self):
+        return PeriodsFrame, (self.periods, self.item_names, self.matrix)
+
+    def __getitem__(self, period):
+        return PeriodColumn(self, self.period_index[period])
+
+    def __contains__(self, period):
+        return period in self.period_index
+
+    def __iter__(self):
+        return iter(self.periods)
+
+    def __reversed__(self):
+        return reversed(self.periods)
+
+    def __len__(self):
+        return len(self.periods)
+
+    def row_series(self, item):
+        """[(период, значение)] статьи по периодам, где она есть"""
+        idx = self.item_index.get(item)
+        if idx is None:
+            return []
+        return [(period, value) for period, value in zip(self.periods, self.matrix[idx].tolist()) if value == value]
+
+    def rows(self, items):
+        """Матрица выбранных статей × периоды; отсутствующее значение дает 0, как data.get(item, 0)"""
+        rows = np.zeros((len(items), len(self.periods)))
+        for row, item in enumerate(items):
+            idx = self.item_index.get(item)
+            if idx is not None:
+                rows[row] = self.matrix[idx]
+        rows[np.isnan(rows)] = 0
+        return rows
+
+    def nonempty(self):
+        """Таблица без периодов, в которых нет ни одного значения"""
+        filled = ~np.isnan(self.matrix).all(axis=0)
+        if filled.all():
+            return self
+        periods = [period for period, keep in zip(self.periods, filled.tolist()) if keep]
+        return PeriodsFrame(periods, self.item_names, self.matrix[:, filled])
+
+    def to_dict(self):
+        return {period: self[period].to_dict() for period in self.periods}
+
+# === ХРАНИЛИЩЕ СОСТОЯНИЯ ПОЛЬЗОВАТЕЛЕЙ ===
+
+# Поля user_data, которые переживают перезапуск бота
+PERSISTENT_USER_FIELDS = ('file_name', 'file_hash', 'loaded_at')
+
+def encode_periods_data(periods_data):
+    """Кодирует periods_data (словарь или PeriodsFrame) в компактный бинарный вид.
+
+    Формат (сжат zlib): длина заголовка (uint32), заголовок JSON со списками
+    периодов и статей, затем матрица статьи × периоды в float64; NaN - нет значения.
+    """
+    frame = PeriodsFrame.from_mapping(periods_data)
+    header = json.dumps({'periods': frame.periods, 'items': frame.item_names}, ensure_ascii=False).encode('utf-8')
+    return zlib.compress(struct.pack('<I', len(header)) + header + np.ascontiguousarray(frame.matrix).tobytes())
+
+@functools.lru_cache(maxsize=1024)
+def decode_periods_header(header):
+    """Наборы периодов и статей из заголовка; у многих пользователей заголовки совпадают"""
+    header = json.loads(header.decode('utf-8'))
+    return intern_labels(header['periods'])[0], intern_labels(header['items'])[0]
+
+def decode_periods_data(blob):
+    """Восстанавливает periods_data из encode_periods_data в виде PeriodsFrame"""
+    raw = zlib.decompress(blob)
+    (header_size,) = struct.unpack_from('<I', raw)
+    periods, items = decode_periods_header(raw[4:4 + header_size])
+
+    # Копия выравнивает матрицу и отпускает распакованный блок целиком
+    matrix = np.frombuffer(raw, dtype=np.float64, offset=4 + header_size).reshape(len(items), len(periods))
+    return PeriodsFrame(periods, items, matrix.copy())
+
+def encode_user_state(state):
+    """Состояние пользователя -> (поля-метаданные, бинарные periods_data)"""
+    fields = {field: state.get(field) for field in PERSISTENT_USER_FIELDS}
+    return fields, encode_periods_data(state.get('periods_data') or {})
+
+def decode_user_state(fields, blob):
+    state = {field: value for field, value in fields.items() if value is not None}
+    state['periods_data'] = decode_periods_data(blob)
+    return state
+
+class StateBackend(abc.ABC):
+    """Интерфейс хранилища состояния пользователей.
+
+    Реализация хранит для user_id набор полей PERSISTENT_USER_FIELDS и бинарный
+    блок periods_data. Так же может быть устроено хранилище поверх Redis или
+    другого key-value сервиса.
+    """
+
+    @abc.abstractmethod
+    def load(self, user_id):
+        """Возвращает (поля, бинарные данные) или None"""
+
+    @abc.abstractmethod
+    def save_many(self, records):
+        """Сохраняет пачку {user_id: (поля, бинарные данные)} одной операцией"""
+
+    @abc.abstractmethod
+    def delete(self, user_id):
+        """Удаляет состояние пользователя"""
+
+    def close(self):
+        pass
+
+class MemoryStateBackend(StateBackend):
+    """Хранилище в памяти процесса - локальная замена Redis для тестов и разработки"""
+
+    def __init__(self):
+        self.records = {}
+        self.lock = threading.Lock()
+
+    def load(self, user_id):
+        with self.lock:
+            return self.records.get(user_id)
+
+    def save_many(self, records):
+        with self.lock:
+            self.records.update(records)
+
+    def delete(self, user_id):
+        with self.lock:
+            self.records.pop(user_id, None)
+
+class SQLiteStateBackend(StateBackend):
+    """Встроенное хранилище SQLite в режиме WAL с индексом по user_id"""
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.execute('PRAGMA busy_timeout=5000')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS user_state ('
+                'user_id INTEGER PRIMARY KEY, fields TEXT NOT NULL, '
+                'periods_data BLOB NOT NULL, updated_at REAL NOT NULL)'
+            )
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS user_state_updated_at ON user_state(updated_at)'
+            )
+
+    def load(self, user_id):
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT fields, periods_data FROM user_state WHERE user_id = ?', (user_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1]
+
+    def save_many(self, records):
+        now = time.time()
+        rows = [
+            (user_id, json.dumps(fields, ensure_ascii=False), blob, now)
+            for user_id, (fields, blob) in records.items()
+        ]
+        with self.lock:
+            self.connection.execute('BEGIN')
+            try:
+                self.connection.executemany(
+                    'INSERT OR REPLACE INTO user_state (user_id, fields, periods_data, updated_at) '
+                    'VALUES (?, ?, ?, ?)', rows
+                )
+                self.connection.execute('COMMIT')
+            except Exception:
+                self.connection.execute('ROLLBACK')
+                raise
+
+    def delete(self, user_id):
+        with self.lock:
+            self.connection.execute('DELETE FROM user_state WHERE user_id = ?', (user_id,))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+class StateStore:
+    """Хранилище состояния с отложенной пакетной записью (write-behind).
+
+    save() лишь кладет состояние в очередь - кодирование и запись на диск
+    выполняет фоновый поток пачками раз в STATE_FLUSH_INTERVAL секунд.
+    Несколько сохранений одного пользователя до сброса схлопываются в одно.
+    """
+
+    def __init__(self, backend, flush_interval):
+        self.backend = backend
+        self.flush_interval = flush_interval
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = False
+        self.thread = threading.Thread(target=self._run, name='state-writer', daemon=True)
+        self.thread.start()
+
+    def save(self, user_id, state):
+        with self.lock:
+            self.pending[user_id] = dict(state)
+        self.wakeup.set()
+
+    def load(self, user_id):
+        with self.lock:
+            if user_id in self.pending:
+                return dict(self.pending[user_id])
+        record = self.backend.load(user_id)
+        if record is None:
+            return None
+        return decode_user_state(*record)
+
+    def delete(self, user_id):
+        with self.lock:
+            self.pending.pop(user_id, None)
+        self.backend.delete(user_id)
+
+    def flush(self):
+        """Записывает накопленные изменения одной пачкой"""
+        with self.lock:
+            batch, self.pending = self.pending, {}
+        if not batch:
+            return
+        try:
+            self.backend.save_many({user_id: encode_user_state(state) for user_id, state in batch.items()})
+        except Exception as e:
+            log_event('state.write_failed', logging.ERROR, users=len(batch), error=str(e))
+            # Вернем в очередь то, что не успели перезаписать более свежими данными
+            with self.lock:
+                for user_id, state in batch.items():
+                    self.pending.setdefault(user_id, state)
+
+    def close(self):
+        self.stopped = True
+        self.wakeup.set()
+        self.thread.join(timeout=5)
+        self.flush()
+        self.backend.close()
+
+    def _run(self):
+        while not self.stopped:
+            self.wakeup.wait()
+            # Даем накопиться пачке, затем пишем все разом
+            time.sleep(self.flush_interval)
+            self.wakeup.clear()
+            self.flush()
+
+_state_store = None
+
+def get_state_store():
+    """Возвращает хранилище состояния, создавая его при первом обращении"""
+    global _state_store
+    if _state_store is None:
+        if STATE_BACKEND == 'memory':
+            backend = MemoryStateBackend()
+        else:
+            backend = SQLiteStateBackend(STATE_DB_PATH)
+        _state_store = StateStore(backend, STATE_FLUSH_INTERVAL)
+        atexit.register(_state_store.close)
+    return _state_store
+
+# Глубины очередей и состояние кэшей считываются в момент опроса /metrics
+METRICS.register(CallbackMetric(
+    'balance_analysis_jobs_in_flight', 'Задачи в пуле вычислений (выполняются и ждут)',
+    lambda: _analysis_jobs_in_flight
+))
+METRICS.register(CallbackMetric(
+    'balance_parses_in_flight', 'Файлы, которые сейчас скачиваются и разбираются', lambda: _parses_in_flight
+))
+METRICS.register(CallbackMetric(
+    'balance_state_pending_writes', 'Пользователи, ожидающие записи в хранилище состояния',
+    lambda: len(_state_store.pending) if _state_store is not None else 0
+))
+METRICS.register(CallbackMetric('balance_cache_entries', 'Записи в кэше файлов и отчетов', lambda: len(REPORT_CACHE.entries)))
+METRICS.register(CallbackMetric('balance_cache_hits_total', 'Попадания в кэш', lambda: REPORT_CACHE.hits, kind='counter'))
+METRICS.register(CallbackMetric('balance_cache_misses_total', 'Промахи кэша', lambda: REPORT_CACHE.misses, kind='counter'))
+METRICS.register(CallbackMetric(
+    'balance_rate_limited_total', 'Отклоненные ограничителем запросы', lambda: dict(RATE_LIMITER.rejected),
+    labelnames=('kind',), kind='counter'
+))
+
 # === ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ===
 
-def save_uploaded_file(file_bytes, user_id, file_name):
-    """Сохраняет загруженный файл на сервере"""
+def save_uploaded_file(source, user_id, file_name):
+    """Сохраняет загруженный файл на сервере.
+
+    Файл, уже лежащий на диске, не копируется, а связывается жесткой ссылкой.
+    """
     try:
         user_dir = f"temp_files/user_{user_id}"
         os.makedirs(user_dir, exist_ok=True)
         
         file_path = os.path.join(user_dir, file_name)
-        with open(file_path, 'wb') as f:
-            f.write(file_bytes)
+        if isinstance(source, str):
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            try:
+                os.link(source, file_path)
+            except OSError:
+                shutil.copyfile(source, file_path)
+        else:
+            with open(file_path, 'wb') as f:
+                f.write(source)
         
         return file_path
     except Exception as e:
-        print(f"❌ Ошибка сохранения файла: {e}")
+        log_event('upload.archive_failed', logging.ERROR, user_id=user_id, error=str(e))
         return None
 
 def save_user_data(user_id, data):
-    """Сохраняет данные пользователя в файл"""
+    """Ставит данные пользователя в очередь на сохранение в хранилище состояния"""
     try:
-        user_dir = f"temp_files/user_{user_id}"
-        os.makedirs(user_dir, exist_ok=True)
-        
-        data_file = os.path.join(user_dir, 'user_data.json')
-        with open(data_file, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-        
+        get_state_store().save(user_id, {
+            field: data[field] for field in ('periods_data',) + PERSISTENT_USER_FIELDS if field in data
+        })
         return True
     except Exception as e:
-        print(f"❌ Ошибка сохранения данных: {e}")
+        log_event('state.save_failed', logging.ERROR, user_id=user_id, error=str(e))
         return False
 
 def load_user_data_with_fallback(context, user_id):
-    """Загружает данные пользователя с возвратом к файловому хранилищу"""
+    """Загружает данные пользователя с возвратом к хранилищу состояния"""
     try:
         # Сначала проверяем, есть ли данные в контексте
         if 'periods_data' in context.user_data and context.user_data['periods_data']:
             return True
         
-        # Если нет в контексте, пробуем загрузить из файла
-        user_dir = f"temp_files/user_{user_id}"
-        data_file = os.path.join(user_dir, 'user_data.json')
-        
-        if os.path.exists(data_file):
-            with open(data_file, 'r', encoding='utf-8') as f:
-                user_data = json.load(f)
-                context.user_data.update(user_data)
+        # Если нет в контексте, пробуем загрузить из хранилища
+        user_data = get_state_store().load(user_id)
+        if user_data and user_data.get('periods_data'):
+            context.user_data.update(user_data)
             return True
         
         return False
     except Exception as e:
-        print(f"❌ Ошибка загрузки данных: {e}")
+        log_event('state.load_failed', logging.ERROR, user_id=user_id, error=str(e))
         return False
 
 async def template_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -187,6 +1228,18 @@ async def template_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 """
     await update.message.reply_text(template)
 
+async def append_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /append: следующий файл дополнит загруженные данные новыми периодами"""
+    if not load_user_data_with_fallback(context, update.message.from_user.id):
+        await update.message.reply_text("❌ Сначала загрузите файл с данными")
+        return
+
+    context.user_data['upload_mode'] = 'append'
+    await update.message.reply_text(
+        "📎 Пришлите файл только с новыми периодами - они будут добавлены к загруженным данным.\n\n"
+        "Можно и без команды: подпишите файл /append"
+    )
+
 async def sample_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Создает пример файла с периодами для тестирования"""
     sample_data = {
@@ -226,6 +1279,133 @@ async def sample_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         caption='📋 Вот пример файла с отчетами за несколько периодов. Отправьте его боту для анализа динамики!'
     )
     
+# === ОТПРАВКА ДЛИННЫХ СООБЩЕНИЙ ===
+
+def telegram_length(text):
+    """Длина в единицах UTF-16 - так Telegram считает лимит сообщения"""
+    return len(text.encode('utf-16-le')) // 2
+
+def split_long_line(line, limit):
+    """Режет строку длиннее limit по пробелам, не оставляя **жирный** незакрытым"""
+    budget = limit - 4  # место под закрывающие и открывающие **
+    words = []
+    for word in line.split(' '):
+        while telegram_length(word) > budget:
+            cut = budget
+            while telegram_length(word[:cut]) > budget or word[cut - 1:cut + 1] == '**':
+                cut -= 1
+            words.append(word[:cut])
+            word = word[cut:]
+        words.append(word)
+
+    pieces = []
+    current = ''
+    for word in words:
+        candidate = f"{current} {word}" if current else word
+        if current and telegram_length(candidate) > budget:
+            pieces.append(current)
+            current = word
+        else:
+            current = candidate
+    pieces.append(current)
+
+    # Разметка, открытая в одной части, закрывается в ней и открывается в следующей
+    bold = False
+    for index, piece in enumerate(pieces):
+        if bold:
+            piece = '**' + piece
+        bold = piece.count('**') % 2 == 1
+        pieces[index] = piece + '**' if bold else piece
+    return pieces
+
+def split_message(text, limit=MESSAGE_MAX_LENGTH):
+    """Делит текст на сообщения не длиннее limit.
+
+    Части режутся по границам разделов (пустая строка), раздел длиннее
+    лимита - по строкам, строка длиннее лимита - split_long_line.
+    """
+    if telegram_length(text) <= limit:
+        return [text] if text.strip() else []
+
+    units = []
+    sections = text.split('\n\n')
+    for index, section in enumerate(sections):
+        if index < len(sections) - 1:
+            section += '\n\n'
+        if telegram_length(section) <= limit:
+            units.append(section)
+            continue
+        for line in section.splitlines(keepends=True):
+            if telegram_length(line) <= limit:
+                units.append(line)
+            else:
+                units.extend(split_long_line(line.rstrip('\n'), limit))
+
+    chunks = []
+    current = []
+    size = 0
+    for unit in units:
+        unit_size = telegram_length(unit)
+        if current and size + unit_size > limit:
+            chunks.append(''.join(current))
+            current = []
+            size = 0
+        current.append(unit)
+        size += unit_size
+    if current:
+        chunks.append(''.join(current))
+    return [chunk.rstrip('\n') for chunk in chunks if chunk.strip()]
+
+# Темп отправки: корзина на чат и общая корзина процесса (лимиты Bot API)
+SEND_LIMITER = RateLimiter({
+    'chat': (SEND_CHAT_BURST, SEND_CHAT_PER_SEC * 60),
+    'global': (max(1, int(SEND_GLOBAL_PER_SEC)), SEND_GLOBAL_PER_SEC * 60),
+})
+
+async def wait_send_slot(chat_id):
+    """Ждет, пока отправка в чат уложится в лимиты чата и бота"""
+    for bucket in (SEND_LIMITER.bucket(chat_id, 'chat'), SEND_LIMITER.bucket(None, 'global')):
+        wait = bucket.consume()
+        while wait:
+            await asyncio.sleep(wait)
+            wait = bucket.consume()
+
+class PacedRateLimiter(BaseRateLimiter):
+    """Ограничитель запросов к Bot API для Application.
+
+    Все запросы с chat_id идут в темпе корзин SEND_LIMITER; на RetryAfter
+    (flood control) запрос ждет указанное Telegram время и повторяется до
+    SEND_MAX_RETRIES раз (или rate_limit_args раз, если он задан у вызова).
+    """
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        max_retries = SEND_MAX_RETRIES if rate_limit_args is None else rate_limit_args
+        chat_id = data.get('chat_id')
+        for attempt in range(max_retries + 1):
+            if chat_id is not None:
+                await wait_send_slot(chat_id)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == max_retries:
+                    raise
+                delay = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after
+                log_event('send.retry_after', logging.WARNING, endpoint=endpoint, chat_id=chat_id,
+                          retry_after=delay, attempt=attempt + 1)
+                await asyncio.sleep(delay)
+
+async def send_long_message(message, text, **kwargs):
+    """Отправляет текст частями split_message по порядку; kwargs - для последней части"""
+    chunks = split_message(text)
+    for index, chunk in enumerate(chunks):
+        await message.reply_text(chunk, **(kwargs if index == len(chunks) - 1 else {}))
+
 # === ОСНОВНЫЕ ОБРАБОТЧИКИ КОМАНД ===
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Улучшенный обработчик команды /start с меню выбора"""
@@ -284,11 +1464,41 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 • 31.12.2023, 31.12.2022
 • На 31 декабря 2023
 • За 2023 год, За 2022 год
+
+➕ **НОВЫЙ ПЕРИОД:**
+/append и файл только с новыми периодами - они добавятся к загруженным данным
+
+📦 **ПАКЕТ КОМПАНИЙ:**
+zip-архив с книгами или книга с подписью "портфель" (лист - компания):
+рейтинг компаний и Excel с данными каждой
 """
     await update.message.reply_text(help_text)
 
 async def receive_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик загрузки Excel файлов"""
+    global _parses_in_flight
+
+    if not await check_rate_limit(update, 'upload'):
+        return
+
+    # Общий предел на разбор файлов: лишние загрузки отклоняем сразу, до скачивания
+    if _parses_in_flight >= MAX_CONCURRENT_PARSES:
+        RATE_LIMITER.rejected['parse'] += 1
+        await update.message.reply_text("🚦 Сейчас обрабатывается много файлов, отправьте файл повторно через минуту")
+        return
+
+    _parses_in_flight += 1
+    try:
+        await process_document(update, context)
+    finally:
+        _parses_in_flight -= 1
+
+async def process_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Скачивание, разбор и сохранение загруженного файла"""
+    # Режим добавления: после /append или с подписью /append к файлу
+    caption = (update.message.caption or '').strip().lower()
+    caption_command = (caption.split() or [''])[0]
+    append = context.user_data.pop('upload_mode', None) == 'append' or caption_command in APPEND_CAPTIONS
     try:
         if not update.message.document:
             await update.message.reply_text("📎 Пожалуйста, пришлите Excel файл с отчетностью")
@@ -297,152 +1507,669 @@ async def receive_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
         file = update.message.document
         file_name = file.file_name.lower()
 
-        if not (file_name.endswith('.xlsx') or file_name.endswith('.xls')):
-            await update.message.reply_text("❌ Пожалуйста, пришлите файл в формате Excel (.xlsx или .xls)")
+        if not file_name.endswith(('.xlsx', '.xls', '.zip')):
+            await update.message.reply_text(
+                "❌ Пожалуйста, пришлите файл в формате Excel (.xlsx или .xls) или zip-архив с книгами"
+            )
             return
 
-        await update.message.reply_text("⏳ Анализирую структуру файла...")
+        # Пакет компаний: zip-архив книг или книга с подписью "портфель" (лист - компания)
+        batch = file_name.endswith('.zip') or caption_command in BATCH_CAPTIONS
 
-        # Скачиваем файл
-        file_obj = await file.get_file()
-        file_bytes = await file_obj.download_as_bytearray()
+        # Заявленный размер проверяем до скачивания
+        if file.file_size and file.file_size > MAX_UPLOAD_MB * 1024 * 1024:
+            await update.message.reply_text(
+                f"❌ Файл слишком большой ({file.file_size / 1024 / 1024:.1f} МБ), максимум {MAX_UPLOAD_MB:g} МБ"
+            )
+            return
+
+        await update.message.reply_text("⏳ Анализирую структуру файла...")
 
-        # Читаем Excel файл
+        # Скачиваем файл: небольшой - в память без лишних копий, крупный - на диск
+        started_at = time.perf_counter()
+        with stage_timer('download'):
+            source = await download_upload(file)
+        log_event('upload.downloaded', size=source_size(source), spooled=isinstance(source, str),
+                  duration_ms=round((time.perf_counter() - started_at) * 1000, 1))
+        # Файл на диске удаляем, когда завершатся все задачи пула, которые могут его открыть
+        spool = SpoolCleanup(source) if isinstance(source, str) else None
+        token = _spool_cleanup.set(spool)
         try:
-            df = read_excel_file(file_bytes, file_name)
-        except Exception as e:
-            await update.message.reply_text(f"❌ Ошибка чтения файла: {str(e)}")
-            return
-        
-        # Определяем периоды
-        periods = detect_periods(df)
-        
-        if not periods:
-            await update.message.reply_text("❌ Не удалось определить периоды в файле")
-            return
-        
-        # Извлекаем данные по периодам
-        periods_data = extract_financial_data_by_period(df, periods)
-        
-        # Сохраняем данные в контекст пользователя
-        context.user_data.update({
-            'periods_data': periods_data,
-            'file_name': file_name,
-            'loaded_at': datetime.now().isoformat()
-        })
-        
-        extracted_count = sum(len(data) for data in periods_data.values())
-        await update.message.reply_text(
-            f"✅ Файл успешно обработан!\n"
-            f"📊 Извлечено показателей: {extracted_count}\n"
-            f"📅 Периодов: {len(periods)}\n\n"
-            f"🎯 **Теперь выберите тип анализа:**"
-        )
+            if batch:
+                await analyze_batch(update, context, source, file_name)
+            else:
+                await analyze_upload(update, context, source, file_name, append=append)
+        finally:
+            _spool_cleanup.reset(token)
+            if spool is not None:
+                spool.release()
 
     except Exception as e:
         await update.message.reply_text(f"❌ Ошибка при анализе: {str(e)}")
-        logger.error(f"Ошибка в receive_document: {e}")
+        log_event('upload.failed', logging.ERROR, error=str(e))
+
+async def analyze_upload(update, context, source, file_name, append=False):
+    """Разбор скачанного файла (байты или путь на диске) и сохранение результата.
+
+    append: периоды файла добавляются к уже загруженным данным пользователя.
+    """
+    # Повторно загруженный файл берем из кэша, не разбирая заново
+    started_at = time.perf_counter()
+    # Хэш файла до MAX_UPLOAD_MB считается в потоке, не блокируя цикл событий
+    file_hash = await asyncio.to_thread(file_content_hash, source)
+    parsed = REPORT_CACHE.get(('file', file_hash))
+    cached = parsed is not None
+
+    if ARCHIVE_UPLOADS:
+        await asyncio.to_thread(save_uploaded_file, source, update.message.from_user.id, os.path.basename(file_name))
+
+    # Иначе проверяем структуру файла, читаем его, определяем периоды
+    # и извлекаем данные в пуле вычислений
+    if parsed is None:
+        try:
+            # Проверка читает центральный каталог zip - в потоке, не блокируя цикл событий
+            warnings = await asyncio.to_thread(inspect_upload, source, file_name)
+        except UploadRejected as e:
+            UPLOADS_TOTAL.inc(result='rejected')
+            await update.message.reply_text(f"❌ {e}")
+            return
+        for warning in warnings:
+            await update.message.reply_text(f"⚠️ {warning}")
+
+        try:
+            parsed = await parse_workbook_in_pool(source, file_name, update=update)
+        except AnalysisQueueFull:
+            UPLOADS_TOTAL.inc(result='overloaded')
+            await update.message.reply_text("🚦 Сервер перегружен, отправьте файл повторно через минуту")
+            return
+        except asyncio.TimeoutError:
+            UPLOADS_TOTAL.inc(result='timeout')
+            await update.message.reply_text("⌛ Файл обрабатывается слишком долго, попробуйте файл меньшего размера")
+            return
+        except Exception as e:
+            UPLOADS_TOTAL.inc(result='parse_error')
+            log_event('upload.parse_failed', logging.WARNING, error=str(e))
+            await update.message.reply_text(f"❌ Ошибка чтения файла: {str(e)}")
+            return
+        REPORT_CACHE.put(('file', file_hash), parsed)
+
+    periods, periods_data, periods_ratios = parsed
+
+    if not periods:
+        await update.message.reply_text("❌ Не удалось определить периоды в файле")
+        return
+
+    if append:
+        if load_user_data_with_fallback(context, update.message.from_user.id):
+            await append_periods(update, context, periods_data, file_hash, file_name, started_at)
+            return
+        await update.message.reply_text("ℹ️ Загруженных данных нет, файл загружен как новый")
+
+    # Сохраняем данные и снимок коэффициентов в контекст пользователя;
+    # снимок заменяется только при загрузке нового файла
+    context.user_data.update({
+        'periods_data': periods_data,
+        'periods_ratios': periods_ratios,
+        'file_hash': file_hash,
+        'file_name': file_name,
+        'loaded_at': datetime.now().isoformat()
+    })
+    save_user_data(update.message.from_user.id, context.user_data)
+    
+    extracted_count = sum(len(data) for data in periods_data.values())
+    UPLOADS_TOTAL.inc(result='cached' if cached else 'parsed')
+    log_event('upload.parsed', file_hash=file_hash[:16], cached=cached, periods=len(periods),
+              values=extracted_count, duration_ms=round((time.perf_counter() - started_at) * 1000, 1))
+    await update.message.reply_text(
+        f"✅ Файл успешно обработан!\n"
+        f"📊 Извлечено показателей: {extracted_count}\n"
+        f"📅 Периодов: {len(periods)}\n\n"
+        f"🎯 **Теперь выберите тип анализа:**"
+    )
+
+async def append_periods(update, context, new_periods_data, file_hash, file_name, started_at):
+    """Добавляет периоды разобранного файла к данным пользователя"""
+    user_data = context.user_data
+    old_periods_data = user_data['periods_data']
+    old_key = user_data.get('file_hash')
+
+    periods_data, periods_ratios, affected = merge_appended_periods(
+        old_periods_data, get_periods_ratios(context), new_periods_data
+    )
+    new_key = appended_dataset_key(old_key, file_hash)
+
+    affected_items = {item for period in affected for item in new_periods_data[period]}
+    last_period = next(reversed(periods_data), None)
+    last_period_changed = last_period != next(reversed(old_periods_data), None) or last_period in affected
+    carried = carry_over_reports(old_key, new_key, affected_items, last_period_changed) if old_key else 0
+
+    user_data.update({
+        'periods_data': periods_data,
+        'periods_ratios': periods_ratios,
+        'file_hash': new_key,
+        'file_name': f"{user_data.get('file_name') or 'данные'} + {file_name}",
+        'loaded_at': datetime.now().isoformat()
+    })
+    save_user_data(update.message.from_user.id, user_data)
+
+    added = sum(1 for period in affected if period not in old_periods_data)
+    UPLOADS_TOTAL.inc(result='appended')
+    log_event('upload.appended', file_hash=file_hash[:16], added=added, updated=len(affected) - added,
+              periods=len(periods_data), reports_kept=carried,
+              duration_ms=round((time.perf_counter() - started_at) * 1000, 1))
+    await update.message.reply_text(
+        f"✅ Периоды добавлены!\n"
+        f"➕ Новых периодов: {added}, обновлено: {len(affected) - added}\n"
+        f"📅 Всего периодов: {len(periods_data)}\n\n"
+        f"🎯 **Теперь выберите тип анализа:**"
+    )
+
+# === СКАЧИВАНИЕ ФАЙЛОВ ===
+
+class UploadBuffer:
+    """Приемник для File.download_to_memory: хранит скачанные байты без копирования.
+
+    В отличие от bytearray и BytesIO, ответ Telegram не переписывается в
+    новый буфер - тот же объект bytes идет на хэширование и разбор.
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+        return len(data)
+
+    def getvalue(self):
+        if len(self.chunks) == 1 and isinstance(self.chunks[0], bytes):
+            return self.chunks[0]
+        return b''.join(self.chunks)
+
+async def download_upload(document):
+    """Скачивает документ: возвращает bytes или путь к временному файлу.
+
+    Файлы крупнее UPLOAD_SPOOL_THRESHOLD_MB пишутся на диск: в пул вычислений
+    тогда передается путь, и воркеры читают книгу с диска, а не получают
+    копию содержимого на каждый лист. Временный файл удаляет вызывающий.
+    """
+    file_obj = await document.get_file()
+
+    if (document.file_size or 0) <= UPLOAD_SPOOL_THRESHOLD_MB * 1024 * 1024:
+        buffer = UploadBuffer()
+        await file_obj.download_to_memory(buffer)
+        return buffer.getvalue()
+
+    os.makedirs(UPLOAD_SPOOL_DIR, exist_ok=True)
+    fd, path = tempfile.mkstemp(suffix=os.path.splitext(document.file_name or '')[1].lower(), dir=UPLOAD_SPOOL_DIR)
+    os.close(fd)
+    try:
+        await file_obj.download_to_drive(custom_path=path)
+    except Exception:
+        os.remove(path)
+        raise
+    return path
+
+def excel_source(source):
+    """Объект для openpyxl/pandas/zipfile: путь как есть, байты - в BytesIO (без копирования)"""
+    return source if isinstance(source, str) else io.BytesIO(source)
+
+def source_size(source):
+    return os.path.getsize(source) if isinstance(source, str) else len(source)
+
+# === ПРОВЕРКА ЗАГРУЖАЕМЫХ ФАЙЛОВ ===
+
+class UploadRejected(Exception):
+    """Файл отклонен до разбора; текст исключения показывается пользователю"""
+
+DIMENSION_PATTERN = re.compile(rb'<(?:\w+:)?dimension\s+ref="([A-Z]+)?(\d+)?(?::([A-Z]+)(\d+))?"')
+
+def column_number(letters):
+    """Номер столбца Excel по буквам: A -> 1, AB -> 28"""
+    number = 0
+    for char in letters:
+        number = number * 26 + ord(char) - 64
+    return number
+
+def sheet_dimension(zip_file, member):
+    """Размер листа (строк, столбцов) по элементу <dimension> в начале XML листа.
+
+    Распаковывается только первый фрагмент части; если элемента нет, возвращается None.
+    """
+    with zip_file.open(member) as stream:
+        head = stream.read(4096)
+    match = DIMENSION_PATTERN.search(head)
+    if not match:
+        return None
+    first_col, first_row, last_col, last_row = match.groups()
+    last_col = last_col or first_col or 'A'
+    last_row = last_row or first_row or '1'
+    return int(last_row), column_number(last_col.decode('ascii'))
+
+def inspect_upload(source, file_name):
+    """Проверка файла до разбора по метаданным, без построения DataFrame.
+
+    Для .xlsx читается центральный каталог zip (распакованные размеры и
+    степень сжатия частей) и элемент <dimension> каждого листа. Отклоняет
+    zip-бомбы и слишком широкие листы (UploadRejected); для листов длиннее
+    MAX_SHEET_ROWS возвращает предупреждения - лишние строки при чтении
+    отбрасываются.
+    """
+    if not file_name.endswith('.xlsx'):
+        return []
+
+    warnings = []
+    try:
+        with zipfile.ZipFile(excel_source(source)) as zip_file:
+            members = zip_file.infolist()
+            total_size = sum(info.file_size for info in members)
+            if total_size > MAX_UNCOMPRESSED_MB * 1024 * 1024:
+                raise UploadRejected(
+                    f"Файл слишком большой в распакованном виде ({total_size / 1024 / 1024:.0f} МБ)"
+                )
+            for info in members:
+                if info.compress_size and info.file_size > 1024 * 1024 and \
+                        info.file_size / info.compress_size > MAX_COMPRESSION_RATIO:
+                    raise UploadRejected("Файл подозрительно сильно сжат и не может быть обработан")
+
+            sheets = sorted(
+                (info.filename for info in members
+                 if info.filename.startswith('xl/worksheets/') and info.filename.endswith('.xml')),
+                key=lambda name: int(re.sub(r'\D', '', name) or 0)
+            )
+            for member in sheets:
+                dimension = sheet_dimension(zip_file, member)
+                if dimension is None:
+                    continue
+                rows, columns = dimension
+                sheet_label = member.rsplit('/', 1)[-1][:-4]
+                if columns > MAX_SHEET_COLUMNS:
+                    raise UploadRejected(
+                        f"Лист {sheet_label} содержит {columns} столбцов, максимум {MAX_SHEET_COLUMNS}"
+                    )
+                if rows > MAX_SHEET_ROWS + 1:
+                    warnings.append(
+                        f"Лист {sheet_label} содержит {rows} строк, будут прочитаны первые {MAX_SHEET_ROWS}"
+                    )
+    except zipfile.BadZipFile:
+        raise UploadRejected("Файл поврежден или не является книгой .xlsx")
+
+    return warnings
 
 # === ФУНКЦИИ АНАЛИЗА ДАННЫХ ===
 
-def read_excel_file(file_bytes, file_name):
-    """Читает Excel файл с поддержкой разных форматов"""
+@timed_stage('read_excel')
+def read_excel_file(source, file_name, sheet=0):
+    """Читает лист Excel файла (по умолчанию первый) с поддержкой разных форматов"""
+    if file_name.endswith('.xlsx') and source_size(source) >= EXCEL_STREAMING_THRESHOLD:
+        try:
+            return read_excel_streaming(source, sheet)
+        except Exception as e:
+            log_event('excel.streaming_failed', logging.WARNING, error=str(e))
+
     try:
         if file_name.endswith('.xls'):
-            return pd.read_excel(io.BytesIO(file_bytes), engine='xlrd')
+            return pd.read_excel(excel_source(source), sheet_name=sheet, engine='xlrd', nrows=MAX_SHEET_ROWS)
         else:
-            return pd.read_excel(io.BytesIO(file_bytes), engine='openpyxl')
+            return pd.read_excel(excel_source(source), sheet_name=sheet, engine='openpyxl', nrows=MAX_SHEET_ROWS)
     except Exception as e:
         try:
-            return pd.read_excel(io.BytesIO(file_bytes))
+            return pd.read_excel(excel_source(source), sheet_name=sheet, nrows=MAX_SHEET_ROWS)
         except Exception as e2:
             raise Exception(f"Не удалось прочитать файл: {str(e2)}")
 
+def list_excel_sheets(source, file_name):
+    """Возвращает названия листов с данными (листы-диаграммы пропускаются)"""
+    try:
+        if file_name.endswith('.xlsx'):
+            workbook = openpyxl.load_workbook(excel_source(source), read_only=True)
+            try:
+                return [sheet.title for sheet in workbook.worksheets]
+            finally:
+                workbook.close()
+        return pd.ExcelFile(excel_source(source)).sheet_names
+    except Exception as e:
+        raise Exception(f"Не удалось прочитать файл: {str(e)}")
+
+def excel_header_names(header_cells):
+    """Имена столбцов по строке заголовка так же, как их дает pandas.read_excel"""
+    names = []
+    seen = {}
+    for idx, cell in enumerate(header_cells):
+        name = f"Unnamed: {idx}" if cell is None else cell
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        names.append(name)
+    return names
+
+PAGE_SIZE_MB = os.sysconf('SC_PAGE_SIZE') / 1024 / 1024 if hasattr(os, 'sysconf') else None
+
+def rss_memory_mb():
+    """Текущий RSS процесса, МБ (None, если /proc недоступен)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * PAGE_SIZE_MB
+    except (OSError, ValueError, IndexError, TypeError):
+        return None
+
+def peak_memory_mb():
+    """Пиковое потребление памяти процессом за все время его работы, МБ (None, если недоступно).
+
+    Воркер пула переиспользуется, поэтому это пик по всем разобранным им
+    файлам, а не по одному файлу.
+    """
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def memory_delta(before, after):
+    return round(after - before, 1) if before is not None and after is not None else None
+
+def read_excel_streaming(source, sheet=0):
+    """Потоково читает лист .xlsx (по номеру) в режиме read-only.
+
+    Сначала читается только строка заголовка и по ней определяются периоды;
+    затем строки проходятся по одной, и в DataFrame попадают лишь столбец
+    наименований и столбцы периодов. Остальные ячейки в память не попадают.
+    """
+    started_at = time.perf_counter()
+    rss_before, peak_before = rss_memory_mb(), peak_memory_mb()
+    workbook = openpyxl.load_workbook(excel_source(source), read_only=True, data_only=True)
+    try:
+        # Строк сверх предела не читаем, даже если <dimension> их не указал
+        rows = workbook.worksheets[sheet].iter_rows(max_row=MAX_SHEET_ROWS + 1, values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return pd.DataFrame()
+
+        columns = excel_header_names(header)
+        period_columns = {period['column'] for period in detect_periods(pd.DataFrame(columns=columns))}
+        indicator_column = find_indicator_column(columns)
+        if not period_columns:
+            return pd.DataFrame(columns=columns)
+
+        keep = [idx for idx, col in enumerate(columns) if col == indicator_column or col in period_columns]
+        data = [[row[idx] if idx < len(row) else None for idx in keep] for row in rows]
+    finally:
+        workbook.close()
+
+    df = pd.DataFrame(data, columns=[columns[idx] for idx in keep])
+    # Память считается по этому файлу: прирост RSS за чтение и насколько чтение
+    # подняло пик процесса (0, если пик был достигнут раньше другим файлом)
+    log_event(
+        'excel.streaming_read', rows=len(df), columns_kept=len(keep), columns=len(columns),
+        duration_ms=round((time.perf_counter() - started_at) * 1000, 1),
+        rss_delta_mb=memory_delta(rss_before, rss_memory_mb()),
+        peak_rss_growth_mb=memory_delta(peak_before, peak_memory_mb())
+    )
+    return df
+
+def parse_excel_sheet(source, file_name, sheet=0, sheet_name=None):
+    """Разбирает один лист: чтение, периоды, данные и тип листа (выполняется в пуле)"""
+    df = read_excel_file(source, file_name, sheet)
+
+    periods = detect_periods(df)
+    periods_data = extract_financial_data_by_period(df, periods) if periods else {}
+
+    return {
+        'sheet': sheet_name or str(sheet),
+        'kind': classify_sheet(sheet_name or '', periods_data),
+        'periods': periods,
+        'periods_data': periods_data
+    }
+
+def classify_sheet(sheet_name, periods_data):
+    """Определяет тип листа: баланс (форма 1), ОФР (форма 2), смешанный или пропускаемый"""
+    items = {item for data in periods_data.values() for item in data}
+    if not items:
+        return 'ignored'
+
+    balance_count = len(items - PNL_ITEMS)
+    pnl_count = len(items & PNL_ITEMS)
+
+    # При равенстве подсказывает название листа
+    name = sheet_name.lower()
+    if 'баланс' in name or 'форма 1' in name or 'форма №1' in name:
+        balance_count += 1
+    if 'результат' in name or 'форма 2' in name or 'форма №2' in name or 'офр' in name:
+        pnl_count += 1
+
+    if balance_count > pnl_count:
+        return 'balance'
+    if pnl_count > balance_count:
+        return 'pnl'
+    return 'mixed'
+
+def merge_sheet_results(sheet_results):
+    """Объединяет данные листов в один periods_data по периодам.
+
+    Периоды разных листов сопоставляются по дате ("за 2023" на листе ОФР и
+    "31.12.2023" в балансе - один период), название берется с листа баланса.
+    Значение статьи с листа своего типа (баланс - для статей баланса, ОФР - для
+    статей ОФР) имеет приоритет; с остальных листов значения лишь дополняют
+    недостающие статьи. Единственный полезный лист возвращается как есть.
+    """
+    kind_order = {'balance': 0, 'mixed': 1, 'pnl': 2}
+    useful = sorted(
+        (result for result in sheet_results if result['kind'] != 'ignored'),
+        key=lambda result: kind_order[result['kind']]
+    )
+    if not useful:
+        return [], {}
+    if len(useful) == 1:
+        return useful[0]['periods'], useful[0]['periods_data']
+
+    periods_by_date = {}
+    for result in useful:
+        for period in result['periods']:
+            periods_by_date.setdefault(period['date'], period)
+    periods = sorted(periods_by_date.values(), key=lambda x: x['date'])
+
+    periods_data = {period['formatted']: {} for period in periods}
+    for result in useful:
+        for period in result['periods']:
+            target = periods_data[periods_by_date[period['date']]['formatted']]
+            for item, value in result['periods_data'].get(period['formatted'], {}).items():
+                item_kind = 'pnl' if item in PNL_ITEMS else 'balance'
+                if item not in target or result['kind'] == item_kind:
+                    target[item] = value
+
+    return periods, periods_data
+
+def build_workbook_snapshot(sheet_results):
+    """Объединяет листы и рассчитывает коэффициенты: (periods, periods_data, periods_ratios)"""
+    periods, periods_data = merge_sheet_results(sheet_results)
+    periods_data = PeriodsFrame.from_mapping(periods_data)
+    return periods, periods_data, calculate_periods_ratios(periods_data)
+
+def parse_financial_file(source, file_name):
+    """Полный разбор файла всеми листами последовательно, в одном процессе"""
+    sheets = list_excel_sheets(source, file_name)
+    return build_workbook_snapshot([
+        parse_excel_sheet(source, file_name, idx, name) for idx, name in enumerate(sheets)
+    ])
+
+async def parse_workbook_in_pool(source, file_name, update=None):
+    """Разбирает листы книги параллельно в пуле вычислений и объединяет результат.
+
+    Время разбора многолистовой книги близко ко времени самого большого листа.
+    Исключения пула (AnalysisQueueFull, asyncio.TimeoutError) пробрасываются.
+    """
+    sheets = await run_in_analysis_pool(list_excel_sheets, source, file_name, update=update)
+    sheet_results = await asyncio.gather(*(
+        run_in_analysis_pool(parse_excel_sheet, source, file_name, idx, name)
+        for idx, name in enumerate(sheets)
+    ))
+
+    # Объединение и расчет коэффициентов - легкие операции над готовыми словарями
+    return build_workbook_snapshot(sheet_results)
+
+# Единый шаблон заголовка периода: полные даты, "на DD.MM", "за YYYY", кварталы и год
+PERIOD_PATTERN = re.compile(r"""
+    (?P<dmy>(?P<dmy_day>\d{2})[./-](?P<dmy_month>\d{2})[./-](?P<dmy_year>\d{4}))
+  | (?P<ymd>(?P<ymd_year>\d{4})[./-](?P<ymd_month>\d{2})[./-](?P<ymd_day>\d{2}))
+  | (?P<on_date>на\s+(?P<on_day>\d{2})\.(?P<on_month>\d{2})(?![./-]\d{4}))  # не начало полной даты
+  | (?P<for_year>за\s+(?P<for_year_value>\d{4}))
+  | (?P<quarter>(?P<quarter_num>[1-4])\s*(?:-?й\s+)?квартал)
+  | (?P<year>\b(?:19|20)\d{2}\b)
+""", re.VERBOSE)
+
+QUARTER_END = {1: (3, 31), 2: (6, 30), 3: (9, 30), 4: (12, 31)}
+
+@functools.lru_cache(maxsize=4096)
+def parse_period_header(header):
+    """Разбирает заголовок столбца за один проход шаблона.
+
+    Возвращает кортеж (дата, найденный текст, отображаемое название) или None.
+    Полная дата важнее "на DD.MM" и квартала, те - важнее "за YYYY". Год для
+    "на DD.MM" и квартала берется из того же заголовка, а при его отсутствии -
+    текущий.
+    """
+    full_date = None
+    partial = None
+    for_year = None
+    year = None
+
+    for match in PERIOD_PATTERN.finditer(header):
+        kind = match.lastgroup
+        if kind in ('dmy', 'ymd'):
+            try:
+                date_obj = datetime(int(match[f'{kind}_year']), int(match[f'{kind}_month']), int(match[f'{kind}_day']))
+            except ValueError:
+                continue
+            full_date = (date_obj, match[0], date_obj.strftime('%d.%m.%Y'))
+            break
+        elif kind in ('on_date', 'quarter') and partial is None:
+            partial = match
+        elif kind == 'for_year' and for_year is None:
+            for_year = int(match['for_year_value'])
+        elif kind == 'year' and year is None:
+            year = int(match[0])
+
+    if full_date:
+        return full_date
+
+    if partial is not None:
+        year = year or for_year or datetime.now().year
+        try:
+            if partial.lastgroup == 'quarter':
+                quarter = int(partial['quarter_num'])
+                month, day = QUARTER_END[quarter]
+                return datetime(year, month, day), partial[0], f"Q{quarter}.{year}"
+            date_obj = datetime(year, int(partial['on_month']), int(partial['on_day']))
+            return date_obj, partial[0], date_obj.strftime('%d.%m.%Y')
+        except ValueError:
+            return None
+
+    if for_year is not None:
+        return datetime(for_year, 12, 31), f"за {for_year}", str(for_year)
+
+    return None
+
+@timed_stage('detect_periods')
 def detect_periods(df):
     """Определяет периоды в столбцах DataFrame с правильной сортировкой"""
     periods = []
-    
+
     for col in df.columns:
-        col_str = str(col).lower().strip()
-        
-        # Поиск дат в различных форматах
-        date_patterns = [
-            r'\d{2}.\d{2}.\d{4}',  # 31.12.2023
-            r'\d{4}-\d{2}-\d{2}',   # 2023-12-31
-            r'\d{2}/\d{2}/\d{4}',   # 31/12/2023
-            r'\d{4}.\d{2}.\d{2}',   # 2023.12.31
-        ]
-        
-        for pattern in date_patterns:
-            matches = re.findall(pattern, col_str)
-            if matches:
-                try:
-                    date_str = matches[0]
-                    # Приводим к стандартному формату
-                    if '.' in date_str and len(date_str.split('.')[0]) == 2:
-                        date_obj = datetime.strptime(date_str, '%d.%m.%Y')
-                    elif '-' in date_str:
-                        date_obj = datetime.strptime(date_str, '%Y-%m-%d')
-                    elif '/' in date_str:
-                        date_obj = datetime.strptime(date_str, '%d/%m/%Y')
-                    else:
-                        date_obj = datetime.strptime(date_str, '%Y.%m.%d')
-                    
-                    periods.append({
-                        'column': col,
-                        'date': date_obj,
-                        'date_str': date_str,
-                        'formatted': date_obj.strftime('%d.%m.%Y'),
-                        'year': date_obj.year
-                    })
-                    break
-                except:
-                    continue
-        
-        # Поиск периодов в текстовом формате
-        period_keywords = {
-            'на 31.12': '31.12',
-            'на 31.03': '31.03', 
-            'на 30.06': '30.06',
-            'на 30.09': '30.09',
-            'за 2024': '2024',
-            'за 2023': '2023',
-            'за 2022': '2022',
-            '1 квартал': 'Q1',
-            '2 квартал': 'Q2',
-            '3 квартал': 'Q3',
-            '4 квартал': 'Q4'
-        }
-        
-        for keyword, period in period_keywords.items():
-            if keyword in col_str:
-                year = 2024 if '2024' in col_str else 2023 if '2023' in col_str else 2022
-                periods.append({
-                    'column': col,
-                    'date': datetime(year, 12, 31),
-                    'date_str': period,
-                    'formatted': f"{period}.{year}",
-                    'year': year
-                })
-                break
-    
-    # Сортируем периоды по году (от старых к новым)
-    periods.sort(key=lambda x: x['year'])
-    
+        if isinstance(col, datetime):
+            # Заголовок уже прочитан как дата (ячейка формата "Дата" в Excel)
+            date_obj = datetime(col.year, col.month, col.day)
+            parsed = (date_obj, date_obj.strftime('%d.%m.%Y'), date_obj.strftime('%d.%m.%Y'))
+        else:
+            parsed = parse_period_header(str(col).lower().strip())
+
+        if parsed:
+            date_obj, date_str, formatted = parsed
+            periods.append({
+                'column': col,
+                'date': date_obj,
+                'date_str': date_str,
+                'formatted': formatted,
+                'year': date_obj.year
+            })
+
+    # Сортируем периоды по дате (от старых к новым)
+    periods.sort(key=lambda x: x['date'])
+
     return periods
 
+class KeywordMatcher:
+    """Автомат Ахо-Корасик по ключевым словам статей баланса.
+
+    За один проход по строке находит все вхождения ключевых слов и
+    возвращает статью с наименьшим порядковым номером в словаре - тот же
+    результат, что и последовательный перебор статей и ключевых слов.
+    """
+
+    def __init__(self, items):
+        self.items = list(items)
+        no_match = len(self.items)
+
+        goto = [{}]
+        best = [no_match]  # лучший (минимальный) номер статьи, оканчивающейся в узле
+        for priority, keywords in enumerate(items.values()):
+            for keyword in keywords:
+                node = 0
+                for char in keyword:
+                    if char not in goto[node]:
+                        goto.append({})
+                        best.append(no_match)
+                        goto[node][char] = len(goto) - 1
+                    node = goto[node][char]
+                best[node] = min(best[node], priority)
+
+        # Обходом в ширину достраиваем переходы по суффиксным ссылкам до полного автомата,
+        # чтобы при сканировании не откатываться по ссылкам
+        fail = [0] * len(goto)
+        transitions = [dict(goto[0])] + [None] * (len(goto) - 1)
+        queue = collections.deque(goto[0].values())
+        while queue:
+            node = queue.popleft()
+            best[node] = min(best[node], best[fail[node]])
+            transitions[node] = dict(transitions[fail[node]])
+            for char, child in goto[node].items():
+                fail[child] = transitions[fail[node]].get(char, 0) if node else 0
+                transitions[node][char] = child
+                queue.append(child)
+
+        self.transitions = transitions
+        self.best = best
+        self.no_match = no_match
+
+    def match(self, text):
+        """Возвращает статью с наивысшим приоритетом среди найденных в тексте или None"""
+        transitions, best = self.transitions, self.best
+        node = 0
+        result = self.no_match
+        for char in text:
+            node = transitions[node].get(char, 0)
+            if best[node] < result:
+                result = best[node]
+                if result == 0:
+                    break
+        return None if result == self.no_match else self.items[result]
+
+BALANCE_MATCHER = KeywordMatcher(BALANCE_ITEMS)
+
 def find_balance_item(column_name, df_columns):
     """Находит соответствие столбца статьям баланса"""
-    column_name = str(column_name).lower().strip()
-    
+    return classify_balance_item(str(column_name))
+
+@functools.lru_cache(maxsize=4096)
+def classify_balance_item(column_name):
+    """Классифицирует название строки (результат кэшируется для повторяющихся названий)"""
+    column_name = column_name.lower().strip()
+
     # Убираем римские цифры и точки в начале
     cleaned_name = re.sub(r'^[ivx]+\.?\s*', '', column_name).strip()
-    
-    for item, keywords in BALANCE_ITEMS.items():
-        for keyword in keywords:
-            if keyword in cleaned_name:
-                return item
-    
+
+    item = BALANCE_MATCHER.match(cleaned_name)
+    if item:
+        return item
+
     # Дополнительные проверки для сложных случаев
     if 'внеоборотные активы' in column_name:
         return 'внеоборотные активы'
@@ -485,618 +2212,769 @@ def find_balance_item(column_name, df_columns):
     
     return None
 
+def find_indicator_column(columns):
+    """Находит столбец с наименованиями показателей"""
+    for col in columns:
+        if 'наименование' in str(col).lower() or 'показатель' in str(col).lower():
+            return col
+    return None
+
+@timed_stage('extract')
 def extract_financial_data_by_period(df, periods):
     """Извлекает финансовые данные по периодам для структуры с столбцом наименований"""
     financial_data = {}
-    
-    print(f"🔍 Анализирую {len(periods)} периодов:")
+    started_at = time.perf_counter()
     
     # Инициализируем данные для каждого периода
     for period in periods:
         financial_data[period['formatted']] = {}
     
     # Ищем столбец с наименованиями показателей
-    indicator_column = None
-    for col in df.columns:
-        if 'наименование' in str(col).lower() or 'показатель' in str(col).lower():
-            indicator_column = col
-            break
+    indicator_column = find_indicator_column(df.columns)
     
     if not indicator_column:
-        print("❌ Не найден столбец с наименованиями показателей")
+        log_event('extract.no_indicator_column', logging.WARNING, periods=len(periods), columns=len(df.columns))
         return financial_data
-    
-    print(f"📋 Столбец с показателями: '{indicator_column}'")
-    
-    # Проходим по всем строкам и извлекаем данные
-    for row_idx in range(len(df)):
-        indicator_name = str(df[indicator_column].iloc[row_idx]).strip()
-        
-        # Пропускаем пустые строки и заголовки
-        if not indicator_name or indicator_name in ['Актив', 'Пассив', 'Наименование показателя']:
-            continue
-        
-        # Определяем тип показателя
-        item = find_balance_item(indicator_name, [indicator_name])
-        
-        if item:
-            print(f"   📊 Найден показатель: '{indicator_name}' → {item}")
-            
-            # Извлекаем значения для каждого периода
-            for period in periods:
-                period_key = period['formatted']
-                col_name = period['column']
-                
-                try:
-                    value = pd.to_numeric(df[col_name].iloc[row_idx], errors='coerce')
-                    if not pd.isna(value) and value != 0:
-                        financial_data[period_key][item] = value
-                        print(f"      {period_key}: {value:,.0f}")
-                except Exception as e:
-                    print(f"      Ошибка извлечения для {period_key}: {e}")
-    
+
+    # 1. Классифицируем столбец наименований целиком: каждое уникальное название - один раз
+    names = df[indicator_column].astype(str).str.strip()
+    skip_names = {'', 'Актив', 'Пассив', 'Наименование показателя'}
+    items_by_name = {
+        name: (None if name in skip_names else find_balance_item(name, [name]))
+        for name in names.unique()
+    }
+    items = names.map(items_by_name)
+    matched_rows = items.notna().to_numpy()
+
+    if not matched_rows.any():
+        log_event('extract.summary', periods=len(periods), rows=len(df), matched_rows=0, values=0,
+                  indicator_column=indicator_column)
+        return financial_data
+
+    # Построчная детализация - только на уровне DEBUG и с выборкой
+    if logger.isEnabledFor(logging.DEBUG):
+        for row, name, item in zip(np.flatnonzero(matched_rows), names[matched_rows], items[matched_rows]):
+            log_event('extract.row', logging.DEBUG, sample_rate=LOG_SAMPLE_RATE, row=int(row), name=name, item=item)
+
+    # 2. Приводим все столбцы периодов к числам одной операцией
+    values = df.iloc[matched_rows, [df.columns.get_loc(period['column']) for period in periods]]
+    values = values.apply(pd.to_numeric, errors='coerce')
+    values.columns = [period['formatted'] for period in periods]
+    values['item'] = items[matched_rows].to_numpy()
+
+    # 3. Длинный формат (строка, период) в порядке обхода строк; последнее ненулевое значение побеждает
+    long_values = values.melt(id_vars='item', var_name='period', value_name='value', ignore_index=False)
+    long_values = long_values[long_values['value'].notna() & (long_values['value'] != 0)]
+    long_values = long_values.sort_index(kind='stable')
+
+    grouped = long_values.groupby(['period', 'item'], sort=False)['value'].last()
+    for (period_key, item), value in grouped.items():
+        financial_data[period_key][item] = value
+
+    log_event(
+        'extract.summary', periods=len(periods), rows=len(df), matched_rows=int(matched_rows.sum()),
+        values=len(grouped), indicator_column=indicator_column,
+        duration_ms=round((time.perf_counter() - started_at) * 1000, 1)
+    )
+
     return financial_data
 
-def calculate_financial_ratios_for_period(data):
-    """Рассчитывает финансовые коэффициенты для одного периода"""
-    ratios = {}
-    
-    try:
-        # Извлекаем данные
-        assets = data.get('активы всего', 0)
-        current_assets = data.get('оборотные активы', 0)
-        cash = data.get('денежные средства', 0)
-        receivables = data.get('дебиторская задолженность', 0)
-        inventory = data.get('запасы', 0)
-        
-        # Если нет оборотных активов, но есть их компоненты - рассчитываем
-        if current_assets == 0:
-            current_assets = cash + receivables + inventory
-        
-        equity = data.get('капитал', 0)
-        current_liabilities = data.get('краткосрочные обязательства', 0)
-        total_liabilities = data.get('обязательства всего', 0)
-        
-        revenue = data.get('выручка', 0)
-        net_profit = data.get('чистая прибыль', 0)
-        gross_profit = data.get('валовая прибыль', 0)
-        
+# Статьи, участвующие в расчете коэффициентов (строки матрицы статьи × периоды)
+RATIO_INPUT_ITEMS = [
+    'активы всего', 'оборотные активы', 'денежные средства', 'дебиторская задолженность', 'запасы',
+    'капитал', 'краткосрочные обязательства', 'обязательства всего',
+    'выручка', 'чистая прибыль', 'валовая прибыль'
+]
+
+def build_items_matrix(periods_data, items):
+    """Строит матрицу статьи × периоды; отсутствующие статьи дают 0, как data.get(item, 0)"""
+    if isinstance(periods_data, PeriodsFrame):
+        return periods_data.rows(items)
+    return np.fromiter(
+        (data.get(item, 0) for item in items for data in periods_data.values()),
+        dtype=np.float64,
+        count=len(items) * len(periods_data)
+    ).reshape(len(items), len(periods_data))
+
+def calculate_ratios_matrix(periods_data):
+    """Рассчитывает все коэффициенты сразу для всех периодов.
+
+    Возвращает (названия коэффициентов, матрица коэффициенты × периоды). Условия
+    расчета те же, что были у расчета по одному периоду: если знаменатель (или
+    другое условие) не положителен, в ячейке NaN.
+    """
+    (assets, current_assets, cash, receivables, inventory,
+     equity, current_liabilities, total_liabilities,
+     revenue, net_profit, gross_profit) = build_items_matrix(periods_data, RATIO_INPUT_ITEMS)
+
+    # Если нет оборотных активов, но есть их компоненты - рассчитываем
+    current_assets = np.where(current_assets == 0, cash + receivables + inventory, current_assets)
+    quick_assets = cash + receivables
+
+    has_liabilities = current_liabilities > 0
+    has_assets = assets > 0
+    has_equity = equity > 0
+    has_revenue = revenue > 0
+
+    # (коэффициент, числитель, знаменатель, условие расчета, множитель)
+    definitions = [
         # 1. КОЭФФИЦИЕНТЫ ЛИКВИДНОСТИ
-        if current_liabilities > 0:
-            ratios['Коэффициент текущей ликвидности'] = current_assets / current_liabilities
-            ratios['Коэффициент абсолютной ликвидности'] = cash / current_liabilities
-            if cash + receivables > 0:
-                ratios['Коэффициент срочной ликвидности'] = (cash + receivables) / current_liabilities
-        
+        ('Коэффициент текущей ликвидности', current_assets, current_liabilities, has_liabilities, 1),
+        ('Коэффициент абсолютной ликвидности', cash, current_liabilities, has_liabilities, 1),
+        ('Коэффициент срочной ликвидности', quick_assets, current_liabilities, has_liabilities & (quick_assets > 0), 1),
         # 2. РЕНТАБЕЛЬНОСТЬ
-        if assets > 0:
-            ratios['Рентабельность активов (ROA)'] = (net_profit / assets) * 100
-        if equity > 0:
-            ratios['Рентабельность капитала (ROE)'] = (net_profit / equity) * 100
-        if revenue > 0:
-            ratios['Рентабельность продаж (ROS)'] = (net_profit / revenue) * 100
-            if gross_profit > 0:
-                ratios['Валовая рентабельность'] = (gross_profit / revenue) * 100
-        
+        ('Рентабельность активов (ROA)', net_profit, assets, has_assets, 100),
+        ('Рентабельность капитала (ROE)', net_profit, equity, has_equity, 100),
+        ('Рентабельность продаж (ROS)', net_profit, revenue, has_revenue, 100),
+        ('Валовая рентабельность', gross_profit, revenue, has_revenue & (gross_profit > 0), 100),
         # 3. ФИНАНСОВАЯ УСТОЙЧИВОСТЬ
-        if assets > 0:
-            ratios['Коэффициент автономии'] = equity / assets
-            if equity > 0:
-                ratios['Коэффициент финансового левериджа'] = total_liabilities / equity
-        
+        ('Коэффициент автономии', equity, assets, has_assets, 1),
+        ('Коэффициент финансового левериджа', total_liabilities, equity, has_assets & has_equity, 1),
         # 4. ДЕЛОВАЯ АКТИВНОСТЬ
-        if assets > 0:
-            ratios['Оборачиваемость активов'] = revenue / assets
-        
+        ('Оборачиваемость активов', revenue, assets, has_assets, 1),
+    ]
+    names, numerators, denominators, conditions, multipliers = zip(*definitions)
+
+    ratios = np.full((len(names), len(periods_data)), np.nan)
+    np.divide(np.stack(numerators), np.stack(denominators), out=ratios, where=np.stack(conditions))
+    ratios *= np.array(multipliers, dtype=np.float64)[:, np.newaxis]
+
+    return list(names), ratios
+
+@timed_stage('ratios')
+def calculate_periods_ratios(periods_data):
+    """Рассчитывает коэффициенты для всех непустых периодов: PeriodsFrame коэффициенты × периоды"""
+    if isinstance(periods_data, PeriodsFrame):
+        periods_data = periods_data.nonempty()
+    else:
+        periods_data = {period: data for period, data in periods_data.items() if data}
+    if not periods_data:
+        return {}
+
+    try:
+        names, ratios = calculate_ratios_matrix(periods_data)
     except Exception as e:
-        print(f"   ❌ Ошибка расчета коэффициентов: {e}")
-    
-    return ratios
+        log_event('ratios.failed', logging.ERROR, periods=len(periods_data), error=str(e))
+        return {period: {} for period in periods_data}
 
-# === ФУНКЦИИ ГЕНЕРАЦИИ ОТЧЕТОВ ===
+    # NaN в матрице - коэффициент не рассчитан
+    return PeriodsFrame(periods_data, names, ratios)
 
-def generate_period_analysis_report(periods_data):
-    """Генерирует расширенный отчет анализа по периодам"""
-    if not periods_data or all(len(data) == 0 for data in periods_data.values()):
-        return "❌ Не удалось извлечь данные по периодам."
-    
-    # Рассчитываем коэффициенты для каждого периода
-    periods_ratios = {}
-    for period, data in periods_data.items():
-        if data:
-            periods_ratios[period] = calculate_financial_ratios_for_period(data)
-    
-    report = "📊 **ФИНАНСОВЫЙ АНАЛИЗ ПО ПЕРИОДАМ**\n\n"
-    
-    # Основные показатели по периодам
-    report += "💰 **ДИНАМИКА ОСНОВНЫХ ПОКАЗАТЕЛЕЙ:**\n\n"
-    
-    key_indicators = ['выручка', 'чистая прибыль', 'активы всего', 'капитал', 'оборотные активы', 'краткосрочные обязательства']
-    
-    for indicator in key_indicators:
-        values = []
-        for period, data in periods_data.items():
-            if data and indicator in data:
-                values.append((period, data[indicator]))
-        
-        if values:
-            report += f"📈 **{indicator.title()}:**\n"
-            for period, value in values:
-                report += f"• {period}: {value:,.0f} руб.\n"
-            
-            # Анализ динамики
+def calculate_financial_ratios_for_period(data):
+    """Рассчитывает финансовые коэффициенты для одного периода"""
+    ratios = calculate_periods_ratios({'period': data}).get('period', {})
+    return ratios.to_dict() if isinstance(ratios, PeriodColumn) else ratios
+
+def get_periods_ratios(context):
+    """Возвращает коэффициенты из снимка анализа пользователя, рассчитывая их при отсутствии"""
+    if 'periods_ratios' not in context.user_data:
+        context.user_data['periods_ratios'] = calculate_periods_ratios(context.user_data['periods_data'])
+    return context.user_data['periods_ratios']
+
+# === ДОБАВЛЕНИЕ ПЕРИОДОВ ===
+
+# Подписи к файлу, включающие режим добавления (как и команда /append)
+APPEND_CAPTIONS = ('/append', 'append', 'добавить')
+
+# Статьи, от которых зависит отчет каждого вида, и зависит ли он от последнего
+# периода (рекомендации, сравнение с нормативами). Отчет выборочного анализа
+# зависит только от статей выбранных групп.
+RATIO_REPORT_ITEMS = frozenset(RATIO_INPUT_ITEMS)
+REPORT_DEPENDENCIES = {
+    'full': (RATIO_REPORT_ITEMS | {'выручка', 'чистая прибыль', 'активы всего', 'капитал',
+                                   'оборотные активы', 'краткосрочные обязательства'}, True),
+    'liquidity': (RATIO_REPORT_ITEMS, True),
+    'profitability': (RATIO_REPORT_ITEMS, True),
+    'stability': (RATIO_REPORT_ITEMS, True),
+    'forecast': (RATIO_REPORT_ITEMS | {'выручка', 'чистая прибыль', 'активы всего', 'капитал'}, True),
+    'industry': (RATIO_REPORT_ITEMS, True),
+}
+
+def period_date(period):
+    """Дата периода по отображаемому названию (dd.mm.yyyy, Qn.yyyy, yyyy) или None"""
+    match = re.fullmatch(r'Q([1-4])\.(\d{4})', period)
+    if match:
+        month, day = QUARTER_END[int(match[1])]
+        return datetime(int(match[2]), month, day)
+    if re.fullmatch(r'\d{4}', period):
+        return datetime(int(period), 12, 31)
+    parsed = parse_period_header(period.lower())
+    return parsed[0] if parsed else None
+
+def merge_appended_periods(periods_data, periods_ratios, new_periods_data):
+    """Добавляет периоды новой книги к данным пользователя.
+
+    Исходные словари не изменяются: они могут быть общими с кэшем разобранных
+    файлов. Период, который уже есть в данных, дополняется статьями новой
+    книги (ее значения важнее). Коэффициенты пересчитываются только для
+    затронутых периодов, остальные берутся из снимка.
+    Возвращает (periods_data, periods_ratios, затронутые периоды).
+    """
+    affected = [period for period, data in new_periods_data.items() if data]
+    merged = dict(periods_data)
+    for period in affected:
+        merged[period] = {**periods_data.get(period, {}), **new_periods_data[period]}
+
+    # Периоды - от старых к новым, как после detect_periods
+    dates = {period: period_date(period) for period in merged}
+    if all(dates.values()):
+        merged = dict(sorted(merged.items(), key=lambda item: dates[item[0]]))
+
+    new_ratios = calculate_periods_ratios({period: merged[period] for period in affected})
+    merged_ratios = {}
+    for period in merged:
+        if period in new_ratios:
+            merged_ratios[period] = new_ratios[period]
+        elif period in periods_ratios:
+            merged_ratios[period] = periods_ratios[period]
+    return PeriodsFrame.from_mapping(merged), PeriodsFrame.from_mapping(merged_ratios), affected
+
+def appended_dataset_key(dataset_key, file_hash):
+    """Ключ набора данных после добавления: хэш прежнего ключа и хэша нового файла"""
+    return hashlib.sha256(f"{dataset_key}:{file_hash}".encode('ascii')).hexdigest()
+
+def report_dependencies(cache_key):
+    """(статьи, зависит ли от последнего периода) для ключа кэша отчета"""
+    analysis_type = cache_key[1]
+    if analysis_type == 'selective':
+        return {item for group in cache_key[2] for item in INDICATOR_GROUPS.get(group, [])}, False
+    # Неизвестный вид отчета считаем зависящим от всего
+    return REPORT_DEPENDENCIES.get(analysis_type, (None, True))
+
+def carry_over_reports(old_key, new_key, affected_items, last_period_changed):
+    """Копирует под новый ключ набора данных готовые отчеты, которых добавление не коснулось"""
+    carried = 0
+    for key, report in REPORT_CACHE.items():
+        if key[0] != old_key:
+            continue
+        items, uses_last_period = report_dependencies(key)
+        if items is None or (uses_last_period and last_period_changed) or items & affected_items:
+            continue
+        REPORT_CACHE.put((new_key,) + key[1:], report)
+        carried += 1
+    return carried
+
+# === ШАБЛОНЫ ОТЧЕТОВ ===
+# Отчеты описываются декларативно: список секций (показатели, коэффициенты,
+# пороги оценок, тренды). Каждая секция один раз компилируется в функцию
+# render(ctx, out), которая дописывает строки в общий список out.
+
+class ReportContext:
+    """Данные одного отчета; ряды значений собираются один раз на все секции"""
+
+    def __init__(self, periods_data, periods_ratios=None):
+        self.periods_data = periods_data
+        self._periods_ratios = periods_ratios
+        self._item_series = {}
+        self._ratio_series = {}
+
+    @property
+    def periods_ratios(self):
+        if self._periods_ratios is None:
+            self._periods_ratios = calculate_periods_ratios(self.periods_data)
+        return self._periods_ratios
+
+    def item_series(self, indicator):
+        """[(период, значение)] статьи по периодам, где она есть"""
+        series = self._item_series.get(indicator)
+        if series is None and isinstance(self.periods_data, PeriodsFrame):
+            series = self._item_series[indicator] = self.periods_data.row_series(indicator)
+        elif series is None:
+            series = self._item_series[indicator] = [
+                (period, data[indicator]) for period, data in self.periods_data.items()
+                if data and indicator in data
+            ]
+        return series
+
+    def ratio_series(self, ratio_name):
+        """[(период, значение)] коэффициента по периодам, где он рассчитан"""
+        series = self._ratio_series.get(ratio_name)
+        if series is None and isinstance(self.periods_ratios, PeriodsFrame):
+            series = self._ratio_series[ratio_name] = self.periods_ratios.row_series(ratio_name)
+        elif series is None:
+            series = self._ratio_series[ratio_name] = [
+                (period, ratios[ratio_name]) for period, ratios in self.periods_ratios.items()
+                if ratio_name in ratios
+            ]
+        return series
+
+def compile_template(template, *fields):
+    """Шаблон в синтаксисе str.format -> функция (значения полей по порядку fields) -> строка.
+
+    Шаблон разбирается один раз, при компиляции: имена полей заменяются
+    номерами аргументов, и на каждой строке отчета остается только str.format.
+    """
+    parts = []
+    for literal, field, spec, conversion in string.Formatter().parse(template):
+        parts.append(literal.replace('{', '{{').replace('}', '}}'))
+        if field is None:
+            continue
+        if field not in fields or '{' in spec:
+            raise ValueError(f"Недопустимое поле шаблона {{{field}}}: ожидаются {', '.join(fields)}")
+        conversion = f"!{conversion}" if conversion else ''
+        spec = f":{spec}" if spec else ''
+        parts.append(f"{{{fields.index(field)}{conversion}{spec}}}")
+    return ''.join(parts).format
+
+VERDICT_OPERATORS = {'>=': operator.ge, '>': operator.gt, '<=': operator.le, '<': operator.lt}
+
+def compile_verdict(rules, default=None, op='>='):
+    """Пороги [(граница, текст)] -> функция value -> текст первого выполненного порога или default"""
+    compare = VERDICT_OPERATORS[op]
+    rules = tuple(rules)
+
+    def verdict(value):
+        for bound, text in rules:
+            if compare(value, bound):
+                return text
+        return default
+    return verdict
+
+def compile_trend(threshold, up, down):
+    """Функция change -> строка тренда, если изменение вышло за порог, иначе None"""
+    up = compile_template(up, 'change')
+    down = compile_template(down, 'change')
+
+    def trend(change):
+        if change > threshold:
+            return up(change)
+        if change < -threshold:
+            return down(change)
+        return None
+    return trend
+
+def compile_report(*sections):
+    """Собирает секции в функцию render(periods_data, periods_ratios=None) -> str"""
+    def render(periods_data, periods_ratios=None):
+        ctx = ReportContext(periods_data, periods_ratios)
+        out = []
+        for section in sections:
+            section(ctx, out)
+        return ''.join(out)
+    return render
+
+def text_section(text):
+    def render(ctx, out):
+        out.append(text)
+    return render
+
+def branch_section(condition, then, otherwise):
+    """Секции then или otherwise в зависимости от condition(ctx)"""
+    def render(ctx, out):
+        for section in (then if condition(ctx) else otherwise):
+            section(ctx, out)
+    return render
+
+def indicator_section(indicators, header, line, change):
+    """Значения статей по периодам и изменение от первого периода к последнему"""
+    compiled = [(indicator, header.format(name=indicator.title())) for indicator in indicators]
+    line = compile_template(line, 'period', 'value')
+    change = compile_template(change, 'trend', 'change_abs', 'change_rel')
+
+    def render(ctx, out):
+        for indicator, title in compiled:
+            values = ctx.item_series(indicator)
+            if not values:
+                continue
+            out.append(title)
+            out.extend([line(period, value) for period, value in values])
             if len(values) >= 2:
-                first_period, first_val = values[0]
-                last_period, last_val = values[-1]
-                change_abs = last_val - first_val
+                first_val = values[0][1]
+                last_val = values[-1][1]
                 change_rel = ((last_val - first_val) / first_val * 100) if first_val != 0 else 0
                 trend = "📈" if change_rel > 0 else "📉" if change_rel < 0 else "➡️"
-                report += f"  {trend} Изменение за период: {change_abs:+,.0f} руб. ({change_rel:+.1f}%)\n"
-            
-            report += "\n"
-    
-    # Анализ коэффициентов по периодам
-    if any(periods_ratios.values()):
-        report += "📊 **ДИНАМИКА ФИНАНСОВЫХ КОЭФФИЦИЕНТОВ:**\n\n"
-        
-        ratio_categories = {
-            '💧 **ЛИКВИДНОСТЬ:**': ['Коэффициент текущей ликвидности', 'Коэффициент абсолютной ликвидности'],
-            '🎯 **РЕНТАБЕЛЬНОСТЬ:**': ['Рентабельность активов (ROA)', 'Рентабельность капитала (ROE)', 'Рентабельность продаж (ROS)'],
-            '🏛️ **ФИНАНСОВАЯ УСТОЙЧИВОСТЬ:**': ['Коэффициент автономии', 'Коэффициент финансового левериджа'],
-            '📈 **ДЕЛОВАЯ АКТИВНОСТЬ:**': ['Оборачиваемость активов']
-        }
-        
-        for category, ratios_list in ratio_categories.items():
-            report += f"{category}\n"
-            
-            category_has_data = False
-            for ratio_name in ratios_list:
-                if any(ratio_name in ratios for ratios in periods_ratios.values()):
-                    category_has_data = True
-                    break
-            
-            if not category_has_data:
-                report += "• ❌ Недостаточно данных для расчета\n\n"
+                out.append(change(trend, last_val - first_val, change_rel))
+            out.append("\n")
+    return render
+
+def ratio_section(ratio_names, header, line, verdicts=None, trend=None, trends=None, trailer="\n"):
+    """Значения коэффициентов по периодам с оценкой каждого значения и трендом.
+
+    line - шаблон строки или функция имя -> шаблон; verdicts и trends -
+    {имя: compile_verdict/compile_trend}, trend - тренд для остальных имен.
+    """
+    verdicts = verdicts or {}
+    trends = trends or {}
+    compiled = [
+        (name, header.format(name=name),
+         compile_template(line(name) if callable(line) else line, 'period', 'value'),
+         verdicts.get(name), trends.get(name, trend))
+        for name in ratio_names
+    ]
+
+    def render(ctx, out):
+        for name, title, line_format, verdict, trend in compiled:
+            values = ctx.ratio_series(name)
+            if not values:
                 continue
-            
-            for ratio_name in ratios_list:
-                ratio_values = []
-                for period, ratios in periods_ratios.items():
-                    if ratio_name in ratios:
-                        ratio_values.append((period, ratios[ratio_name]))
-                
-                if ratio_values:
-                    report += f"• {ratio_name}:\n"
-                    for period, value in ratio_values:
-                        if 'рентабельность' in ratio_name.lower():
-                            report += f"  {period}: {value:.1f}%\n"
-                        else:
-                            report += f"  {period}: {value:.2f}\n"
-                    
-                       # Анализ тренда
-                    if len(ratio_values) >= 2:
-                        first_val = ratio_values[0][1]
-                        last_val = ratio_values[-1][1]
-                        change = last_val - first_val
-                        
-                        if 'ликвидности' in ratio_name:
-                            if change > 0.1:
-                                report += f"  📈 Улучшение +{change:.2f}\n"
-                            elif change < -0.1:
-                                report += f"  📉 Ухудшение {change:.2f}\n"
-                        
-                        elif 'рентабельность' in ratio_name.lower():
-                            if change > 1:
-                                report += f"  📈 Рост +{change:.1f}п.п.\n"
-                            elif change < -1:
-                                report += f"  📉 Спад {change:.1f}п.п.\n"
-            
-            report += "\n"
-    else:
-        report += "❌ **Не удалось рассчитать финансовые коэффициенты**\n\n"
-    
-    # Сводные выводы
-    report += "💡 **ОБЩИЕ ВЫВОДЫ:**\n\n"
-    
-    # Анализ динамики выручки
-    revenue_data = []
-    for period, data in periods_data.items():
-        if data and 'выручка' in data:
-            revenue_data.append(data['выручка'])
-    
-    if len(revenue_data) >= 2:
-        revenue_growth = ((revenue_data[-1] - revenue_data[0]) / revenue_data[0] * 100) if revenue_data[0] != 0 else 0
-        if revenue_growth > 15:
-            report += "• 🚀 Высокий рост выручки\n"
-        elif revenue_growth > 5:
-            report += "• 📈 Умеренный рост бизнеса\n"
-        elif revenue_growth > 0:
-            report += "• ⚠️ Незначительный рост\n"
-        else:
-            report += "• ❌ Снижение выручки\n"
-    
-    # Анализ рентабельности
-    last_period = list(periods_ratios.keys())[-1] if periods_ratios else None
-    if last_period and last_period in periods_ratios:
-        last_ratios = periods_ratios[last_period]
-        if 'Рентабельность активов (ROA)' in last_ratios:
-            roa = last_ratios['Рентабельность активов (ROA)']
-            if roa > 10:
-                report += "• 💎 Высокая рентабельность\n"
-            elif roa > 5:
-                report += "• ✅ Средняя рентабельность\n"
+            out.append(title)
+            if verdict is None:
+                out.extend([line_format(period, value) for period, value in values])
             else:
-                report += "• 🔴 Низкая рентабельность\n"
-    
-    # Рекомендации
-    report += "\n💡 **РЕКОМЕНДАЦИИ:**\n"
-    report += "• Регулярно отслеживайте динамику ключевых показателей\n"
-    report += "• Сравнивайте с отраслевыми нормативами\n"
-    report += "• Планируйте мероприятия по улучшению слабых показателей\n"
-    
-    return report
+                for period, value in values:
+                    out.append(line_format(period, value))
+                    text = verdict(value)
+                    if text:
+                        out.append(text)
+            if trend is not None and len(values) >= 2:
+                text = trend(values[-1][1] - values[0][1])
+                if text:
+                    out.append(text)
+            out.append(trailer)
+    return render
 
-def generate_liquidity_analysis_report(periods_data):
-    """Генерирует отчет по анализу ликвидности"""
-    report = "💧 **АНАЛИЗ ЛИКВИДНОСТИ**\n\n"
-    
-    periods_ratios = {}
-    for period, data in periods_data.items():
-        if data:
-            periods_ratios[period] = calculate_financial_ratios_for_period(data)
-    
-    # Анализ коэффициентов ликвидности
-    liquidity_ratios = ['Коэффициент текущей ликвидности', 'Коэффициент абсолютной ликвидности', 'Коэффициент срочной ликвидности']
-    
-    for ratio_name in liquidity_ratios:
-        ratio_values = []
-        for period, ratios in periods_ratios.items():
-            if ratio_name in ratios:
-                ratio_values.append((period, ratios[ratio_name]))
-        
-        if ratio_values:
-            report += f"**{ratio_name}:**\n"
-            for period, value in ratio_values:
-                report += f"• {period}: {value:.2f}\n"
-                
-                # Оценка значения
-                if ratio_name == 'Коэффициент текущей ликвидности':
-                    if value >= 2.0:
-                        report += "  ✅ Отличная ликвидность\n"
-                    elif value >= 1.5:
-                        report += "  ⚠️ Нормальная ликвидность\n"
-                    elif value >= 1.0:
-                        report += "  🟡 Пониженная ликвидность\n"
-                    else:
-                        report += "  ❌ Критическая ликвидность\n"
-                
-                elif ratio_name == 'Коэффициент абсолютной ликвидности':
-                    if value >= 0.2:
-                        report += "  ✅ Хорошая абсолютная ликвидность\n"
-                    else:
-                        report += "  ⚠️ Низкая абсолютная ликвидность\n"
-            
-            # Анализ тренда
-            if len(ratio_values) >= 2:
-                first_val = ratio_values[0][1]
-                last_val = ratio_values[-1][1]
-                change = last_val - first_val
-                if change > 0.1:
-                    report += f"  📈 Улучшение +{change:.2f}\n"
-                elif change < -0.1:
-                    report += f"  📉 Ухудшение {change:.2f}\n"
-            
-            report += "\n"
-    
-    # Рекомендации по ликвидности
-    report += "💡 **РЕКОМЕНДАЦИИ ПО ЛИКВИДНОСТИ:**\n"
-    last_period = list(periods_ratios.keys())[-1]
-    if last_period in periods_ratios:
-        last_ratios = periods_ratios[last_period]
-        if 'Коэффициент текущей ликвидности' in last_ratios:
-            cr = last_ratios['Коэффициент текущей ликвидности']
-            if cr < 1.5:
-                report += "• Увеличить объем оборотных активов\n"
-                report += "• Сократить краткосрочные обязательства\n"
-                report += "• Оптимизировать управление запасами\n"
-            else:
-                report += "• Ликвидность в норме, поддерживать текущий уровень\n"
-    
-    return report
+def ratio_category_section(title, ratio_names, **ratio_options):
+    """Группа коэффициентов под общим заголовком; без данных - одна строка"""
+    ratios = ratio_section(ratio_names, trailer="", **ratio_options)
+    title = f"{title}\n"
+
+    def render(ctx, out):
+        out.append(title)
+        if not any(ctx.ratio_series(name) for name in ratio_names):
+            out.append("• ❌ Недостаточно данных для расчета\n\n")
+            return
+        ratios(ctx, out)
+        out.append("\n")
+    return render
+
+def growth_verdict_section(indicator, verdict, scale=1):
+    """Оценка роста статьи от первого периода к последнему"""
+    def render(ctx, out):
+        values = ctx.item_series(indicator)
+        if len(values) >= 2:
+            first_val = values[0][1]
+            growth = ((values[-1][1] - first_val) / first_val * scale) if first_val != 0 else 0
+            out.append(verdict(growth))
+    return render
+
+def last_ratio_section(ratio_name, verdict, empty_text="• Нет данных для рекомендаций\n"):
+    """Оценка коэффициента последнего периода.
+
+    Если коэффициенты не рассчитаны ни за один период, выводится empty_text
+    (None - секция пропускается).
+    """
+    def render(ctx, out):
+        periods_ratios = ctx.periods_ratios
+        if not periods_ratios:
+            if empty_text:
+                out.append(empty_text)
+            return
+        last_ratios = periods_ratios[list(periods_ratios)[-1]]
+        if ratio_name in last_ratios:
+            text = verdict(last_ratios[ratio_name])
+            if text:
+                out.append(text)
+    return render
+
+def indicator_forecast_section(indicators, verdict):
+    """Линейный прогноз статьи на следующий период по росту за все периоды"""
+    compiled = [(indicator, f"📈 **{indicator.title()}:**\n") for indicator in indicators]
+
+    def render(ctx, out):
+        for indicator, title in compiled:
+            values = ctx.item_series(indicator)
+            if len(values) < 2:
+                continue
+            first_val = values[0][1]
+            last_val = values[-1][1]
+            growth_rate = (last_val - first_val) / first_val if first_val != 0 else 0
+            forecast_value = last_val * (1 + growth_rate)
+            out.append(title)
+            out.append(f"• Исторический рост: {growth_rate*100:+.1f}%\n")
+            out.append(f"• Прогноз на след. период: {forecast_value:,.0f} руб.\n")
+            out.append(verdict(growth_rate))
+            out.append("\n")
+    return render
+
+def ratio_forecast_section(ratio_names, line):
+    """Текущее значение коэффициента и прогноз по среднему изменению за период"""
+    compiled = [
+        (name, compile_template(line(name) if callable(line) else line, 'name', 'current', 'forecast'))
+        for name in ratio_names
+    ]
+
+    def render(ctx, out):
+        for name, line_format in compiled:
+            values = ctx.ratio_series(name)
+            if len(values) < 2:
+                continue
+            current_value = values[-1][1]
+            avg_growth = (current_value - values[0][1]) / len(values)
+            out.append(line_format(name, current_value, current_value + avg_growth))
+            out.append("\n")
+    return render
+
+# Общие элементы шаблонов
+def is_profitability(ratio_name):
+    return 'рентабельность' in ratio_name.lower()
+
+LIQUIDITY_TREND = compile_trend(0.1, "  📈 Улучшение +{change:.2f}\n", "  📉 Ухудшение {change:.2f}\n")
+PROFITABILITY_TREND = compile_trend(1, "  📈 Рост +{change:.1f}п.п.\n", "  📉 Спад {change:.1f}п.п.\n")
+
+RETURN_ON_CAPITAL_VERDICT = compile_verdict([
+    (15, "  🚀 Высокая рентабельность\n"),
+    (8, "  ✅ Хорошая рентабельность\n"),
+    (5, "  ⚠️ Средняя рентабельность\n"),
+], default="  ❌ Низкая рентабельность\n")
+
+RATIO_VERDICTS = {
+    'Коэффициент текущей ликвидности': compile_verdict([
+        (2.0, "  ✅ Отличная ликвидность\n"),
+        (1.5, "  ⚠️ Нормальная ликвидность\n"),
+        (1.0, "  🟡 Пониженная ликвидность\n"),
+    ], default="  ❌ Критическая ликвидность\n"),
+    'Коэффициент абсолютной ликвидности': compile_verdict([
+        (0.2, "  ✅ Хорошая абсолютная ликвидность\n"),
+    ], default="  ⚠️ Низкая абсолютная ликвидность\n"),
+    'Рентабельность активов (ROA)': RETURN_ON_CAPITAL_VERDICT,
+    'Рентабельность капитала (ROE)': RETURN_ON_CAPITAL_VERDICT,
+    'Рентабельность продаж (ROS)': compile_verdict([
+        (10, "  🚀 Высокая маржа\n"),
+        (5, "  ✅ Хорошая маржа\n"),
+    ], default="  ⚠️ Низкая маржа\n"),
+    'Коэффициент автономии': compile_verdict([
+        (0.5, "  ✅ Высокая автономия\n"),
+        (0.3, "  ⚠️ Средняя автономия\n"),
+    ], default="  ❌ Низкая автономия\n"),
+    'Коэффициент финансового левериджа': compile_verdict([
+        (1.0, "  ✅ Низкий леверидж\n"),
+        (2.0, "  ⚠️ Умеренный леверидж\n"),
+    ], default="  ❌ Высокий леверидж\n", op='<='),
+}
+
+FULL_REPORT_TEMPLATE = compile_report(
+    text_section("📊 **ФИНАНСОВЫЙ АНАЛИЗ ПО ПЕРИОДАМ**\n\n"),
+    text_section("💰 **ДИНАМИКА ОСНОВНЫХ ПОКАЗАТЕЛЕЙ:**\n\n"),
+    indicator_section(
+        ['выручка', 'чистая прибыль', 'активы всего', 'капитал', 'оборотные активы', 'краткосрочные обязательства'],
+        header="📈 **{name}:**\n",
+        line="• {period}: {value:,.0f} руб.\n",
+        change="  {trend} Изменение за период: {change_abs:+,.0f} руб. ({change_rel:+.1f}%)\n",
+    ),
+    branch_section(
+        lambda ctx: any(ctx.periods_ratios.values()),
+        then=[text_section("📊 **ДИНАМИКА ФИНАНСОВЫХ КОЭФФИЦИЕНТОВ:**\n\n")] + [
+            ratio_category_section(
+                category, ratio_names,
+                header="• {name}:\n",
+                line=lambda name: "  {period}: {value:.1f}%\n" if is_profitability(name) else "  {period}: {value:.2f}\n",
+                trends={name: LIQUIDITY_TREND if 'ликвидности' in name else PROFITABILITY_TREND
+                        for name in ratio_names if 'ликвидности' in name or is_profitability(name)},
+            )
+            for category, ratio_names in {
+                '💧 **ЛИКВИДНОСТЬ:**': ['Коэффициент текущей ликвидности', 'Коэффициент абсолютной ликвидности'],
+                '🎯 **РЕНТАБЕЛЬНОСТЬ:**': ['Рентабельность активов (ROA)', 'Рентабельность капитала (ROE)', 'Рентабельность продаж (ROS)'],
+                '🏛️ **ФИНАНСОВАЯ УСТОЙЧИВОСТЬ:**': ['Коэффициент автономии', 'Коэффициент финансового левериджа'],
+                '📈 **ДЕЛОВАЯ АКТИВНОСТЬ:**': ['Оборачиваемость активов'],
+            }.items()
+        ],
+        otherwise=[text_section("❌ **Не удалось рассчитать финансовые коэффициенты**\n\n")],
+    ),
+    text_section("💡 **ОБЩИЕ ВЫВОДЫ:**\n\n"),
+    growth_verdict_section('выручка', compile_verdict([
+        (15, "• 🚀 Высокий рост выручки\n"),
+        (5, "• 📈 Умеренный рост бизнеса\n"),
+        (0, "• ⚠️ Незначительный рост\n"),
+    ], default="• ❌ Снижение выручки\n", op='>'), scale=100),
+    last_ratio_section('Рентабельность активов (ROA)', compile_verdict([
+        (10, "• 💎 Высокая рентабельность\n"),
+        (5, "• ✅ Средняя рентабельность\n"),
+    ], default="• 🔴 Низкая рентабельность\n", op='>'), empty_text=None),
+    text_section(
+        "\n💡 **РЕКОМЕНДАЦИИ:**\n"
+        "• Регулярно отслеживайте динамику ключевых показателей\n"
+        "• Сравнивайте с отраслевыми нормативами\n"
+        "• Планируйте мероприятия по улучшению слабых показателей\n"
+    ),
+)
+
+LIQUIDITY_REPORT_TEMPLATE = compile_report(
+    text_section("💧 **АНАЛИЗ ЛИКВИДНОСТИ**\n\n"),
+    ratio_section(
+        ['Коэффициент текущей ликвидности', 'Коэффициент абсолютной ликвидности', 'Коэффициент срочной ликвидности'],
+        header="**{name}:**\n", line="• {period}: {value:.2f}\n",
+        verdicts=RATIO_VERDICTS, trend=LIQUIDITY_TREND,
+    ),
+    text_section("💡 **РЕКОМЕНДАЦИИ ПО ЛИКВИДНОСТИ:**\n"),
+    last_ratio_section('Коэффициент текущей ликвидности', compile_verdict([
+        (1.5, "• Увеличить объем оборотных активов\n"
+              "• Сократить краткосрочные обязательства\n"
+              "• Оптимизировать управление запасами\n"),
+    ], default="• Ликвидность в норме, поддерживать текущий уровень\n", op='<')),
+)
+
+PROFITABILITY_REPORT_TEMPLATE = compile_report(
+    text_section("💎 **АНАЛИЗ РЕНТАБЕЛЬНОСТИ**\n\n"),
+    ratio_section(
+        ['Рентабельность продаж (ROS)', 'Рентабельность активов (ROA)', 'Рентабельность капитала (ROE)', 'Валовая рентабельность'],
+        header="**{name}:**\n", line="• {period}: {value:.1f}%\n",
+        verdicts=RATIO_VERDICTS, trend=PROFITABILITY_TREND,
+    ),
+    text_section("💡 **РЕКОМЕНДАЦИИ ПО РЕНТАБЕЛЬНОСТИ:**\n"),
+    last_ratio_section('Рентабельность продаж (ROS)', compile_verdict([
+        (10, "• Повысить цены реализации\n"
+             "• Снизить себестоимость продаж\n"
+             "• Оптимизировать операционные расходы\n"),
+    ], op='<')),
+)
+
+STABILITY_REPORT_TEMPLATE = compile_report(
+    text_section("🏛️ **АНАЛИЗ ФИНАНСОВОЙ УСТОЙЧИВОСТИ**\n\n"),
+    ratio_section(
+        ['Коэффициент автономии', 'Коэффициент финансового левериджа'],
+        header="**{name}:**\n", line="• {period}: {value:.2f}\n",
+        verdicts=RATIO_VERDICTS,
+    ),
+    text_section("💡 **РЕКОМЕНДАЦИИ ПО УСТОЙЧИВОСТИ:**\n"),
+    last_ratio_section('Коэффициент автономии', compile_verdict([
+        (0.5, "• Увеличить собственный капитал\n"
+              "• Реинвестировать прибыль\n"
+              "• Сократить зависимость от заемных средств\n"),
+    ], op='<')),
+)
+
+FORECAST_REPORT_TEMPLATE = compile_report(
+    text_section("🔮 **ПРОГНОЗ ФИНАНСОВЫХ ТЕНДЕНЦИЙ**\n\n"),
+    indicator_forecast_section(['выручка', 'чистая прибыль', 'активы всего', 'капитал'], compile_verdict([
+        (0.1, "• 🚀 Высокие темпы роста\n"),
+        (0.05, "• 📈 Умеренный рост\n"),
+        (0, "• ⚠️ Незначительный рост\n"),
+    ], default="• 📉 Снижение показателя\n", op='>')),
+    text_section("📊 **ПРОГНОЗ КОЭФФИЦИЕНТОВ:**\n\n"),
+    ratio_forecast_section(
+        ['Коэффициент текущей ликвидности', 'Рентабельность продаж (ROS)', 'Коэффициент автономии'],
+        line=lambda name: ("**{name}:** {current:.1f}% → прогноз: {forecast:.1f}%\n" if is_profitability(name)
+                           else "**{name}:** {current:.2f} → прогноз: {forecast:.2f}\n"),
+    ),
+    text_section("💡 **СТРАТЕГИЧЕСКИЕ РЕКОМЕНДАЦИИ:**\n"),
+    growth_verdict_section('выручка', compile_verdict([
+        (0.15, "• 🚀 Компания в стадии активного роста\n"
+               "• Рассмотреть возможности для инвестирования\n"),
+        (0.05, "• 📈 Стабильное развитие бизнеса\n"
+               "• Продолжать текущую стратегию\n"),
+    ], default="• ⚠️ Требуется пересмотр бизнес-модели\n"
+               "• Искать новые источники роста\n", op='>')),
+)
+
+SELECTIVE_GROUP_TEMPLATES = {
+    group: indicator_section(
+        indicators,
+        header="• {name}:\n",
+        line="  {period}: {value:,.0f} руб.\n",
+        change="  {trend} Изменение: {change_abs:+,.0f} руб. ({change_rel:+.1f}%)\n",
+    )
+    for group, indicators in INDICATOR_GROUPS.items()
+}
+
+COMPLIANCE_VERDICT = compile_verdict([
+    (80, "🎉 **Отличное соответствие** отраслевым нормативам!\n"),
+    (60, "✅ **Хорошее соответствие** большинству нормативов\n"),
+    (40, "⚠️ **Среднее соответствие**, есть области для улучшения\n"),
+], default="❌ **Низкое соответствие**, требуется оптимизация\n")
+
+# === ФУНКЦИИ ГЕНЕРАЦИИ ОТЧЕТОВ ===
+
+@timed_stage('report.full')
+def generate_period_analysis_report(periods_data, periods_ratios=None):
+    """Генерирует расширенный отчет анализа по периодам"""
+    if not periods_data or all(len(data) == 0 for data in periods_data.values()):
+        return "❌ Не удалось извлечь данные по периодам."
+    return FULL_REPORT_TEMPLATE(periods_data, periods_ratios)
+
+@timed_stage('report.liquidity')
+def generate_liquidity_analysis_report(periods_data, periods_ratios=None):
+    """Генерирует отчет по анализу ликвидности"""
+    return LIQUIDITY_REPORT_TEMPLATE(periods_data, periods_ratios)
 
-def generate_profitability_analysis_report(periods_data):
+@timed_stage('report.profitability')
+def generate_profitability_analysis_report(periods_data, periods_ratios=None):
     """Генерирует отчет по анализу рентабельности"""
-    report = "💎 **АНАЛИЗ РЕНТАБЕЛЬНОСТИ**\n\n"
-    
-    periods_ratios = {}
-    for period, data in periods_data.items():
-        if data:
-            periods_ratios[period] = calculate_financial_ratios_for_period(data)
-    
-    # Анализ коэффициентов рентабельности
-    profitability_ratios = ['Рентабельность продаж (ROS)', 'Рентабельность активов (ROA)', 'Рентабельность капитала (ROE)', 'Валовая рентабельность']
-    
-    for ratio_name in profitability_ratios:
-        ratio_values = []
-        for period, ratios in periods_ratios.items():
-            if ratio_name in ratios:
-                ratio_values.append((period, ratios[ratio_name]))
-        
-        if ratio_values:
-            report += f"**{ratio_name}:**\n"
-            for period, value in ratio_values:
-                report += f"• {period}: {value:.1f}%\n"
-                
-                # Оценка значения
-                if 'ROA' in ratio_name or 'ROE' in ratio_name:
-                    if value >= 15:
-                        report += "  🚀 Высокая рентабельность\n"
-                    elif value >= 8:
-                        report += "  ✅ Хорошая рентабельность\n"
-                    elif value >= 5:
-                        report += "  ⚠️ Средняя рентабельность\n"
-                    else:
-                        report += "  ❌ Низкая рентабельность\n"
-                elif 'ROS' in ratio_name:
-                    if value >= 10:
-                        report += "  🚀 Высокая маржа\n"
-                    elif value >= 5:
-                        report += "  ✅ Хорошая маржа\n"
-                    else:
-                        report += "  ⚠️ Низкая маржа\n"
-            
-            # Анализ тренда
-            if len(ratio_values) >= 2:
-                first_val = ratio_values[0][1]
-                last_val = ratio_values[-1][1]
-                change = last_val - first_val
-                if change > 1:
-                    report += f"  📈 Рост +{change:.1f}п.п.\n"
-                elif change < -1:
-                    report += f"  📉 Спад {change:.1f}п.п.\n"
-            
-            report += "\n"
-    
-    # Рекомендации по рентабельности
-    report += "💡 **РЕКОМЕНДАЦИИ ПО РЕНТАБЕЛЬНОСТИ:**\n"
-    last_period = list(periods_ratios.keys())[-1]
-    if last_period in periods_ratios:
-        last_ratios = periods_ratios[last_period]
-        if 'Рентабельность продаж (ROS)' in last_ratios:
-            ros = last_ratios['Рентабельность продаж (ROS)']
-            if ros < 10:
-                report += "• Повысить цены реализации\n"
-                report += "• Снизить себестоимость продаж\n"
-                report += "• Оптимизировать операционные расходы\n"
-    
-    return report
+    return PROFITABILITY_REPORT_TEMPLATE(periods_data, periods_ratios)
 
-def generate_stability_analysis_report(periods_data):
+@timed_stage('report.stability')
+def generate_stability_analysis_report(periods_data, periods_ratios=None):
     """Генерирует отчет по анализу финансовой устойчивости"""
-    report = "🏛️ **АНАЛИЗ ФИНАНСОВОЙ УСТОЙЧИВОСТИ**\n\n"
-    
-    periods_ratios = {}
-    for period, data in periods_data.items():
-        if data:
-            periods_ratios[period] = calculate_financial_ratios_for_period(data)
-    
-    # Анализ коэффициентов устойчивости
-    stability_ratios = ['Коэффициент автономии', 'Коэффициент финансового левериджа']
-    
-    for ratio_name in stability_ratios:
-        ratio_values = []
-        for period, ratios in periods_ratios.items():
-            if ratio_name in ratios:
-                ratio_values.append((period, ratios[ratio_name]))
-        
-        if ratio_values:
-            report += f"**{ratio_name}:**\n"
-            for period, value in ratio_values:
-                if ratio_name == 'Коэффициент автономии':
-                    report += f"• {period}: {value:.2f}\n"
-                    if value >= 0.5:
-                        report += "  ✅ Высокая автономия\n"
-                    elif value >= 0.3:
-                        report += "  ⚠️ Средняя автономия\n"
-                    else:
-                        report += "  ❌ Низкая автономия\n"
-                else:  # Леверидж
-                    report += f"• {period}: {value:.2f}\n"
-                    if value <= 1.0:
-                        report += "  ✅ Низкий леверидж\n"
-                    elif value <= 2.0:
-                        report += "  ⚠️ Умеренный леверидж\n"
-                    else:
-                        report += "  ❌ Высокий леверидж\n"
-            
-            report += "\n"
-    
-    # Рекомендации по устойчивости
-    report += "💡 **РЕКОМЕНДАЦИИ ПО УСТОЙЧИВОСТИ:**\n"
-    last_period = list(periods_ratios.keys())[-1]
-    if last_period in periods_ratios:
-        last_ratios = periods_ratios[last_period]
-        if 'Коэффициент автономии' in last_ratios:
-            autonomy = last_ratios['Коэффициент автономии']
-            if autonomy < 0.5:
-                report += "• Увеличить собственный капитал\n"
-                report += "• Реинвестировать прибыль\n"
-                report += "• Сократить зависимость от заемных средств\n"
-    
-    return report
+    return STABILITY_REPORT_TEMPLATE(periods_data, periods_ratios)
 
-def generate_forecast_report(periods_data):
+@timed_stage('report.forecast')
+def generate_forecast_report(periods_data, periods_ratios=None):
     """Генерирует отчет с прогнозами"""
-    report = "🔮 **ПРОГНОЗ ФИНАНСОВЫХ ТЕНДЕНЦИЙ**\n\n"
-    
-    # Анализ трендов ключевых показателей
-    key_indicators = ['выручка', 'чистая прибыль', 'активы всего', 'капитал']
-    
-    for indicator in key_indicators:
-        values = []
-        periods_list = []
-        
-        for period, data in periods_data.items():
-            if data and indicator in data:
-                values.append(data[indicator])
-                periods_list.append(period)
-        
-        if len(values) >= 2:
-            # Простой линейный прогноз
-            growth_rate = (values[-1] - values[0]) / values[0] if values[0] != 0 else 0
-            forecast_value = values[-1] * (1 + growth_rate)
-            
-            report += f"📈 **{indicator.title()}:**\n"
-            report += f"• Исторический рост: {growth_rate*100:+.1f}%\n"
-            report += f"• Прогноз на след. период: {forecast_value:,.0f} руб.\n"
-            
-            if growth_rate > 0.1:
-                report += "• 🚀 Высокие темпы роста\n"
-            elif growth_rate > 0.05:
-                report += "• 📈 Умеренный рост\n"
-            elif growth_rate > 0:
-                report += "• ⚠️ Незначительный рост\n"
-            else:
-                report += "• 📉 Снижение показателя\n"
-            
-            report += "\n"
-    
-    # Прогноз финансовых коэффициентов
-    report += "📊 **ПРОГНОЗ КОЭФФИЦИЕНТОВ:**\n\n"
-    
-    periods_ratios = {}
-    for period, data in periods_data.items():
-        if data:
-            periods_ratios[period] = calculate_financial_ratios_for_period(data)
-    
-    key_ratios = ['Коэффициент текущей ликвидности', 'Рентабельность продаж (ROS)', 'Коэффициент автономии']
-    
-    for ratio_name in key_ratios:
-        ratio_values = []
-        for period, ratios in periods_ratios.items():
-            if ratio_name in ratios:
-                ratio_values.append(ratios[ratio_name])
-        
-        if len(ratio_values) >= 2:
-            current_value = ratio_values[-1]
-            avg_growth = (ratio_values[-1] - ratio_values[0]) / len(ratio_values) if len(ratio_values) > 1 else 0
-            
-            if ratio_name == 'Рентабельность продаж (ROS)':
-                forecast_value = current_value + avg_growth
-                report += f"**{ratio_name}:** {current_value:.1f}% → прогноз: {forecast_value:.1f}%\n"
-            else:
-                forecast_value = current_value + avg_growth
-                report += f"**{ratio_name}:** {current_value:.2f} → прогноз: {forecast_value:.2f}\n"
-            
-            report += "\n"
-    
-    # Общие выводы и рекомендации
-    report += "💡 **СТРАТЕГИЧЕСКИЕ РЕКОМЕНДАЦИИ:**\n"
-    
-    # Анализ общего тренда
-    revenue_values = []
-    for period, data in periods_data.items():
-        if data and 'выручка' in data:
-            revenue_values.append(data['выручка'])
-    
-    if len(revenue_values) >= 2:
-        overall_growth = (revenue_values[-1] - revenue_values[0]) / revenue_values[0] if revenue_values[0] != 0 else 0
-        
-        if overall_growth > 0.15:
-            report += "• 🚀 Компания в стадии активного роста\n"
-            report += "• Рассмотреть возможности для инвестирования\n"
-        elif overall_growth > 0.05:
-            report += "• 📈 Стабильное развитие бизнеса\n"
-            report += "• Продолжать текущую стратегию\n"
-        else:
-            report += "• ⚠️ Требуется пересмотр бизнес-модели\n"
-            report += "• Искать новые источники роста\n"
-    
-    return report
+    return FORECAST_REPORT_TEMPLATE(periods_data, periods_ratios)
+
+def ordered_groups(selected_groups):
+    """Выбранные группы в порядке INDICATOR_GROUPS (неизвестные - в конце по алфавиту).
+
+    Тот же порядок входит в ключ кэша, поэтому отчет из кэша и отчет,
+    построенный заново, совпадают.
+    """
+    return tuple(group for group in INDICATOR_GROUPS if group in selected_groups) + \
+        tuple(sorted(group for group in selected_groups if group not in INDICATOR_GROUPS))
 
+@timed_stage('report.selective')
 def generate_selective_analysis_report(periods_data, selected_groups):
     """Генерирует отчет для выборочного анализа"""
-    report = f"🎯 **ВЫБОРОЧНЫЙ АНАЛИЗ**\n\n"
-    report += f"📋 **Выбранные группы:** {', '.join(selected_groups)}\n\n"
-    
-    # Основные показатели по выбранным группам
+    ctx = ReportContext(periods_data)
+    selected_groups = ordered_groups(selected_groups)
+    out = [f"🎯 **ВЫБОРОЧНЫЙ АНАЛИЗ**\n\n", f"📋 **Выбранные группы:** {', '.join(selected_groups)}\n\n"]
     for group in selected_groups:
-        report += f"📊 **{group.upper()}:**\n"
-        indicators = INDICATOR_GROUPS.get(group, [])
-        
-        for indicator in indicators:
-            values = []
-            for period, data in periods_data.items():
-                if data and indicator in data:
-                    values.append((period, data[indicator]))
-            
-            if values:
-                report += f"• {indicator.title()}:\n"
-                for period, value in values:
-                    report += f"  {period}: {value:,.0f} руб.\n"
-                
-                # Анализ динамики
-                if len(values) >= 2:
-                    first_val = values[0][1]
-                    last_val = values[-1][1]
-                    change_abs = last_val - first_val
-                    change_rel = ((last_val - first_val) / first_val * 100) if first_val != 0 else 0
-                    trend = "📈" if change_rel > 0 else "📉" if change_rel < 0 else "➡️"
-                    report += f"  {trend} Изменение: {change_abs:+,.0f} руб. ({change_rel:+.1f}%)\n"
-                
-                report += "\n"
-    
-    return report
+        out.append(f"📊 **{group.upper()}:**\n")
+        section = SELECTIVE_GROUP_TEMPLATES.get(group)
+        if section:
+            section(ctx, out)
+    return ''.join(out)
 
 def generate_industry_comparison_report(ratios, industry_data, period):
     """Генерирует отчет сравнения с отраслевыми нормативами"""
-    report = f"🏭 **СРАВНЕНИЕ С ОТРАСЛЕВЫМИ НОРМАТИВАМИ**\n\n"
-    report += f"📊 Отрасль: **{industry_data['name']}**\n"
-    report += f"📅 Период: {period}\n\n"
-    
+    out = [
+        f"🏭 **СРАВНЕНИЕ С ОТРАСЛЕВЫМИ НОРМАТИВАМИ**\n\n",
+        f"📊 Отрасль: **{industry_data['name']}**\n",
+        f"📅 Период: {period}\n\n",
+    ]
+
     standards = industry_data['standards']
-    
+
     for ratio_name, (min_std, max_std) in standards.items():
-        if ratio_name in ratios:
-            value = ratios[ratio_name]
-            report += f"**{ratio_name}:** {value:.2f}\n"
-            
-            if value < min_std:
-                report += f"❌ **НИЖЕ НОРМЫ** (норма: {min_std:.1f}-{max_std:.1f})\n"
-                if ratio_name == 'Коэффициент текущей ликвидности':
-                    report += "   💡 Рекомендация: увеличить оборотные активы\n"
-                elif 'рентабельность' in ratio_name.lower():
-                    report += "   💡 Рекомендация: оптимизировать затраты\n"
-            elif value > max_std:
-                report += f"⚠️ **ВЫШЕ НОРМЫ** (норма: {min_std:.1f}-{max_std:.1f})\n"
-                if ratio_name == 'Коэффициент текущей ликвидности':
-                    report += "   💡 Возможно избыточная ликвидность\n"
-            else:
-                report += f"✅ **В НОРМЕ** (норма: {min_std:.1f}-{max_std:.1f})\n"
-            
-            report += "\n"
+        if ratio_name not in ratios:
+            out.append(f"**{ratio_name}:** ❌ нет данных\n\n")
+            continue
+
+        value = ratios[ratio_name]
+        out.append(f"**{ratio_name}:** {value:.2f}\n")
+        if value < min_std:
+            out.append(f"❌ **НИЖЕ НОРМЫ** (норма: {min_std:.1f}-{max_std:.1f})\n")
+            if ratio_name == 'Коэффициент текущей ликвидности':
+                out.append("   💡 Рекомендация: увеличить оборотные активы\n")
+            elif is_profitability(ratio_name):
+                out.append("   💡 Рекомендация: оптимизировать затраты\n")
+        elif value > max_std:
+            out.append(f"⚠️ **ВЫШЕ НОРМЫ** (норма: {min_std:.1f}-{max_std:.1f})\n")
+            if ratio_name == 'Коэффициент текущей ликвидности':
+                out.append("   💡 Возможно избыточная ликвидность\n")
         else:
-            report += f"**{ratio_name}:** ❌ нет данных\n\n"
-    
-    # Общая оценка
-    matching_standards = sum(1 for ratio_name in standards if ratio_name in ratios and 
-                           min_std <= ratios[ratio_name] <= max_std)
+            out.append(f"✅ **В НОРМЕ** (норма: {min_std:.1f}-{max_std:.1f})\n")
+        out.append("\n")
+
+    # Общая оценка (границы - последнего норматива в списке, как и раньше)
+    matching_standards = sum(1 for ratio_name in standards if ratio_name in ratios and
+                             min_std <= ratios[ratio_name] <= max_std)
     total_comparable = sum(1 for ratio_name in standards if ratio_name in ratios)
-    
+
     if total_comparable > 0:
         compliance_rate = (matching_standards / total_comparable) * 100
-        report += f"📈 **СООТВЕТСТВИЕ НОРМАТИВАМ:** {compliance_rate:.1f}%\n\n"
-        
-        if compliance_rate >= 80:
-            report += "🎉 **Отличное соответствие** отраслевым нормативам!\n"
-        elif compliance_rate >= 60:
-            report += "✅ **Хорошее соответствие** большинству нормативов\n"
-        elif compliance_rate >= 40:
-            report += "⚠️ **Среднее соответствие**, есть области для улучшения\n"
-        else:
-            report += "❌ **Низкое соответствие**, требуется оптимизация\n"
-    
-    return report
+        out.append(f"📈 **СООТВЕТСТВИЕ НОРМАТИВАМ:** {compliance_rate:.1f}%\n\n")
+        out.append(COMPLIANCE_VERDICT(compliance_rate))
+
+    return ''.join(out)
+
+@timed_stage('report.industry')
+def build_industry_comparison_report(periods_data, industry_data, periods_ratios=None):
+    """Сравнивает коэффициенты последнего периода с нормативами"""
+    last_period = list(periods_data.keys())[-1]
+    if periods_ratios is None:
+        ratios = calculate_financial_ratios_for_period(periods_data[last_period])
+    else:
+        ratios = periods_ratios.get(last_period, {})
+    return generate_industry_comparison_report(ratios, industry_data, last_period)
 
 # === ОСНОВНЫЕ ФУНКЦИИ АНАЛИЗА ===
 
@@ -1112,17 +2990,17 @@ async def perform_full_analysis(update: Update, context: ContextTypes.DEFAULT_TY
     await update.message.reply_text("🔍 Выполняю полный финансовый анализ...")
     
     periods_data = context.user_data['periods_data']
-    report = generate_period_analysis_report(periods_data)
+    report = await run_report_job(
+        update, generate_period_analysis_report, periods_data, get_periods_ratios(context),
+        cache_key=report_cache_key(context, 'full')
+    )
+    if report is None:
+        return
     
     context.user_data['last_analysis'] = report
     context.user_data['analysis_type'] = "полный анализ"
     
-    if len(report) > 4000:
-        parts = [report[i:i+4000] for i in range(0, len(report), 4000)]
-        for part in parts:
-            await update.message.reply_text(part)
-    else:
-        await update.message.reply_text(report)
+    await send_long_message(update.message, report)
     
     await update.message.reply_text("✅ Полный анализ завершен!")
 
@@ -1138,12 +3016,17 @@ async def perform_liquidity_analysis(update: Update, context: ContextTypes.DEFAU
     await update.message.reply_text("💧 Анализирую ликвидность...")
     
     periods_data = context.user_data['periods_data']
-    report = generate_liquidity_analysis_report(periods_data)
+    report = await run_report_job(
+        update, generate_liquidity_analysis_report, periods_data, get_periods_ratios(context),
+        cache_key=report_cache_key(context, 'liquidity')
+    )
+    if report is None:
+        return
     
     context.user_data['last_analysis'] = report
     context.user_data['analysis_type'] = "анализ ликвидности"
     
-    await update.message.reply_text(report)
+    await send_long_message(update.message, report)
 
 async def perform_profitability_analysis(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Анализ рентабельности"""
@@ -1156,12 +3039,17 @@ async def perform_profitability_analysis(update: Update, context: ContextTypes.D
     await update.message.reply_text("💎 Анализирую рентабельность...")
     
     periods_data = context.user_data['periods_data']
-    report = generate_profitability_analysis_report(periods_data)
+    report = await run_report_job(
+        update, generate_profitability_analysis_report, periods_data, get_periods_ratios(context),
+        cache_key=report_cache_key(context, 'profitability')
+    )
+    if report is None:
+        return
     
     context.user_data['last_analysis'] = report
     context.user_data['analysis_type'] = "анализ рентабельности"
     
-    await update.message.reply_text(report)
+    await send_long_message(update.message, report)
 
 async def perform_stability_analysis(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Анализ финансовой устойчивости"""
@@ -1174,12 +3062,17 @@ async def perform_stability_analysis(update: Update, context: ContextTypes.DEFAU
     await update.message.reply_text("🏛️ Анализирую финансовую устойчивость...")
     
     periods_data = context.user_data['periods_data']
-    report = generate_stability_analysis_report(periods_data)
+    report = await run_report_job(
+        update, generate_stability_analysis_report, periods_data, get_periods_ratios(context),
+        cache_key=report_cache_key(context, 'stability')
+    )
+    if report is None:
+        return
     
     context.user_data['last_analysis'] = report
     context.user_data['analysis_type'] = "анализ финансовой устойчивости"
     
-    await update.message.reply_text(report)
+    await send_long_message(update.message, report)
 
 async def perform_forecast_analysis(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Прогнозирование тенденций"""
@@ -1192,12 +3085,17 @@ async def perform_forecast_analysis(update: Update, context: ContextTypes.DEFAUL
     await update.message.reply_text("🔮 Анализирую тенденции и строю прогноз...")
     
     periods_data = context.user_data['periods_data']
-    report = generate_forecast_report(periods_data)
+    report = await run_report_job(
+        update, generate_forecast_report, periods_data, get_periods_ratios(context),
+        cache_key=report_cache_key(context, 'forecast')
+    )
+    if report is None:
+        return
     
     context.user_data['last_analysis'] = report
     context.user_data['analysis_type'] = "прогноз тенденций"
     
-    await update.message.reply_text(report)
+    await send_long_message(update.message, report)
 
 # === ФУНКЦИИ ВЫБОРОЧНОГО АНАЛИЗА ===
 
@@ -1295,19 +3193,19 @@ async def start_selective_analysis(update: Update, context: ContextTypes.DEFAULT
         filtered_periods_data[period] = filtered_data
     
     # Генерируем отчет
-    report = generate_selective_analysis_report(filtered_periods_data, selected_groups)
+    report = await run_report_job(
+        update, generate_selective_analysis_report, filtered_periods_data, selected_groups,
+        cache_key=report_cache_key(context, 'selective', ordered_groups(selected_groups))
+    )
+    if report is None:
+        return ConversationHandler.END
     
     # Сохраняем для возможного экспорта в TXT
     context.user_data['last_analysis'] = report
     context.user_data['analysis_type'] = analysis_type
     
     # Отправляем отчет
-    if len(report) > 4000:
-        parts = [report[i:i+4000] for i in range(0, len(report), 4000)]
-        for part in parts:
-            await update.message.reply_text(part)
-    else:
-        await update.message.reply_text(report)
+    await send_long_message(update.message, report)
     
     await update.message.reply_text("✅ Выборочный анализ завершен!")
     await start(update, context)
@@ -1358,22 +3256,281 @@ async def handle_industry_selection(update: Update, context: ContextTypes.DEFAUL
     periods_data = context.user_data['periods_data']
     industry_data = INDUSTRY_STANDARDS[selected_industry]
     
-    # Рассчитываем коэффициенты для последнего периода
-    last_period = list(periods_data.keys())[-1]
-    last_data = periods_data[last_period]
-    ratios = calculate_financial_ratios_for_period(last_data)
-    
-    # Генерируем отчет сравнения
-    report = generate_industry_comparison_report(ratios, industry_data, last_period)
+    # Берем коэффициенты последнего периода из снимка анализа и генерируем отчет сравнения
+    report = await run_report_job(
+        update, build_industry_comparison_report, periods_data, industry_data, get_periods_ratios(context),
+        cache_key=report_cache_key(context, 'industry', selected_industry)
+    )
+    if report is None:
+        return ConversationHandler.END
     
     # Сохраняем для TXT
     context.user_data['last_analysis'] = report
     context.user_data['analysis_type'] = f"сравнение с {industry_data['name']}"
     
-    await update.message.reply_text(report)
+    await send_long_message(update.message, report)
     await start(update, context)
     return ConversationHandler.END
 
+# === ПАКЕТНЫЙ АНАЛИЗ ===
+
+# Подписи к книге, при которых каждый ее лист - отдельная компания
+BATCH_CAPTIONS = ('/batch', 'batch', 'портфель', 'пакет')
+
+# Коэффициенты рейтинга компаний: (название, краткое обозначение, формат, больше - лучше)
+BATCH_RANKING = [
+    ('Рентабельность активов (ROA)', 'ROA', '{:.1f}%', True),
+    ('Рентабельность продаж (ROS)', 'ROS', '{:.1f}%', True),
+    ('Коэффициент текущей ликвидности', 'ТЛ', '{:.2f}', True),
+    ('Коэффициент автономии', 'КА', '{:.2f}', True),
+    ('Коэффициент финансового левериджа', 'ФЛ', '{:.2f}', False),
+]
+
+def list_batch_members(source):
+    """Книги Excel в zip-архиве пакета: [(компания, имя файла в архиве)].
+
+    Архив проверяется так же, как inspect_upload проверяет .xlsx: сумма
+    распакованных размеров и степень сжатия (UploadRejected).
+    """
+    try:
+        with zipfile.ZipFile(excel_source(source)) as zip_file:
+            members = [
+                info for info in zip_file.infolist()
+                if not info.is_dir() and info.filename.lower().endswith(('.xlsx', '.xls'))
+                and not info.filename.startswith('__MACOSX/')
+                and not os.path.basename(info.filename).startswith(('.', '~$'))
+            ]
+    except zipfile.BadZipFile:
+        raise UploadRejected("Архив поврежден или не является zip-файлом")
+
+    total_size = sum(info.file_size for info in members)
+    if total_size > MAX_UNCOMPRESSED_MB * 1024 * 1024:
+        raise UploadRejected(f"Архив слишком большой в распакованном виде ({total_size / 1024 / 1024:.0f} МБ)")
+    for info in members:
+        if info.compress_size and info.file_size > 1024 * 1024 and \
+                info.file_size / info.compress_size > MAX_COMPRESSION_RATIO:
+            raise UploadRejected("Архив подозрительно сильно сжат и не может быть обработан")
+
+    companies = []
+    for info in members:
+        name = info.filename
+        if not info.flag_bits & 0x800:
+            # Имена без флага UTF-8 архиваторы Windows пишут в cp866, zipfile читает их как cp437
+            with contextlib.suppress(UnicodeError):
+                name = name.encode('cp437').decode('cp866')
+        companies.append((os.path.splitext(os.path.basename(name))[0], info.filename))
+    return companies
+
+def read_batch_member(source, member):
+    with zipfile.ZipFile(excel_source(source)) as zip_file:
+        return zip_file.read(member)
+
+def company_result(company, periods_data):
+    """Итог по компании: данные и коэффициенты последнего непустого периода"""
+    filled = [period for period, data in periods_data.items() if data]
+    if not filled:
+        return {'company': company, 'error': "не найдены периоды или статьи отчетности"}
+    last_period = filled[-1]
+    return {
+        'company': company,
+        'periods_data': periods_data,
+        'last_period': last_period,
+        'ratios': calculate_financial_ratios_for_period(periods_data[last_period]),
+    }
+
+def parse_company_sheet(source, file_name, sheet, company):
+    """Компания - лист книги: чтение листа, периоды, данные (выполняется в пуле)"""
+    df = read_excel_file(source, file_name, sheet)
+    periods = detect_periods(df)
+    return company_result(company, extract_financial_data_by_period(df, periods) if periods else {})
+
+def parse_company_workbook(source, member, company):
+    """Компания - книга из архива: листы объединяются, как при обычной загрузке (выполняется в пуле).
+
+    Книга распаковывается и проверяется inspect_upload здесь же, в воркере,
+    а не в цикле событий; отклоненная книга - ошибка компании.
+    """
+    book = read_batch_member(source, member)
+    file_name = member.lower()
+    try:
+        inspect_upload(book, file_name)
+    except UploadRejected as e:
+        return {'company': company, 'error': str(e)}
+    sheets = list_excel_sheets(book, file_name)
+    _, periods_data = merge_sheet_results([
+        parse_excel_sheet(book, file_name, idx, name) for idx, name in enumerate(sheets)
+    ])
+    return company_result(company, periods_data)
+
+def rank_companies(results):
+    """Сортирует компании по баллу 0-100 за коэффициенты BATCH_RANKING.
+
+    По каждому коэффициенту компания получает долю компаний пакета, которых
+    она не хуже (нет значения - 0); балл - среднее по коэффициентам.
+    """
+    scores = {id(result): 0.0 for result in results}
+    for ratio_name, _, _, higher_is_better in BATCH_RANKING:
+        sign = 1 if higher_is_better else -1
+        values = sorted(sign * result['ratios'][ratio_name] for result in results if ratio_name in result['ratios'])
+        for result in results:
+            if ratio_name in result['ratios']:
+                scores[id(result)] += bisect.bisect_right(values, sign * result['ratios'][ratio_name]) / len(values)
+
+    for result in results:
+        result['score'] = round(scores[id(result)] / len(BATCH_RANKING) * 100)
+    return sorted(results, key=lambda result: (-result['score'], result['company']))
+
+def generate_batch_summary(ranked, failed):
+    """Сводный отчет пакета: рейтинг компаний и список необработанных файлов"""
+    out = [f"📦 **ПАКЕТНЫЙ АНАЛИЗ: {len(ranked) + len(failed)} компаний**\n\n"]
+    if ranked:
+        out.append("🏆 **РЕЙТИНГ:**\n")
+        for place, result in enumerate(ranked, 1):
+            ratios = result['ratios']
+            values = ' • '.join(
+                f"{label} {fmt.format(ratios[name]) if name in ratios else '—'}"
+                for name, label, fmt, _ in BATCH_RANKING
+            )
+            out.append(f"{place}. **{result['company']}** - балл {result['score']} ({result['last_period']})\n")
+            out.append(f"   {values}\n")
+        out.append("\n")
+    if failed:
+        out.append("❌ **НЕ ОБРАБОТАНЫ:**\n")
+        out.extend(f"• {result['company']}: {result['error']}\n" for result in failed)
+        out.append("\n")
+    out.append("📊 Балл 0-100: среднее место компании в пакете по " +
+               ", ".join(label for _, label, _, _ in BATCH_RANKING) + "\n")
+    return ''.join(out)
+
+def excel_sheet_name(name, used):
+    """Допустимое и уникальное в книге имя листа (до 31 символа, без []:*?/\\)"""
+    base = re.sub(r'[\[\]:*?/\\]', ' ', name).strip()[:31] or 'Компания'
+    sheet_name, suffix = base, 2
+    while sheet_name.lower() in used:
+        sheet_name = f"{base[:31 - len(str(suffix)) - 3]} ({suffix})"
+        suffix += 1
+    used.add(sheet_name.lower())
+    return sheet_name
+
+def build_batch_workbook(ranked):
+    """Книга экспорта пакета: лист рейтинга и по листу на компанию (выполняется в пуле)"""
+    buffer = io.BytesIO()
+    with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
+        pd.DataFrame([
+            {'Место': place, 'Компания': result['company'], 'Балл': result['score'],
+             'Период': result['last_period'], **result['ratios']}
+            for place, result in enumerate(ranked, 1)
+        ]).to_excel(writer, sheet_name='Рейтинг', index=False)
+
+        used = {'рейтинг'}
+        for result in ranked:
+            sheet_name = excel_sheet_name(result['company'], used)
+            items = pd.DataFrame(result['periods_data'])
+            items.index.name = 'Показатель'
+            items.to_excel(writer, sheet_name=sheet_name)
+            ratios = pd.Series(result['ratios'], name=result['last_period'], dtype=float).to_frame()
+            ratios.index.name = 'Коэффициент'
+            ratios.to_excel(writer, sheet_name=sheet_name, startrow=len(items) + 2)
+    return buffer.getvalue()
+
+async def analyze_batch(update, context, source, file_name):
+    """Пакетный анализ: каждая книга zip-архива или каждый лист книги - отдельная компания.
+
+    Компании разбираются параллельно в пуле (не больше ANALYSIS_WORKERS
+    одновременно, чтобы пакет не занимал всю очередь), ход обработки
+    показывается правкой одного сообщения.
+    """
+    started_at = time.perf_counter()
+    is_archive = file_name.endswith('.zip')
+    try:
+        if is_archive:
+            companies = await run_in_analysis_pool(list_batch_members, source, update=update)
+        else:
+            for warning in await asyncio.to_thread(inspect_upload, source, file_name):
+                await update.message.reply_text(f"⚠️ {warning}")
+            sheets = await run_in_analysis_pool(list_excel_sheets, source, file_name, update=update)
+            companies = [(name, idx) for idx, name in enumerate(sheets)]
+    except UploadRejected as e:
+        UPLOADS_TOTAL.inc(result='rejected')
+        await update.message.reply_text(f"❌ {e}")
+        return
+    except AnalysisQueueFull:
+        UPLOADS_TOTAL.inc(result='overloaded')
+        await update.message.reply_text("🚦 Сервер перегружен, отправьте файл повторно через минуту")
+        return
+    except asyncio.TimeoutError:
+        UPLOADS_TOTAL.inc(result='timeout')
+        await update.message.reply_text("⌛ Файл обрабатывается слишком долго, попробуйте файл меньшего размера")
+        return
+
+    if not companies:
+        await update.message.reply_text("❌ В архиве нет книг Excel (.xlsx или .xls)")
+        return
+    if len(companies) > MAX_BATCH_COMPANIES:
+        UPLOADS_TOTAL.inc(result='rejected')
+        await update.message.reply_text(
+            f"❌ В пакете {len(companies)} компаний, максимум {MAX_BATCH_COMPANIES} - разделите его на части"
+        )
+        return
+
+    total = len(companies)
+    status = await update.message.reply_text(f"📦 Пакетный анализ: 0/{total} компаний...")
+    semaphore = asyncio.Semaphore(ANALYSIS_WORKERS)
+    done = 0
+    progress_at = time.monotonic()
+
+    async def run_company(company, target):
+        nonlocal done, progress_at
+        async with semaphore:
+            try:
+                if is_archive:
+                    result = await run_in_analysis_pool(parse_company_workbook, source, target, company)
+                else:
+                    result = await run_in_analysis_pool(parse_company_sheet, source, file_name, target, company)
+            except UploadRejected as e:
+                result = {'company': company, 'error': str(e)}
+            except AnalysisQueueFull:
+                result = {'company': company, 'error': "сервер перегружен"}
+            except asyncio.TimeoutError:
+                result = {'company': company, 'error': "разбор занял слишком много времени"}
+            except Exception as e:
+                result = {'company': company, 'error': str(e)}
+
+        done += 1
+        if done < total and time.monotonic() - progress_at >= BATCH_PROGRESS_INTERVAL:
+            progress_at = time.monotonic()
+            with contextlib.suppress(TelegramError):
+                await status.edit_text(f"📦 Пакетный анализ: {done}/{total} компаний...")
+        return result
+
+    results = await asyncio.gather(*(run_company(company, target) for company, target in companies))
+    failed = [result for result in results if 'error' in result]
+    ranked = rank_companies([result for result in results if 'error' not in result])
+    elapsed = time.perf_counter() - started_at
+
+    with contextlib.suppress(TelegramError):
+        await status.edit_text(f"📦 Пакетный анализ: {total}/{total} компаний за {elapsed:.1f} с")
+    UPLOADS_TOTAL.inc(result='batch')
+    log_event('batch.done', companies=total, failed=len(failed), archive=is_archive,
+              duration_ms=round(elapsed * 1000, 1))
+
+    summary = generate_batch_summary(ranked, failed)
+    context.user_data['last_analysis'] = summary
+    context.user_data['analysis_type'] = "пакетный анализ"
+    await send_long_message(update.message, summary)
+
+    if ranked:
+        try:
+            workbook = await run_in_analysis_pool(build_batch_workbook, ranked)
+        except (AnalysisQueueFull, asyncio.TimeoutError):
+            await update.message.reply_text("🚦 Не удалось подготовить файл с данными компаний, сервер перегружен")
+            return
+        await update.message.reply_document(
+            document=workbook,
+            filename=f'портфель_{datetime.now().strftime("%Y%m%d_%H%M")}.xlsx',
+            caption='📦 Рейтинг и данные по каждой компании пакета'
+        )
+
 # === ФУНКЦИЯ ЭКСПОРТА В TXT ===
 
 async def export_to_txt(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1412,11 +3569,83 @@ async def export_to_txt(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         await update.message.reply_text(f"❌ Ошибка создания файла: {str(e)}")
 
+# === ПОРЯДОК ОБНОВЛЕНИЙ ===
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка обновлений разных пользователей.
+
+    Обновления одного пользователя выполняются строго по очереди: на
+    context.user_data и состояние ConversationHandler полагаются меню,
+    выборочный анализ и загрузка файла. Обновление сначала дожидается своей
+    очереди у пользователя и лишь затем занимает общий слот, поэтому
+    пользователь, приславший много сообщений подряд, держит не больше одного
+    слота. Блокировка пользователя удаляется, когда у него не остается
+    обновлений в работе.
+    """
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._user_locks = {}
+
+    @staticmethod
+    def _update_key(update):
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+
+    async def process_update(self, update, coroutine):
+        key = self._update_key(update)
+        if key is None:
+            await super().process_update(update, coroutine)
+            return
+
+        entry = self._user_locks.get(key)
+        if entry is None:
+            entry = self._user_locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            # Очередь пользователя - до общего семафора (его берет super().process_update)
+            async with entry[0]:
+                await super().process_update(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._user_locks[key]
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def wait_idle(self, keys):
+        """Дожидается завершения уже принятых обновлений этих пользователей"""
+        for key in keys:
+            entry = self._user_locks.get(key)
+            if entry is not None:
+                async with entry[0]:
+                    pass
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        self._user_locks.clear()
+
 # === ОБРАБОТЧИК СООБЩЕНИЙ ===
 
+# Кнопки, запускающие построение отчета; остальные - дешевая навигация по меню
+ANALYSIS_BUTTONS = {
+    "📊 Полный анализ", "📈 Анализ ликвидности", "💎 Анализ рентабельности",
+    "🏛️ Финансовая устойчивость", "🔮 Прогноз тенденций", "📄 Экспорт в TXT",
+}
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик текстовых сообщений с кнопок"""
     text = update.message.text
+
+    if not await check_rate_limit(update, 'analysis' if text in ANALYSIS_BUTTONS else 'menu'):
+        return
     
     if text == "📊 Полный анализ":
         await perform_full_analysis(update, context)
@@ -1444,13 +3673,26 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 def setup_application():
     """Настраивает и возвращает приложение"""
     # Создаем приложение
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .base_url(TELEGRAM_API_URL)
+        .base_file_url(TELEGRAM_FILE_URL)
+        .request(InstrumentedRequest(connection_pool_size=256))
+        .concurrent_updates(PerUserUpdateProcessor(CONCURRENT_UPDATES))
+        .rate_limiter(PacedRateLimiter())
+        .build()
+    )
+    METRICS.register(CallbackMetric(
+        'balance_update_queue_size', 'Обновления, ожидающие обработки', application.update_queue.qsize
+    ))
     
     # Добавляем обработчики
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("template", template_command))
     application.add_handler(CommandHandler("sample", sample_command))
+    application.add_handler(CommandHandler("append", append_command))
     
     # Обработчик документов (Excel файлов)
     application.add_handler(MessageHandler(filters.Document.ALL, receive_document))
@@ -1488,6 +3730,528 @@ def setup_application():
     
     return application
 
+# === ЛОКАЛЬНЫЙ HTTP-СЕРВЕР ===
+
+HTTP_STATUS_TEXT = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found',
+                    413: 'Payload Too Large', 500: 'Internal Server Error', 501: 'Not Implemented',
+                    503: 'Service Unavailable'}
+HTTP_MAX_BODY = 1024 * 1024
+HTTP_MAX_HEADERS = 100
+# Сколько ждать очередной запрос на keep-alive соединении и сколько можно
+# передавать один запрос (заголовки и тело), секунд
+HTTP_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', 30))
+
+class HTTPRequestError(Exception):
+    """Запрос нельзя обработать; ответ со статусом status, после которого соединение закрывается"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+async def read_http_request(reader):
+    """Читает один запрос: (метод, путь, заголовки, тело) или None, если клиент закрыл соединение"""
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    parts = request_line.decode('latin-1').split(' ', 2)
+    if len(parts) != 3:
+        raise HTTPRequestError(400, 'bad request line')
+    method, target, _ = parts
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        if len(headers) >= HTTP_MAX_HEADERS:
+            raise HTTPRequestError(400, 'too many headers')
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    # Тело без Content-Length нельзя отделить от следующего запроса - не принимаем его
+    if 'transfer-encoding' in headers:
+        raise HTTPRequestError(501, 'transfer-encoding not supported')
+    try:
+        length = int(headers.get('content-length', 0))
+    except ValueError:
+        raise HTTPRequestError(400, 'bad content-length')
+    if length < 0:
+        raise HTTPRequestError(400, 'bad content-length')
+    if length > HTTP_MAX_BODY:
+        raise HTTPRequestError(413, 'too large')
+
+    body = await reader.readexactly(length) if length else b''
+    return method, target.split('?', 1)[0], headers, body
+
+async def start_http_server(routes, host, port):
+    """Запускает минимальный HTTP/1.1 сервер на asyncio.
+
+    routes - словарь (метод, путь) -> async handler(headers, body), который
+    возвращает (статус, content-type, тело в байтах). Поддерживается keep-alive;
+    соединение, молчащее дольше HTTP_READ_TIMEOUT, закрывается. Тела с
+    Transfer-Encoding не принимаются (501), исключение в обработчике дает 500.
+    """
+
+    async def handle_connection(reader, writer):
+        try:
+            while True:
+                try:
+                    async with asyncio.timeout(HTTP_READ_TIMEOUT):
+                        request = await read_http_request(reader)
+                except HTTPRequestError as e:
+                    status, content_type, payload = e.status, 'text/plain', str(e).encode('latin-1')
+                    keep_alive = False
+                else:
+                    if request is None:
+                        break
+                    method, path, headers, body = request
+                    handler = routes.get((method, path))
+                    if handler is None:
+                        status, content_type, payload = 404, 'text/plain', b'not found'
+                    else:
+                        try:
+                            status, content_type, payload = await handler(headers, body)
+                        except Exception as e:
+                            log_event('http.handler_failed', logging.ERROR, path=path, error=repr(e))
+                            status, content_type, payload = 500, 'text/plain', b'internal error'
+                    keep_alive = headers.get('connection', '').lower() != 'close'
+
+                writer.write(
+                    f"HTTP/1.1 {status} {HTTP_STATUS_TEXT.get(status, 'OK')}\r\n"
+                    f"Content-Type: {content_type}\r\n"
+                    f"Content-Length: {len(payload)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode('latin-1') + payload
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        # TimeoutError - простой keep-alive соединения или медленный клиент;
+        # ValueError - строка длиннее буфера StreamReader
+        except (TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle_connection, host, port)
+
+# === РЕЖИМЫ ЗАПУСКА: POLLING И WEBHOOK ===
+
+def webhook_handler(submit_update, pending_updates):
+    """HTTP-обработчик обновлений Telegram.
+
+    Проверяет секрет и передает JSON обновления в submit_update; если в
+    очереди уже WEBHOOK_MAX_PENDING обновлений (pending_updates()), отвечает 503.
+    """
+
+    async def handle(headers, body):
+        if WEBHOOK_SECRET and headers.get('x-telegram-bot-api-secret-token') != WEBHOOK_SECRET:
+            return 403, 'text/plain', b'forbidden'
+
+        # Очередь переполнена - Telegram повторит доставку позже
+        if pending_updates() >= WEBHOOK_MAX_PENDING:
+            return 503, 'text/plain', b'busy'
+
+        try:
+            data = json.loads(body)
+            await submit_update(data)
+        except Exception as e:
+            log_event('webhook.bad_update', logging.WARNING, error=str(e))
+            return 400, 'text/plain', b'bad update'
+
+        return 200, 'application/json', b'{"ok":true}'
+
+    return handle
+
+def application_submitter(application):
+    """Передача JSON обновления в очередь приложения"""
+
+    async def submit(data):
+        await application.update_queue.put(Update.de_json(data, application.bot))
+
+    return submit
+
+async def health_handler(headers, body):
+    return 200, 'text/plain', b'ok'
+
+async def wait_for_shutdown():
+    """Ждет SIGINT/SIGTERM"""
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):  # Windows / не главный поток
+            pass
+    await stop_event.wait()
+
+async def run_polling_mode(application):
+    """Получение обновлений long polling"""
+    start_analysis_pool()
+    async with application:
+        await application.start()
+        await application.updater.start_polling()
+        await start_metrics_server()
+        await wait_for_shutdown()
+        await application.updater.stop()
+        await application.stop()
+
+async def run_webhook_mode(application):
+    """Получение обновлений через локальный HTTP-эндпоинт webhook"""
+    start_analysis_pool()
+    async with application:
+        await application.start()
+        server = await start_http_server({
+            ('POST', WEBHOOK_PATH): webhook_handler(application_submitter(application), application.update_queue.qsize),
+            ('GET', '/healthz'): health_handler,
+        }, WEBHOOK_LISTEN, WEBHOOK_PORT)
+        print(f"🌐 Webhook слушает http://{WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+        await start_metrics_server()
+
+        if WEBHOOK_URL:
+            await register_webhook(application.bot)
+
+        await wait_for_shutdown()
+        server.close()
+        await server.wait_closed()
+        await application.stop()
+
+async def register_webhook(bot):
+    await bot.set_webhook(
+        url=WEBHOOK_URL,
+        secret_token=WEBHOOK_SECRET,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        allowed_updates=Update.ALL_TYPES
+    )
+
+# === ШАРДИРОВАНИЕ ПО ПОЛЬЗОВАТЕЛЯМ ===
+
+class HashRing:
+    """Кольцо консистентного хэширования с виртуальными узлами.
+
+    При добавлении узла к нему переходит лишь ~1/N ключей, остальные
+    пользователи остаются у прежних воркеров.
+    """
+
+    def __init__(self, virtual_nodes=64):
+        self.virtual_nodes = virtual_nodes
+        self.hashes = []
+        self.nodes = []
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.blake2b(str(key).encode('utf-8'), digest_size=8).digest(), 'big')
+
+    def add_node(self, node):
+        for replica in range(self.virtual_nodes):
+            point = self._hash(f"{node}#{replica}")
+            idx = bisect.bisect(self.hashes, point)
+            self.hashes.insert(idx, point)
+            self.nodes.insert(idx, node)
+
+    def remove_node(self, node):
+        keep = [(point, owner) for point, owner in zip(self.hashes, self.nodes) if owner != node]
+        self.hashes = [point for point, _ in keep]
+        self.nodes = [owner for _, owner in keep]
+
+    def with_node(self, node):
+        """Копия кольца с добавленным узлом (само кольцо не меняется)"""
+        ring = HashRing(self.virtual_nodes)
+        ring.hashes, ring.nodes = list(self.hashes), list(self.nodes)
+        ring.add_node(node)
+        return ring
+
+    def get_node(self, key):
+        if not self.nodes:
+            return None
+        idx = bisect.bisect(self.hashes, self._hash(key)) % len(self.hashes)
+        return self.nodes[idx]
+
+def update_user_id(data):
+    """Достает id пользователя (или чата) из JSON обновления Telegram"""
+    for value in data.values():
+        if isinstance(value, dict):
+            if isinstance(value.get('from'), dict):
+                return value['from'].get('id')
+            if isinstance(value.get('chat'), dict):
+                return value['chat'].get('id')
+    return 0
+
+@contextlib.contextmanager
+def patched_environ(overrides):
+    """Временно задает переменные окружения - их наследует процесс, запущенный внутри"""
+    saved = {name: os.environ.get(name) for name in overrides}
+    os.environ.update(overrides)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+class ShardRouter:
+    """Распределяет обновления по процессам-воркерам по user_id.
+
+    Каждый воркер - отдельный процесс (spawn) со своим Application, user_data
+    и кэшами; все обновления одного пользователя попадают к одному воркеру.
+    Воркер получает из очереди JSON обновлений, кортежи-команды маршрутизатора
+    ('handoff', номер, узлы кольца) и None - сигнал остановки.
+    """
+
+    def __init__(self, virtual_nodes):
+        self.virtual_nodes = virtual_nodes
+        self.ring = HashRing(virtual_nodes)
+        # worker_id -> (процесс, очередь, счетчик прочитанных воркером сообщений)
+        self.workers = {}
+        self.submitted = collections.Counter()
+        self.mp_context = multiprocessing.get_context(PROCESS_START_METHOD)
+        self.handoff_replies = self.mp_context.Queue()
+        self.handoff_seq = 0
+        self.rebalance_lock = asyncio.Lock()
+        # Кольцо после добавляемого воркера и придержанные обновления переходящих к нему пользователей
+        self.next_ring = None
+        self.held = []
+        # Ядра делятся между воркерами, если размер пула не задан явно. Значение
+        # передается через окружение, чтобы воркер посчитал от него при импорте
+        # и производные настройки (MAX_CONCURRENT_PARSES)
+        self.worker_env = {}
+        if 'ANALYSIS_WORKERS' not in os.environ:
+            self.worker_env['ANALYSIS_WORKERS'] = str(max(1, (os.cpu_count() or 2) // max(BOT_WORKERS, 1)))
+
+    def _start_process(self, worker_id, backlog=()):
+        queue = self.mp_context.Queue()
+        consumed = self.mp_context.RawValue('q', 0)
+        process = self.mp_context.Process(
+            target=run_shard_worker, args=(worker_id, queue, consumed, self.handoff_replies),
+            name=f"bot-worker-{worker_id}", daemon=True
+        )
+        with patched_environ(self.worker_env):
+            process.start()
+        self.workers[worker_id] = (process, queue, consumed)
+        self.submitted[worker_id] = 0
+        for data in backlog:
+            self._send(worker_id, data)
+
+    def _send(self, worker_id, data):
+        self.workers[worker_id][1].put_nowait(data)
+        self.submitted[worker_id] += 1
+
+    async def add_worker(self):
+        """Добавляет воркер и передает ему часть пользователей.
+
+        Прежние воркеры сначала дорабатывают принятые обновления переходящих
+        пользователей, сбрасывают их отложенную запись состояния и удаляют
+        свою копию их user_data. Только после этого меняется кольцо, а
+        придержанные на это время обновления уходят новому воркеру.
+        """
+        async with self.rebalance_lock:
+            worker_id = max(self.workers, default=-1) + 1
+            previous = list(self.workers)
+            self._start_process(worker_id)
+
+            moved = 0
+            if previous:
+                self.next_ring = self.ring.with_node(worker_id)
+                moved = await self._hand_off(previous, sorted(set(self.next_ring.nodes)))
+            self.ring.add_node(worker_id)
+            self.next_ring = None
+            held, self.held = self.held, []
+            for data in held:
+                self._route(data)
+
+            log_event('shard.worker_started', worker_id=worker_id, workers=len(self.workers),
+                      users_moved=moved, updates_held=len(held))
+            return worker_id
+
+    async def _hand_off(self, worker_ids, nodes):
+        """Рассылает воркерам команду передачи пользователей и ждет подтверждений"""
+        self.handoff_seq += 1
+        for worker_id in worker_ids:
+            self._send(worker_id, ('handoff', self.handoff_seq, nodes))
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + SHARD_HANDOFF_TIMEOUT
+        waiting, moved = set(worker_ids), 0
+        while waiting:
+            waiting = {worker_id for worker_id in waiting if self.workers[worker_id][0].is_alive()}
+            remaining = deadline - loop.time()
+            if not waiting or remaining <= 0:
+                break
+            try:
+                seq, worker_id, count = await loop.run_in_executor(
+                    None, self.handoff_replies.get, True, min(remaining, 1)
+                )
+            except QueueEmpty:
+                continue
+            if seq == self.handoff_seq:
+                waiting.discard(worker_id)
+                moved += count
+        if waiting:
+            log_event('shard.handoff_timeout', logging.WARNING, workers=sorted(waiting))
+        return moved
+
+    def _route(self, data):
+        user_id = update_user_id(data)
+        worker_id = self.ring.get_node(user_id)
+        # Пользователь переходит к новому воркеру - ждем, пока прежний отдаст его состояние
+        if self.next_ring is not None and self.next_ring.get_node(user_id) != worker_id:
+            self.held.append(data)
+        else:
+            self._send(worker_id, data)
+
+    async def submit(self, data):
+        self._route(data)
+
+    def pending(self):
+        """Обновления, отправленные воркерам и еще не прочитанные ими, плюс придержанные"""
+        return len(self.held) + sum(
+            self.submitted[worker_id] - consumed.value for worker_id, (_, _, consumed) in self.workers.items()
+        )
+
+    def restart_worker(self, worker_id):
+        """Запускает упавший воркер заново с новой очередью.
+
+        Упавший процесс мог держать блокировку чтения своей очереди, поэтому
+        старая очередь не переиспользуется; то, что из нее удается забрать
+        без блокировки, переносится в новую.
+        """
+        process, queue, _ = self.workers[worker_id]
+        backlog = []
+        with contextlib.suppress(QueueEmpty, OSError, EOFError):
+            while True:
+                backlog.append(queue.get_nowait())
+        queue.close()
+        queue.cancel_join_thread()
+        log_event('shard.worker_restarted', logging.ERROR, worker_id=worker_id, exitcode=process.exitcode,
+                  recovered=len(backlog))
+        self._start_process(worker_id, backlog)
+
+    async def supervise(self, interval=5):
+        """Перезапускает упавшие воркеры; их пользователи остаются за ними"""
+        while True:
+            await asyncio.sleep(interval)
+            for worker_id, (process, _, _) in list(self.workers.items()):
+                if not process.is_alive():
+                    self.restart_worker(worker_id)
+
+    def stop(self):
+        for worker_id in self.workers:
+            self._send(worker_id, None)
+        for process, _, _ in self.workers.values():
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+
+def run_shard_worker(worker_id, queue, consumed, handoff_replies):
+    """Точка входа процесса-воркера"""
+    # Останавливает воркер маршрутизатор (через очередь), а не сигнал терминала
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    asyncio.run(shard_worker_main(worker_id, queue, consumed, handoff_replies))
+
+async def hand_off_users(application, worker_id, nodes):
+    """Отдает пользователей, которые по новому кольцу принадлежат другим воркерам.
+
+    Дожидается уже принятых обновлений этих пользователей, записывает
+    отложенное состояние в хранилище и удаляет их данные из памяти воркера.
+    Возвращает число переданных пользователей.
+    """
+    ring = HashRing(SHARD_VIRTUAL_NODES)
+    for node in nodes:
+        ring.add_node(node)
+
+    # Обновления, уже переданные приложению, должны дойти до очереди пользователя
+    while not application.update_queue.empty():
+        await asyncio.sleep(0.01)
+    await asyncio.sleep(0)
+
+    moved = [user_id for user_id in list(application.user_data) if ring.get_node(user_id) != worker_id]
+    await application.update_processor.wait_idle(moved)
+    if _state_store is not None:
+        await asyncio.to_thread(_state_store.flush)
+    for user_id in moved:
+        application.drop_user_data(user_id)
+        application.drop_chat_data(user_id)
+    return len(moved)
+
+async def shard_worker_main(worker_id, queue, consumed, handoff_replies):
+    """Обрабатывает обновления, которые маршрутизатор направил этому воркеру"""
+    start_analysis_pool()
+    application = setup_application()
+    loop = asyncio.get_running_loop()
+    submit = application_submitter(application)
+
+    async with application:
+        await application.start()
+        await start_metrics_server(worker_id + 1)
+        while True:
+            data = await loop.run_in_executor(None, queue.get)
+            consumed.value += 1
+            if data is None:
+                break
+            if isinstance(data, tuple):
+                _, seq, nodes = data
+                handoff_replies.put((seq, worker_id, await hand_off_users(application, worker_id, nodes)))
+                continue
+            await submit(data)
+        await application.stop()
+
+    # Процесс multiprocessing завершается без atexit - дописываем состояние явно
+    if _state_store is not None:
+        _state_store.close()
+
+async def poll_updates_into(bot, submit_update):
+    """Long polling в маршрутизаторе: получает обновления и передает их дальше"""
+    offset = None
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=Update.ALL_TYPES)
+        except NetworkError as e:
+            log_event('polling.failed', logging.WARNING, error=str(e))
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            await submit_update(update.to_dict())
+            offset = update.update_id + 1
+
+async def run_sharded_mode(workers):
+    """Маршрутизатор + N воркеров. SIGUSR1 добавляет еще один воркер."""
+    router = ShardRouter(SHARD_VIRTUAL_NODES)
+    for _ in range(workers):
+        await router.add_worker()
+
+    tasks = [asyncio.create_task(router.supervise())]
+    loop = asyncio.get_running_loop()
+    try:
+        loop.add_signal_handler(signal.SIGUSR1, lambda: tasks.append(asyncio.create_task(router.add_worker())))
+    except (NotImplementedError, AttributeError, RuntimeError):
+        pass
+
+    METRICS.register(CallbackMetric('balance_router_pending_updates', 'Обновления в очередях воркеров', router.pending))
+    await start_metrics_server()
+
+    server = None
+    async with Bot(TELEGRAM_BOT_TOKEN, base_url=TELEGRAM_API_URL, base_file_url=TELEGRAM_FILE_URL) as bot:
+        if BOT_MODE == 'webhook':
+            server = await start_http_server({
+                ('POST', WEBHOOK_PATH): webhook_handler(router.submit, router.pending),
+                ('GET', '/healthz'): health_handler,
+            }, WEBHOOK_LISTEN, WEBHOOK_PORT)
+            if WEBHOOK_URL:
+                await register_webhook(bot)
+        else:
+            tasks.append(asyncio.create_task(poll_updates_into(bot, router.submit)))
+
+        await wait_for_shutdown()
+
+        for task in tasks:
+            task.cancel()
+        if server is not None:
+            server.close()
+            await server.wait_closed()
+    router.stop()
+
 async def main():
     """Основная асинхронная функция"""
     print("🔧 Инициализация бота...")
@@ -1504,11 +4268,17 @@ async def main():
     print("   • Экспорт в TXT")
     print("   • Специализированные анализы")
     print("   • Полный финансовый анализ")
-    print("🌐 Режим: POLLING")
+    print(f"🌐 Режим: {BOT_MODE.upper()}")
     print("🚀 Бот готов к работе!")
     
-    # Запускаем бота в режиме polling
-    await application.run_polling()
+    # Запускаем бота в выбранном режиме
+    if BOT_WORKERS > 1:
+        print(f"🧩 Воркеров: {BOT_WORKERS} (шардирование по user_id)")
+        await run_sharded_mode(BOT_WORKERS)
+    elif BOT_MODE == 'webhook':
+        await run_webhook_mode(application)
+    else:
+        await run_polling_mode(application)
 
 # === ЗАПУСК ПРИЛОЖЕНИЯ ===
 if __name__ == '__main__':
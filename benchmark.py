@@ -0,0 +1,430 @@
+"""Бенчмарк конвейера анализа на синтетических книгах.
+
+Генерирует книги в формате /sample (столбец "Наименование показателя" и
+столбцы дат), масштабируя число строк, периодов, листов и долю "шумных"
+названий, замеряет время и пиковую память каждой функции конвейера,
+пиковый RSS разбора одной загрузки (в отдельном процессе) и сохраняет
+результаты в JSON. Сравнение с сохраненным прогоном:
+
+    python benchmark.py                                   # все сценарии
+    python benchmark.py --scenarios small --repeat 3
+    python benchmark.py --scenarios logging               # цена логирования, 5000 строк
+    python benchmark.py --output base.json
+    python benchmark.py --compare base.json --threshold 1.2
+"""
+import os
+import io
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import calendar
+import platform
+import statistics
+import subprocess
+import tempfile
+import contextlib
+import tracemalloc
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '123456:BENCHMARK')
+os.environ.setdefault('STATE_BACKEND', 'memory')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+import numpy as np
+import pandas as pd
+import openpyxl
+
+import balance_analyzer as ba
+
+# Названия строк как в /sample и в типовой отчетности; значения - порядок величины
+BASE_ITEMS = [
+    ('Выручка', 1_000_000), ('Себестоимость продаж', 700_000), ('Валовая прибыль', 300_000),
+    ('Коммерческие расходы', 60_000), ('Управленческие расходы', 50_000),
+    ('Прибыль от продаж', 190_000), ('Прибыль до налогообложения', 180_000),
+    ('Чистая прибыль', 150_000), ('Основные средства', 450_000), ('Нематериальные активы', 20_000),
+    ('Внеоборотные активы', 480_000), ('Запасы', 120_000), ('Дебиторская задолженность', 80_000),
+    ('Денежные средства', 40_000), ('Оборотные активы', 270_000), ('Итого активы', 750_000),
+    ('Уставный капитал', 300_000), ('Нераспределенная прибыль', 120_000), ('Капитал', 420_000),
+    ('Долгосрочные обязательства', 100_000), ('Краткосрочные обязательства', 230_000),
+    ('Кредиторская задолженность', 150_000), ('Заемные средства', 80_000),
+]
+
+# Строки, которые не должны распознаваться как статьи
+FILLER_ITEMS = [
+    'Прочие доходы и расходы', 'Справочно', 'Расшифровка', 'Примечание к строке',
+    'Отложенные налоговые активы', 'Резервы под обесценение', 'Итого по разделу',
+]
+
+SCENARIOS = {
+    'small': {'rows': 30, 'periods': 3, 'sheets': 1, 'noise': 0.1},
+    'medium': {'rows': 1000, 'periods': 8, 'sheets': 2, 'noise': 0.3},
+    'large': {'rows': 10000, 'periods': 12, 'sheets': 3, 'noise': 0.3},
+    'wide': {'rows': 500, 'periods': 60, 'sheets': 1, 'noise': 0.2},
+    # Сотни помесячных столбцов с заголовками разных форматов (PERIOD_PATTERN)
+    'monthly': {'rows': 200, 'periods': 360, 'sheets': 1, 'noise': 0.2, 'headers': 'mixed'},
+    # Разбор загрузки на 5000 строк при разных настройках логирования (log_levels)
+    'logging': {'rows': 5000, 'periods': 4, 'sheets': 1, 'noise': 0.3, 'log_levels': True},
+}
+
+# Настройки логирования для сценариев с log_levels: (уровень, доля DEBUG-событий)
+LOG_CONFIGS = {
+    'warning': (logging.WARNING, 0.01),
+    'info': (logging.INFO, 0.01),
+    'debug_sampled': (logging.DEBUG, 0.01),
+    'debug_all': (logging.DEBUG, 1.0),
+}
+
+
+def noisy_label(name, rng, noise):
+    """Название с "шумом": регистр, пробелы, коды строк, пояснения, посторонние строки"""
+    if rng.random() >= noise:
+        return name
+    variant = rng.randrange(6)
+    if variant == 0:
+        return name.upper()
+    if variant == 1:
+        return f"  {name.lower()}  "
+    if variant == 2:
+        return f"{rng.randrange(1100, 2500)} {name}"
+    if variant == 3:
+        return f"{name} (тыс. руб.)"
+    if variant == 4:
+        return f"в т.ч. {name.lower()}"
+    return rng.choice(FILLER_ITEMS)
+
+
+def month_header(year, month, index):
+    """Заголовок конца месяца в одном из форматов отчетности, по очереди"""
+    day = calendar.monthrange(year, month)[1]
+    if month == 12:
+        return f"За {year} год"
+    if month % 3 == 0 and index % 2:
+        return f"{month // 3} квартал {year} г."
+    variant = index % 4
+    if variant == 0:
+        return f"{day:02d}.{month:02d}.{year}"
+    if variant == 1:
+        return f"{year}-{month:02d}-{day:02d}"
+    if variant == 2:
+        return f"На {day:02d}.{month:02d} {year} г."
+    return f"{day:02d}/{month:02d}/{year}"
+
+
+def period_headers(periods, style='annual'):
+    """Заголовки периодов, начиная с более ранних.
+
+    annual - годовые даты 31.12.YYYY; mixed - концы месяцев в разных
+    форматах (полная дата, "на DD.MM YYYY г.", квартал, "за YYYY год").
+    """
+    last_year = datetime.now().year - 1
+    if style == 'annual':
+        return [f"31.12.{year}" for year in range(last_year - periods + 1, last_year + 1)]
+    first_year = last_year - (periods - 1) // 12
+    months = [(first_year + idx // 12, idx % 12 + 1) for idx in range(periods)]
+    return [month_header(year, month, idx) for idx, (year, month) in enumerate(months)]
+
+
+def generate_sheet_rows(rows, periods, noise, rng, headers='annual'):
+    headers = ['Наименование показателя'] + period_headers(periods, headers)
+    data = [headers]
+    for idx in range(rows):
+        name, scale = BASE_ITEMS[idx % len(BASE_ITEMS)]
+        growth = rng.uniform(0.95, 1.15)
+        values = [round(scale * growth ** step * rng.uniform(0.9, 1.1)) for step in range(periods)]
+        data.append([noisy_label(name, rng, noise)] + values)
+    return data
+
+
+def generate_workbook(rows, periods, sheets, noise, seed=0, headers='annual'):
+    """Синтетическая книга .xlsx в формате /sample; возвращает bytes"""
+    rng = random.Random(seed)
+    workbook = openpyxl.Workbook(write_only=True)
+    for sheet in range(sheets):
+        worksheet = workbook.create_sheet('Отчетность по периодам' if sheet == 0 else f"Лист {sheet + 1}")
+        for row in generate_sheet_rows(rows, periods, noise, rng, headers):
+            worksheet.append(row)
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+    return buffer.getvalue()
+
+
+def extract_financial_data_by_period_loop(df, periods):
+    """Прежняя построчная реализация extract_financial_data_by_period - эталон для сравнения.
+
+    Обход строк через iloc и pd.to_numeric на каждую ячейку, как до
+    векторизации (без печати каждой ячейки, чтобы замерять сам обход).
+    """
+    financial_data = {period['formatted']: {} for period in periods}
+    indicator_column = ba.find_indicator_column(df.columns)
+    if not indicator_column:
+        return financial_data
+
+    for row_idx in range(len(df)):
+        indicator_name = str(df[indicator_column].iloc[row_idx]).strip()
+        if not indicator_name or indicator_name in ['Актив', 'Пассив', 'Наименование показателя']:
+            continue
+        item = ba.find_balance_item(indicator_name, [indicator_name])
+        if item:
+            for period in periods:
+                value = pd.to_numeric(df[period['column']].iloc[row_idx], errors='coerce')
+                if not pd.isna(value) and value != 0:
+                    financial_data[period['formatted']][item] = value
+    return financial_data
+
+
+def measure(func, repeat, setup=None):
+    """Время (мс, по repeat запускам) и пик памяти (КБ, отдельным запуском под tracemalloc)"""
+    timings = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        started_at = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - started_at) * 1000)
+
+    if setup:
+        setup()
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'median_ms': round(statistics.median(timings), 3),
+        'min_ms': round(min(timings), 3),
+        'peak_kb': round(peak / 1024, 1),
+    }
+
+
+def max_rss_mb():
+    """Пиковый RSS процесса, МБ (ru_maxrss: КБ в Linux, байты в macOS)"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def upload_rss_child(path, mode):
+    """Выполняется в отдельном процессе: один разбор загрузки, как его делает бот.
+
+    mode: path - файл на диске (крупная загрузка), bytes - содержимое в памяти.
+    Печатает JSON с пиком RSS после импорта модулей и после разбора.
+    """
+    before = max_rss_mb()
+    source = path
+    if mode == 'bytes':
+        with open(path, 'rb') as f:
+            source = f.read()
+    ba.parse_financial_file(source, 'benchmark.xlsx')
+    after = max_rss_mb()
+    print(json.dumps({'baseline_mb': round(before, 1), 'peak_mb': round(after, 1),
+                      'growth_mb': round(after - before, 1)}))
+
+
+def measure_upload_rss(workbook):
+    """Прирост пикового RSS за разбор одной загрузки (файлом и байтами), каждый - в новом процессе.
+
+    Пик RSS процесса не сбрасывается, поэтому разбор в самом бенчмарке не
+    показал бы память отдельной загрузки.
+    """
+    if resource is None:
+        return None
+    fd, path = tempfile.mkstemp(suffix='.xlsx')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(workbook)
+        results = {}
+        for mode in ('path', 'bytes'):
+            completed = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--upload-rss', path, mode],
+                capture_output=True, text=True, check=True,
+            )
+            results[mode] = json.loads(completed.stdout.strip().splitlines()[-1])
+        return results
+    finally:
+        os.remove(path)
+
+
+@contextlib.contextmanager
+def log_config(level, sample_rate):
+    """Временные уровень и доля событий логгера бота; записи JSON уходят в /dev/null"""
+    formatter, sample = ba._log_handler.formatter, ba.LOG_SAMPLE_RATE
+    with open(os.devnull, 'w') as devnull:
+        stream = ba._log_handler.setStream(devnull)
+        ba._log_handler.setFormatter(ba.JsonLogFormatter())
+        ba.logger.setLevel(level)
+        ba.LOG_SAMPLE_RATE = sample_rate
+        try:
+            yield
+        finally:
+            ba.logger.setLevel(logging.NOTSET)
+            ba.LOG_SAMPLE_RATE = sample
+            ba._log_handler.setFormatter(formatter)
+            ba._log_handler.setStream(stream)
+
+
+def run_scenario(params, repeat, seed):
+    params = dict(params)
+    log_levels = params.pop('log_levels', False)
+    workbook = generate_workbook(seed=seed, **params)
+    file_name = 'benchmark.xlsx'
+    results = {'workbook_kb': round(len(workbook) / 1024, 1)}
+
+    df = ba.read_excel_file(workbook, file_name)
+    periods = ba.detect_periods(df)
+    labels = [str(label) for label in df[ba.find_indicator_column(df.columns)]]
+    periods_data = ba.extract_financial_data_by_period(df, periods)
+    periods_ratios = ba.calculate_periods_ratios(periods_data)
+
+    def classify_all():
+        for label in labels:
+            ba.find_balance_item(label, df.columns)
+
+    def ratios_by_period():
+        for data in periods_data.values():
+            ba.calculate_financial_ratios_for_period(data)
+
+    cases = {
+        'read_excel_file': (lambda: ba.read_excel_file(workbook, file_name), None),
+        'detect_periods': (lambda: ba.detect_periods(df), ba.parse_period_header.cache_clear),
+        # Холодный кэш классификатора: каждое название разбирается заново
+        'find_balance_item': (classify_all, ba.classify_balance_item.cache_clear),
+        'extract_financial_data_by_period': (lambda: ba.extract_financial_data_by_period(df, periods), None),
+        'extract_financial_data_by_period_loop': (lambda: extract_financial_data_by_period_loop(df, periods), None),
+        'calculate_financial_ratios_for_period': (ratios_by_period, None),
+        'calculate_periods_ratios': (lambda: ba.calculate_periods_ratios(periods_data), None),
+        'generate_period_analysis_report': (
+            lambda: ba.generate_period_analysis_report(periods_data, periods_ratios), None),
+        'generate_liquidity_analysis_report': (
+            lambda: ba.generate_liquidity_analysis_report(periods_data, periods_ratios), None),
+        'generate_profitability_analysis_report': (
+            lambda: ba.generate_profitability_analysis_report(periods_data, periods_ratios), None),
+        'generate_stability_analysis_report': (
+            lambda: ba.generate_stability_analysis_report(periods_data, periods_ratios), None),
+        'generate_forecast_report': (
+            lambda: ba.generate_forecast_report(periods_data, periods_ratios), None),
+        'generate_selective_analysis_report': (
+            lambda: ba.generate_selective_analysis_report(periods_data, set(ba.INDICATOR_GROUPS)), None),
+        'build_industry_comparison_report': (
+            lambda: ba.build_industry_comparison_report(periods_data, ba.INDUSTRY_STANDARDS['retail'], periods_ratios),
+            None),
+        'parse_financial_file': (lambda: ba.parse_financial_file(workbook, file_name), None),
+    }
+
+    for name, (func, setup) in cases.items():
+        results[name] = measure(func, repeat, setup)
+    if log_levels:
+        # Построчные события пишет извлечение данных; полный разбор - цена для всей загрузки
+        for config, (level, sample_rate) in LOG_CONFIGS.items():
+            with log_config(level, sample_rate):
+                results[f'extract_financial_data_by_period[log={config}]'] = measure(
+                    lambda: ba.extract_financial_data_by_period(df, periods), repeat)
+                results[f'parse_financial_file[log={config}]'] = measure(
+                    lambda: ba.parse_financial_file(workbook, file_name), repeat)
+    results['upload_rss'] = measure_upload_rss(workbook)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current, baseline, threshold):
+    """Печатает сравнение медиан; возвращает число регрессий (замедление больше threshold раз)"""
+    regressions = 0
+    print(f"\n{'сценарий / функция':<64} {'было, мс':>10} {'стало, мс':>10} {'x':>7}")
+    for scenario, results in current['results'].items():
+        base_results = baseline['results'].get(scenario)
+        if not base_results:
+            continue
+        for name, result in results.items():
+            base = base_results.get(name)
+            if not isinstance(result, dict) or not isinstance(base, dict) or not base.get('median_ms') \
+                    or 'median_ms' not in result:
+                continue
+            ratio = result['median_ms'] / base['median_ms']
+            # Совсем короткие замеры слишком шумные, чтобы считать их регрессией
+            flag = ratio > threshold and result['median_ms'] > 0.5
+            regressions += flag
+            print(f"{scenario + ' / ' + name:<64} {base['median_ms']:>10.2f} {result['median_ms']:>10.2f} "
+                  f"{ratio:>6.2f}{' ⚠️' if flag else ''}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenarios', nargs='+', choices=sorted(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None,
+                        help='куда сохранить результаты (по умолчанию temp_files/benchmarks/<коммит>.json)')
+    parser.add_argument('--compare', metavar='BASELINE', help='JSON прошлого прогона для сравнения')
+    parser.add_argument('--threshold', type=float, default=1.2, help='допустимое замедление, раз')
+    parser.add_argument('--upload-rss', nargs=2, metavar=('PATH', 'MODE'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.upload_rss:
+        upload_rss_child(*args.upload_rss)
+        return
+
+    commit = git_commit()
+    report = {
+        'meta': {
+            'commit': commit,
+            'created_at': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'cpu_count': os.cpu_count(),
+            'repeat': args.repeat,
+            'seed': args.seed,
+        },
+        'scenarios': {name: SCENARIOS[name] for name in args.scenarios},
+        'results': {},
+    }
+
+    for name in args.scenarios:
+        started_at = time.perf_counter()
+        report['results'][name] = run_scenario(SCENARIOS[name], args.repeat, args.seed)
+        print(f"✅ {name}: {SCENARIOS[name]} за {time.perf_counter() - started_at:.1f} с")
+        for func_name, result in report['results'][name].items():
+            if isinstance(result, dict) and 'median_ms' in result:
+                print(f"   {func_name:<52} {result['median_ms']:>10.2f} мс  {result['peak_kb']:>10.1f} КБ")
+        upload_rss = report['results'][name]['upload_rss']
+        if upload_rss:
+            print(f"   {'пиковый RSS загрузки (файл / байты)':<52} "
+                  f"+{upload_rss['path']['growth_mb']:.1f} / +{upload_rss['bytes']['growth_mb']:.1f} МБ")
+
+    output = args.output or os.path.join('temp_files', 'benchmarks', f"{commit or 'results'}.json")
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"💾 Результаты: {output}")
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.threshold)
+        if regressions:
+            print(f"❌ Регрессий: {regressions}")
+            sys.exit(1)
+        print("✅ Регрессий нет")
+
+
+if __name__ == '__main__':
+    main()
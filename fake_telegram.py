@@ -0,0 +1,404 @@
+"""Сквозной нагрузочный тест без сети: локальная замена Bot API и симуляция пользователей.
+
+FakeBotAPI отвечает на getMe, getUpdates, sendMessage, sendDocument, getFile
+(и скачивание файла) на локальном порту, проверяя длину сообщений и, по
+желанию, темп отправки в чат (429 с retry_after, как flood control). Бот из setup_application()
+работает против нее в режиме polling, а драйвер от имени множества
+пользователей шлет /start, загружает книги и нажимает кнопки анализа,
+дожидаясь ответа бота на каждое действие.
+
+    python fake_telegram.py --users 1000 --parallel 200
+    python fake_telegram.py --users 200 --actions start upload full liquidity export
+    python fake_telegram.py --users 50 --periods 60 --flood-per-chat 3
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import socket
+import argparse
+import itertools
+import collections
+from email.parser import BytesParser
+from urllib.parse import parse_qs, quote
+
+TOKEN = '123456:FAKE-TELEGRAM'
+MESSAGE_LIMIT = 4096  # единиц UTF-16, как в Bot API
+
+
+class FakeAPIError(Exception):
+    """Ответ Bot API с ok=false (error_code, description, parameters)"""
+
+    def __init__(self, code, description, **parameters):
+        super().__init__(description)
+        self.code = code
+        self.description = description
+        self.parameters = parameters
+
+
+class FakeBotAPI:
+    """Минимальная реализация Bot API в памяти.
+
+    Сообщения бота складываются в очередь своего чата (messages_for), откуда
+    их читает драйвер; файлы для getFile регистрируются через add_file.
+    """
+
+    METHODS = (
+        'getMe', 'getUpdates', 'deleteWebhook', 'setWebhook', 'sendMessage', 'sendDocument',
+        'getFile', 'editMessageText', 'sendChatAction', 'answerCallbackQuery', 'setMyCommands',
+        'close', 'logOut',
+    )
+
+    def __init__(self, token=TOKEN, flood_per_chat=0):
+        self.token = token
+        # Сколько сообщений в секунду чат принимает без 429 (0 - без ограничения)
+        self.flood_per_chat = flood_per_chat
+        self.sent_at = collections.defaultdict(collections.deque)
+        self.updates = collections.deque()
+        self.updates_ready = asyncio.Event()
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.chats = collections.defaultdict(asyncio.Queue)
+        self.files = {}
+        self.routes = {}
+        self.calls = collections.Counter()
+        self.server = None
+        self.closing = False
+
+    async def start(self, host='127.0.0.1', port=0):
+        # Тот же минимальный HTTP-сервер, что принимает webhook в боте
+        from balance_analyzer import start_http_server
+
+        for method in self.METHODS:
+            self.routes[('POST', f"/bot{self.token}/{method}")] = self.api_handler(method)
+            self.routes[('GET', f"/bot{self.token}/{method}")] = self.api_handler(method)
+        self.server = await start_http_server(self.routes, host, port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        # Отпускаем висящие long polling запросы, чтобы их обработчики завершились до закрытия
+        self.closing = True
+        self.updates_ready.set()
+        await asyncio.sleep(0.1)
+        self.server.close()
+        await self.server.wait_closed()
+
+    # --- Со стороны пользователей ---
+
+    def push_update(self, kind, payload):
+        update = {'update_id': next(self.update_ids), kind: payload}
+        self.updates.append(update)
+        self.updates_ready.set()
+        return update
+
+    def user_message(self, user_id, text=None, document=None):
+        message = {
+            'message_id': next(self.message_ids),
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f"user{user_id}"},
+        }
+        if text is not None:
+            message['text'] = text
+            if text.startswith('/'):
+                message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        if document is not None:
+            message['document'] = document
+        return self.push_update('message', message)
+
+    def add_file(self, file_id, content, file_name):
+        path = f"documents/{file_id}{os.path.splitext(file_name)[1]}"
+        self.files[file_id] = (path, content)
+
+        async def download(headers, body):
+            return 200, 'application/octet-stream', content
+
+        # PTB экранирует путь файла (двоеточие в токене - %3A)
+        self.routes[('GET', quote(f"/file/bot{self.token}/{path}"))] = download
+        return {
+            'file_id': file_id, 'file_unique_id': f"u{file_id}", 'file_name': file_name,
+            'file_size': len(content),
+            'mime_type': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        }
+
+    def messages_for(self, chat_id):
+        return self.chats[chat_id]
+
+    # --- Со стороны бота ---
+
+    @staticmethod
+    def parse_params(headers, body):
+        content_type = headers.get('content-type', '')
+        if content_type.startswith('multipart/form-data'):
+            message = BytesParser().parsebytes(
+                f"Content-Type: {content_type}\r\n\r\n".encode('latin-1') + body
+            )
+            params = {}
+            for part in message.get_payload():
+                name = part.get_param('name', header='content-disposition')
+                if part.get_filename():
+                    params[name] = {'filename': part.get_filename(), 'size': len(part.get_payload(decode=True))}
+                else:
+                    params[name] = part.get_payload(decode=True).decode('utf-8')
+            return params
+        if content_type.startswith('application/json'):
+            return json.loads(body or b'{}')
+        return {key: values[-1] for key, values in parse_qs(body.decode('utf-8')).items()}
+
+    def api_handler(self, method):
+        async def handle(headers, body):
+            self.calls[method] += 1
+            params = self.parse_params(headers, body)
+            try:
+                result = await getattr(self, f"api_{method}", self.api_default)(params)
+            except FakeAPIError as e:
+                self.calls[f"{method}:{e.code}"] += 1
+                payload = {'ok': False, 'error_code': e.code, 'description': e.description}
+                if e.parameters:
+                    payload['parameters'] = e.parameters
+                return e.code, 'application/json', json.dumps(payload).encode('utf-8')
+            return 200, 'application/json', json.dumps({'ok': True, 'result': result}).encode('utf-8')
+        return handle
+
+    async def api_default(self, params):
+        return True
+
+    async def api_getMe(self, params):
+        return {'id': 1, 'is_bot': True, 'first_name': 'FakeBot', 'username': 'fake_bot',
+                'can_join_groups': False, 'can_read_all_group_messages': False, 'supports_inline_queries': False}
+
+    async def api_getUpdates(self, params):
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        timeout = float(params.get('timeout') or 0)
+
+        while self.updates and self.updates[0]['update_id'] < offset:
+            self.updates.popleft()
+        if not self.updates and timeout and not self.closing:
+            self.updates_ready.clear()
+            try:
+                await asyncio.wait_for(self.updates_ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return list(itertools.islice(self.updates, limit))
+
+    def check_flood(self, chat_id):
+        if not self.flood_per_chat:
+            return
+        now = time.monotonic()
+        sent_at = self.sent_at[chat_id]
+        while sent_at and now - sent_at[0] > 1:
+            sent_at.popleft()
+        if len(sent_at) >= self.flood_per_chat:
+            raise FakeAPIError(429, 'Too Many Requests: retry after 1', retry_after=1)
+        sent_at.append(now)
+
+    def bot_message(self, params, **content):
+        chat_id = int(params['chat_id'])
+        self.check_flood(chat_id)
+        message = {
+            'message_id': next(self.message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': 1, 'is_bot': True, 'first_name': 'FakeBot'},
+            **content,
+        }
+        self.chats[chat_id].put_nowait(message)
+        return message
+
+    async def api_sendMessage(self, params):
+        text = params.get('text', '')
+        if not text.strip():
+            raise FakeAPIError(400, 'Bad Request: message text is empty')
+        if len(text.encode('utf-16-le')) // 2 > MESSAGE_LIMIT:
+            raise FakeAPIError(400, 'Bad Request: message is too long')
+        return self.bot_message(params, text=text)
+
+    async def api_editMessageText(self, params):
+        return self.bot_message(params, text=params.get('text', ''), edited=True)
+
+    async def api_sendDocument(self, params):
+        document = params.get('document') or {}
+        return self.bot_message(params, caption=params.get('caption'), document={
+            'file_id': f"sent{next(self.message_ids)}", 'file_unique_id': 'sent',
+            'file_name': document.get('filename') if isinstance(document, dict) else None,
+            'file_size': document.get('size') if isinstance(document, dict) else None,
+        })
+
+    async def api_getFile(self, params):
+        file_id = params['file_id']
+        path, content = self.files[file_id]
+        return {'file_id': file_id, 'file_unique_id': f"u{file_id}", 'file_size': len(content), 'file_path': path}
+
+
+# --- Драйвер нагрузки ---
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+# Ответы бота, означающие ошибку, и отказы по перегрузке / ограничению частоты
+ERROR_PREFIXES = ('❌', '⌛')
+REJECTED_PREFIXES = ('🚦', '🐢')
+
+# Действие пользователя: что отправить и каким ответом бота оно завершается
+ACTIONS = {
+    'start': ('/start', lambda m: 'ДОБРО ПОЖАЛОВАТЬ' in (m.get('text') or '')),
+    'upload': (None, lambda m: (m.get('text') or '').startswith('✅ Файл успешно обработан')),
+    'full': ('📊 Полный анализ', lambda m: (m.get('text') or '').startswith('✅ Полный анализ завершен')),
+    'liquidity': ('📈 Анализ ликвидности', lambda m: 'ЛИКВИДНОСТ' in (m.get('text') or '').upper()),
+    'forecast': ('🔮 Прогноз тенденций', lambda m: 'ПРОГНОЗ' in (m.get('text') or '').upper()),
+    'export': ('📄 Экспорт в TXT', lambda m: 'document' in m),
+}
+
+
+class LoadStats:
+    def __init__(self):
+        self.latencies = collections.defaultdict(list)
+        self.outcomes = collections.defaultdict(collections.Counter)
+
+    def record(self, action, outcome, latency):
+        self.outcomes[action][outcome] += 1
+        if outcome == 'ok':
+            self.latencies[action].append(latency)
+
+    @staticmethod
+    def percentile(values, share):
+        if not values:
+            return float('nan')
+        values = sorted(values)
+        return values[min(len(values) - 1, int(len(values) * share))]
+
+    def print_report(self, elapsed):
+        total = sum(sum(counter.values()) for counter in self.outcomes.values())
+        ok = sum(counter['ok'] for counter in self.outcomes.values())
+        print(f"\nДействий: {total} за {elapsed:.1f} с, {total / elapsed:.1f} действий/с, "
+              f"успешно {ok} ({ok / max(total, 1):.1%})")
+        print(f"{'действие':<11} {'всего':>7} {'отказы':>7} {'ошибки':>7} {'таймауты':>9} "
+              f"{'p50, мс':>9} {'p90, мс':>9} {'p99, мс':>9}")
+        for action, counter in self.outcomes.items():
+            values = self.latencies[action]
+            print(f"{action:<11} {sum(counter.values()):>7} {counter['rejected']:>7} {counter['error']:>7} "
+                  f"{counter['timeout']:>9} "
+                  f"{self.percentile(values, 0.5) * 1000:>9.0f} {self.percentile(values, 0.9) * 1000:>9.0f} "
+                  f"{self.percentile(values, 0.99) * 1000:>9.0f}")
+
+
+async def perform(api, user_id, action, document, timeout):
+    """Отправляет действие и ждет завершающего ответа бота: 'ok', 'rejected', 'error' или 'timeout'"""
+    text, is_done = ACTIONS[action]
+    inbox = api.messages_for(user_id)
+    while not inbox.empty():
+        inbox.get_nowait()
+
+    if action == 'upload':
+        api.user_message(user_id, document=document)
+    else:
+        api.user_message(user_id, text=text)
+
+    deadline = time.perf_counter() + timeout
+    while True:
+        remaining = deadline - time.perf_counter()
+        if remaining <= 0:
+            return 'timeout'
+        try:
+            message = await asyncio.wait_for(inbox.get(), remaining)
+        except asyncio.TimeoutError:
+            return 'timeout'
+        if is_done(message):
+            return 'ok'
+        text = message.get('text') or ''
+        if text.startswith(REJECTED_PREFIXES):
+            return 'rejected'
+        if text.startswith(ERROR_PREFIXES):
+            return 'error'
+
+
+async def simulate_user(api, user_id, actions, documents, stats, timeout, think_time):
+    document = random.choice(documents)
+    for action in actions:
+        started_at = time.perf_counter()
+        outcome = await perform(api, user_id, action, document, timeout)
+        stats.record(action, outcome, time.perf_counter() - started_at)
+        if think_time:
+            await asyncio.sleep(random.uniform(0, think_time))
+
+
+def prepare_documents(api, count, rows, periods):
+    from benchmark import generate_workbook
+
+    documents = []
+    for idx in range(count):
+        content = generate_workbook(rows=rows, periods=periods, sheets=1, noise=0.2, seed=idx)
+        documents.append(api.add_file(f"file{idx}", content, f"report_{idx}.xlsx"))
+    return documents
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--parallel', type=int, default=200, help='одновременно активных пользователей')
+    parser.add_argument('--actions', nargs='+', choices=list(ACTIONS), default=['start', 'upload', 'full', 'liquidity'])
+    parser.add_argument('--files', type=int, default=20, help='разных книг среди загрузок')
+    parser.add_argument('--rows', type=int, default=200)
+    parser.add_argument('--periods', type=int, default=4)
+    parser.add_argument('--timeout', type=float, default=60, help='ожидание ответа на действие, с')
+    parser.add_argument('--think-time', type=float, default=0.0, help='пауза между действиями, до N с')
+    parser.add_argument('--keep-limits', action='store_true', help='не отключать ограничение частоты запросов')
+    parser.add_argument('--port', type=int, default=0, help='порт Bot API (по умолчанию - свободный)')
+    parser.add_argument('--flood-per-chat', type=float, default=0,
+                        help='сообщений в секунду на чат до ответа 429 (0 - без ограничения)')
+    args = parser.parse_args()
+
+    # Настройки бота читаются при импорте модуля - задаем их до импорта
+    port = args.port or free_port()
+    os.environ['TELEGRAM_BOT_TOKEN'] = TOKEN
+    os.environ['TELEGRAM_API_URL'] = f"http://127.0.0.1:{port}/bot"
+    os.environ['TELEGRAM_FILE_URL'] = f"http://127.0.0.1:{port}/file/bot"
+    os.environ.setdefault('STATE_BACKEND', 'memory')
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    os.environ.setdefault('METRICS_PORT', '0')
+    if not args.keep_limits:
+        for kind in ('MENU', 'ANALYSIS', 'UPLOAD'):
+            os.environ.setdefault(f"RATE_{kind}_BURST", '1000000')
+        # Иначе одновременные загрузки сверх ANALYSIS_WORKERS получают отказ "занято"
+        # и прогон измеряет отказы, а не пропускную способность
+        os.environ.setdefault('MAX_CONCURRENT_PARSES', str(args.parallel))
+        os.environ.setdefault('ANALYSIS_QUEUE_LIMIT', str(args.parallel))
+
+    import balance_analyzer
+
+    api = await FakeBotAPI(flood_per_chat=args.flood_per_chat).start(port=port)
+    documents = prepare_documents(api, args.files, args.rows, args.periods)
+    application = balance_analyzer.setup_application()
+    stats = LoadStats()
+    semaphore = asyncio.Semaphore(args.parallel)
+
+    async def run_user(user_id):
+        async with semaphore:
+            await simulate_user(api, user_id, args.actions, documents, stats, args.timeout, args.think_time)
+
+    async with application:
+        await application.start()
+        await application.updater.start_polling(poll_interval=0, timeout=10)
+
+        started_at = time.perf_counter()
+        await asyncio.gather(*(run_user(user_id) for user_id in range(1, args.users + 1)))
+        elapsed = time.perf_counter() - started_at
+
+        await application.updater.stop()
+        await application.stop()
+
+    await api.stop()
+    stats.print_report(elapsed)
+    print(f"Вызовы Bot API: {dict(api.calls)}")
+    errors = sum(counter['error'] + counter['timeout'] for counter in stats.outcomes.values())
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,166 @@
+"""Нагрузочный тест обработки обновлений.
+
+Прогоняет через Application поток сообщений от множества пользователей и
+сравнивает последовательную обработку с PerUserUpdateProcessor. Обработчик
+имитирует запрос к Telegram задержкой и проверяет, что сообщения каждого
+пользователя обрабатываются в порядке отправки. С --flood первый пользователь
+до всех остальных присылает пачку сообщений, и задержка остальных
+пользователей считается отдельно: флуд не должен занимать общие слоты.
+
+    python load_test.py --users 200 --messages 10 --delay-ms 20
+    python load_test.py --users 50 --messages 2 --flood 500 --concurrency 64 --skip-sequential
+"""
+import os
+import json
+import time
+import random
+import asyncio
+import argparse
+from datetime import datetime, timezone
+
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '123456:LOAD-TEST')
+
+from telegram import Update, Message, Chat, User
+from telegram.ext import Application, MessageHandler, filters
+from telegram.request import BaseRequest
+
+from balance_analyzer import PerUserUpdateProcessor
+
+
+class OfflineRequest(BaseRequest):
+    """Отвечает на getMe локально, чтобы Application инициализировался без сети"""
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        result = True
+        if url.endswith('/getMe'):
+            result = {'id': 123456, 'is_bot': True, 'first_name': 'LoadTest', 'username': 'load_test_bot'}
+        return 200, json.dumps({'ok': True, 'result': result}).encode('utf-8')
+
+
+def make_update(update_id, user_id, seq, now):
+    user = User(user_id, f"user{user_id}", False)
+    message = Message(update_id, now, Chat(user_id, Chat.PRIVATE), from_user=user, text=str(seq))
+    return Update(update_id, message=message)
+
+
+def make_updates(users, messages, flood=0):
+    """Сообщения вида 'seq' от каждого пользователя, перемешанные между пользователями.
+
+    flood сообщений пользователя 1 идут подряд в самом начале потока.
+    """
+    now = datetime.now(timezone.utc)
+    queues = [
+        [(user_id, seq) for seq in range(flood if user_id == 1 else 0, messages + (flood if user_id == 1 else 0))]
+        for user_id in range(1, users + 1)
+    ]
+    updates = [make_update(seq + 1, 1, seq, now) for seq in range(flood)]
+    update_id = flood
+    while any(queues):
+        queue = random.choice([q for q in queues if q])
+        user_id, seq = queue.pop(0)
+        update_id += 1
+        updates.append(make_update(update_id, user_id, seq, now))
+    return updates
+
+
+async def run(concurrent_updates, updates, delay):
+    violations = 0
+    latencies = []
+    other_latencies = []
+    sent_at = {}
+
+    async def handler(update, context):
+        nonlocal violations
+        seq = int(update.message.text)
+        # Тот же порядок, в котором пользователь отправлял сообщения
+        if seq != context.user_data.get('next_seq', 0):
+            violations += 1
+        await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+        context.user_data['next_seq'] = seq + 1
+        latency = time.perf_counter() - sent_at[update.update_id]
+        latencies.append(latency)
+        if update.effective_user.id != 1:
+            other_latencies.append(latency)
+
+    application = (
+        Application.builder()
+        .token(os.environ['TELEGRAM_BOT_TOKEN'])
+        .updater(None)
+        .request(OfflineRequest())
+        .get_updates_request(OfflineRequest())
+        .concurrent_updates(concurrent_updates)
+        .build()
+    )
+    application.add_handler(MessageHandler(filters.TEXT, handler))
+
+    async with application:
+        started = time.perf_counter()
+        for update in updates:
+            sent_at[update.update_id] = time.perf_counter()
+        # Так же, как Application.start: при параллельной обработке каждое
+        # обновление - отдельная задача через update_processor
+        if application.update_processor.max_concurrent_updates > 1:
+            await asyncio.gather(*(
+                application.update_processor.process_update(update, application.process_update(update))
+                for update in updates
+            ))
+        else:
+            for update in updates:
+                await application.process_update(update)
+        elapsed = time.perf_counter() - started
+
+    return {
+        'elapsed': elapsed,
+        'throughput': len(updates) / elapsed,
+        'p50': percentile(latencies, 0.5),
+        'p99': percentile(latencies, 0.99),
+        'others_p50': percentile(other_latencies, 0.5),
+        'others_p99': percentile(other_latencies, 0.99),
+        'violations': violations,
+    }
+
+
+def percentile(values, share):
+    """Перцентиль в мс (0, если значений нет)"""
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))] * 1000
+
+
+def print_result(title, result):
+    print(f"{title:<32} {result['elapsed']:7.2f} с  {result['throughput']:8.1f} обн/с  "
+          f"p50 {result['p50']:8.1f} мс  p99 {result['p99']:8.1f} мс  "
+          f"остальные p50 {result['others_p50']:8.1f} мс  p99 {result['others_p99']:8.1f} мс  "
+          f"нарушений порядка: {result['violations']}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--messages', type=int, default=10, help='сообщений от каждого пользователя')
+    parser.add_argument('--delay-ms', type=float, default=20, help='средняя длительность обработки')
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--flood', type=int, default=0, help='сообщений пользователя 1 подряд в начале потока')
+    parser.add_argument('--skip-sequential', action='store_true')
+    args = parser.parse_args()
+
+    updates = make_updates(args.users, args.messages, args.flood)
+    delay = args.delay_ms / 1000
+    print(f"Пользователей: {args.users}, обновлений: {len(updates)}, задержка ~{args.delay_ms} мс")
+
+    if not args.skip_sequential:
+        print_result("Последовательно (1)", await run(1, updates, delay))
+    print_result(f"По пользователям ({args.concurrency})",
+                 await run(PerUserUpdateProcessor(args.concurrency), updates, delay))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
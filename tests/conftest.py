@@ -0,0 +1,11 @@
+"""Общие настройки тестов: окружение задается до импорта balance_analyzer"""
+import os
+import sys
+
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '123456:TEST')
+os.environ.setdefault('STATE_BACKEND', 'memory')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+os.environ.setdefault('METRICS_PORT', '0')
+os.environ.setdefault('ANALYSIS_EXECUTOR', 'thread')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,49 @@
+"""Пул вычислений: место в очереди занято, пока задача выполняется в воркере"""
+import asyncio
+import threading
+
+import pytest
+
+import balance_analyzer as ba
+
+
+def wait_for_event(event):
+    event.wait(5)
+    return 'done'
+
+
+def test_timed_out_job_keeps_its_slot(monkeypatch):
+    monkeypatch.setattr(ba, 'ANALYSIS_JOB_TIMEOUT', 0.05)
+    monkeypatch.setattr(ba, 'ANALYSIS_WORKERS', 1)
+    monkeypatch.setattr(ba, 'ANALYSIS_QUEUE_LIMIT', 0)
+    event = threading.Event()
+
+    async def scenario():
+        with pytest.raises(asyncio.TimeoutError):
+            await ba.run_in_analysis_pool(wait_for_event, event)
+        assert ba._analysis_jobs_in_flight == 1
+
+        # Прерванная задача еще выполняется - новой задаче места нет
+        with pytest.raises(ba.AnalysisQueueFull):
+            await ba.run_in_analysis_pool(len, 'abc')
+
+        event.set()
+        for _ in range(100):
+            if ba._analysis_jobs_in_flight == 0:
+                break
+            await asyncio.sleep(0.01)
+        assert ba._analysis_jobs_in_flight == 0
+        assert await ba.run_in_analysis_pool(len, 'abc') == 3
+        assert ba._analysis_jobs_in_flight == 0
+
+    asyncio.run(scenario())
+
+
+def test_failed_job_releases_slot():
+    async def scenario():
+        with pytest.raises(ZeroDivisionError):
+            await ba.run_in_analysis_pool(divmod, 1, 0)
+        await asyncio.sleep(0)
+        assert ba._analysis_jobs_in_flight == 0
+
+    asyncio.run(scenario())
@@ -0,0 +1,102 @@
+"""Добавление периодов: объединение данных и перенос готовых отчетов в кэше"""
+import copy
+
+import pytest
+
+import balance_analyzer as ba
+
+
+def balance(scale):
+    return {
+        'выручка': 1000.0 * scale, 'чистая прибыль': 100.0 * scale, 'активы всего': 2000.0 * scale,
+        'оборотные активы': 800.0 * scale, 'краткосрочные обязательства': 400.0 * scale,
+        'капитал': 1200.0 * scale, 'денежные средства': 150.0 * scale, 'запасы': 300.0 * scale,
+    }
+
+
+@pytest.fixture
+def report_cache(monkeypatch):
+    cache = ba.ContentCache(1000, 3600)
+    monkeypatch.setattr(ba, 'REPORT_CACHE', cache)
+    return cache
+
+
+def test_merge_keeps_inputs_and_sorts_periods():
+    old = {'31.12.2022': balance(1), '31.12.2020': balance(0.5)}
+    new = {'31.12.2021': balance(0.8), '31.12.2019': {}}
+    frozen_old, frozen_new = copy.deepcopy(old), copy.deepcopy(new)
+
+    merged, ratios, affected = ba.merge_appended_periods(old, ba.calculate_periods_ratios(old), new)
+
+    assert old == frozen_old and new == frozen_new
+    assert affected == ['31.12.2021']
+    assert list(merged) == ['31.12.2020', '31.12.2021', '31.12.2022']
+    assert merged == {**old, '31.12.2021': new['31.12.2021']}
+    assert ratios == ba.calculate_periods_ratios(merged)
+
+
+def test_merge_updates_existing_period_with_new_values():
+    old = {'31.12.2022': balance(1)}
+    new = {'31.12.2022': {'выручка': 5000.0, 'валовая прибыль': 900.0}}
+
+    merged, ratios, affected = ba.merge_appended_periods(old, ba.calculate_periods_ratios(old), new)
+
+    assert affected == ['31.12.2022']
+    assert merged['31.12.2022'] == {**balance(1), 'выручка': 5000.0, 'валовая прибыль': 900.0}
+    assert ratios == ba.calculate_periods_ratios(merged)
+
+
+def test_merge_keeps_order_of_unknown_period_names():
+    old = {'прошлый': balance(1)}
+    merged, _, _ = ba.merge_appended_periods(old, ba.calculate_periods_ratios(old), {'31.12.2020': balance(2)})
+    assert list(merged) == ['прошлый', '31.12.2020']
+
+
+def test_merge_reuses_ratios_of_untouched_periods():
+    old = {'31.12.2021': balance(1), '31.12.2022': balance(2)}
+    old_ratios = {**ba.calculate_periods_ratios(old), '31.12.2021': {'маркер': 1.0}}
+
+    _, ratios, _ = ba.merge_appended_periods(old, old_ratios, {'31.12.2023': balance(3)})
+
+    assert ratios['31.12.2021'] == {'маркер': 1.0}
+    assert ratios['31.12.2023'] == ba.calculate_periods_ratios({'p': balance(3)})['p']
+
+
+def put_reports(old_key, periods_data, groups):
+    ba.REPORT_CACHE.put((old_key, 'liquidity'), ba.generate_liquidity_analysis_report(periods_data))
+    for group_set in groups:
+        group_set = ba.ordered_groups(group_set)
+        ba.REPORT_CACHE.put((old_key, 'selective', group_set),
+                            ba.generate_selective_analysis_report(periods_data, list(group_set)))
+
+
+def test_carry_over_only_untouched_reports(report_cache):
+    old = {'31.12.2021': balance(1), '31.12.2022': balance(2)}
+    put_reports('old', old, [{'Ликвидность'}, {'Выручка и прибыль'}])
+    report_cache.put(('other', 'liquidity'), 'чужой отчет')
+
+    # Новые значения только статей выручки за уже загруженный период
+    new = {'31.12.2021': {'выручка': 1500.0}}
+    merged, ratios, affected = ba.merge_appended_periods(old, ba.calculate_periods_ratios(old), new)
+    carried = ba.carry_over_reports('old', 'new', {'выручка'}, last_period_changed=False)
+
+    assert carried == 1
+    carried_keys = [key for key, _ in report_cache.items() if key[0] == 'new']
+    assert carried_keys == [('new', 'selective', ('Ликвидность',))]
+    assert report_cache.get(carried_keys[0]) == ba.generate_selective_analysis_report(merged, ['Ликвидность'])
+
+
+def test_new_last_period_invalidates_last_period_reports(report_cache):
+    old = {'31.12.2021': balance(1)}
+    put_reports('old', old, [{'Ликвидность'}])
+
+    carried = ba.carry_over_reports('old', 'new', set(), last_period_changed=True)
+
+    assert carried == 1
+    assert report_cache.get(('new', 'liquidity')) is None
+    assert report_cache.get(('new', 'selective', ('Ликвидность',))) is not None
+
+
+def test_unknown_report_kind_is_never_carried(report_cache):
+    report_cache.put(('old', 'новый вид'), 'отчет')
+    assert ba.carry_over_reports('old', 'new', set(), last_period_changed=False) == 0
@@ -0,0 +1,136 @@
+"""Пакетный анализ: состав zip-архива, разбор книги компании и рейтинг"""
+import io
+import zipfile
+
+import openpyxl
+import pytest
+
+import balance_analyzer as ba
+
+
+def make_zip(entries):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        for name, data in entries:
+            zip_file.writestr(name, data, compress_type=zipfile.ZIP_DEFLATED)
+    return buffer.getvalue()
+
+
+def with_cp866_names(archive, names):
+    """Имена в cp866 без флага UTF-8, как пишут архиваторы Windows (zipfile прочтет их как cp437)"""
+    for name in names:
+        encoded = name.encode('cp866')
+        archive = archive.replace(b'N' * len(encoded), encoded)
+    return archive
+
+
+def make_workbook(rows):
+    workbook = openpyxl.Workbook()
+    for row in rows:
+        workbook.active.append(row)
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+    return buffer.getvalue()
+
+
+def test_members_skip_junk_entries():
+    archive = make_zip([
+        ('Альфа.xlsx', b'x'),
+        ('отчеты/Бета.XLS', b'x'),
+        ('__MACOSX/отчеты/._Бета.xls', b'x'),
+        ('отчеты/~$Альфа.xlsx', b'x'),
+        ('.hidden.xlsx', b'x'),
+        ('readme.txt', b'x'),
+        ('папка/', b''),
+    ])
+    assert ba.list_batch_members(archive) == [('Альфа', 'Альфа.xlsx'), ('Бета', 'отчеты/Бета.XLS')]
+
+
+def test_members_decode_cp866_names():
+    archive = make_zip([('N' * len('ООО Ромашка.xlsx'), b'x'), ('Лютик.xlsx', b'x')])
+    archive = with_cp866_names(archive, ['ООО Ромашка.xlsx'])
+    assert [company for company, _ in ba.list_batch_members(archive)] == ['ООО Ромашка', 'Лютик']
+
+
+def test_members_reject_zip_bomb(monkeypatch):
+    monkeypatch.setattr(ba, 'MAX_COMPRESSION_RATIO', 50)
+    with pytest.raises(ba.UploadRejected):
+        ba.list_batch_members(make_zip([('Бомба.xlsx', b'\0' * (8 * 1024 * 1024))]))
+
+
+def test_members_reject_large_total(monkeypatch):
+    monkeypatch.setattr(ba, 'MAX_UNCOMPRESSED_MB', 1)
+    with pytest.raises(ba.UploadRejected):
+        ba.list_batch_members(make_zip([(f'{index}.xlsx', b'1' * 300 * 1024) for index in range(4)]))
+
+
+def test_members_reject_bad_zip(tmp_path):
+    path = tmp_path / 'batch.zip'
+    path.write_bytes(b'not a zip')
+    with pytest.raises(ba.UploadRejected):
+        ba.list_batch_members(str(path))
+
+
+def test_company_workbook_is_read_from_archive():
+    book = make_workbook([
+        ['Показатель', '31.12.2022', '31.12.2023'],
+        ['Выручка', 1000, 1200],
+        ['Чистая прибыль', 100, 150],
+        ['Активы всего', 2000, 2100],
+    ])
+    archive = make_zip([('Альфа.xlsx', book), ('Битая.xlsx', b'not a workbook')])
+
+    result = ba.parse_company_workbook(archive, 'Альфа.xlsx', 'Альфа')
+    assert result['company'] == 'Альфа' and result['last_period'] == '31.12.2023'
+    assert result['periods_data']['31.12.2023']['выручка'] == 1200
+
+    result = ba.parse_company_workbook(archive, 'Битая.xlsx', 'Битая')
+    assert result['company'] == 'Битая' and 'error' in result
+
+
+def test_rejected_company_workbook_is_an_error_result(monkeypatch):
+    monkeypatch.setattr(ba, 'MAX_COMPRESSION_RATIO', 50)
+    book = make_zip([('xl/worksheets/sheet1.xml', b' ' * (8 * 1024 * 1024))])
+    archive = make_zip([('Бомба.xlsx', book)])
+    result = ba.parse_company_workbook(archive, 'Бомба.xlsx', 'Бомба')
+    assert result['company'] == 'Бомба' and 'error' in result
+
+
+def company(name, **ratios):
+    names = {label: ratio_name for ratio_name, label, _, _ in ba.BATCH_RANKING}
+    return {'company': name, 'last_period': '2023', 'ratios': {names[label]: value for label, value in ratios.items()}}
+
+
+def test_rank_single_company():
+    [result] = ba.rank_companies([company('Альфа', ROA=5, ROS=3, ТЛ=1.2, КА=0.4, ФЛ=1.5)])
+    assert result['score'] == 100
+
+
+def test_rank_ties_share_score_and_sort_by_name():
+    ranked = ba.rank_companies([
+        company('Бета', ROA=5, ROS=3, ТЛ=1.2, КА=0.4, ФЛ=1.5),
+        company('Альфа', ROA=5, ROS=3, ТЛ=1.2, КА=0.4, ФЛ=1.5),
+    ])
+    assert [(result['company'], result['score']) for result in ranked] == [('Альфа', 100), ('Бета', 100)]
+
+
+def test_rank_missing_ratios_and_lower_is_better():
+    ranked = ba.rank_companies([
+        company('Нет данных'),
+        company('Лидер', ROA=10, ROS=8, ТЛ=2.0, КА=0.7, ФЛ=0.5),
+        company('Середина', ROA=5, ROS=4, ТЛ=1.5, КА=0.5, ФЛ=1.0),
+        company('Только леверидж', ФЛ=0.1),
+    ])
+    scores = {result['company']: result['score'] for result in ranked}
+    assert [result['company'] for result in ranked][0] == 'Лидер'
+    assert scores['Нет данных'] == 0
+    assert scores['Только леверидж'] == 20
+    assert scores['Лидер'] > scores['Середина'] > scores['Только леверидж']
+
+
+def test_batch_summary_lists_failures():
+    ranked = ba.rank_companies([company('Альфа', ROA=5)])
+    summary = ba.generate_batch_summary(ranked, [{'company': 'Битая', 'error': 'файл поврежден'}])
+    assert "2 компаний" in summary
+    assert "1. **Альфа** - балл 20 (2023)" in summary
+    assert "• Битая: файл поврежден" in summary
@@ -0,0 +1,33 @@
+"""Эталоны и генератор книг бенчмарка"""
+import pandas as pd
+import pytest
+
+import balance_analyzer as ba
+import benchmark
+
+
+@pytest.mark.parametrize('params', [
+    {'rows': 300, 'periods': 4, 'sheets': 1, 'noise': 0.5},
+    {'rows': 100, 'periods': 24, 'sheets': 1, 'noise': 0.3, 'headers': 'mixed'},
+])
+def test_vectorized_extract_matches_loop_reference(params):
+    workbook = benchmark.generate_workbook(seed=3, **params)
+    df = ba.read_excel_file(workbook, 'benchmark.xlsx')
+    periods = ba.detect_periods(df)
+
+    expected = benchmark.extract_financial_data_by_period_loop(df, periods)
+    actual = ba.extract_financial_data_by_period(df, periods)
+    assert {period: dict(data) for period, data in actual.items()} == expected
+    assert [list(data) for data in actual.values()] == [list(data) for data in expected.values()]
+
+
+def test_loop_reference_handles_text_zero_and_missing_values():
+    df = pd.DataFrame({
+        'Наименование показателя': ['Выручка', 'Запасы', 'Актив', 'Денежные средства', 'Выручка'],
+        '31.12.2023': [100, 'н/д', 5, 0, 300],
+        '31.12.2024': [None, '50', 7, 10, 0],
+    })
+    periods = ba.detect_periods(df)
+    expected = {'31.12.2023': {'выручка': 300}, '31.12.2024': {'запасы': 50, 'денежные средства': 10}}
+    assert benchmark.extract_financial_data_by_period_loop(df, periods) == expected
+    assert {period: dict(data) for period, data in ba.extract_financial_data_by_period(df, periods).items()} == expected
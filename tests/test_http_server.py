@@ -0,0 +1,180 @@
+"""Локальный HTTP-сервер и webhook: разбор запросов, ошибки, таймауты, обновление от FakeBotAPI"""
+import json
+import asyncio
+
+import balance_analyzer as ba
+from fake_telegram import FakeBotAPI
+
+
+async def echo_handler(headers, body):
+    return 200, 'text/plain', body
+
+
+async def failing_handler(headers, body):
+    raise RuntimeError('boom')
+
+
+async def start_server(routes):
+    server = await ba.start_http_server(routes, '127.0.0.1', 0)
+    return server, server.sockets[0].getsockname()[1]
+
+
+async def read_response(reader):
+    """(статус, заголовки, тело) одного ответа"""
+    status_line = await reader.readline()
+    if not status_line:
+        return None
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get('content-length', 0)))
+    return int(status_line.split()[1]), headers, body
+
+
+def post(path, body, **headers):
+    lines = [f"POST {path} HTTP/1.1", f"Content-Length: {len(body)}"]
+    lines += [f"{name.replace('_', '-')}: {value}" for name, value in headers.items()]
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body
+
+
+def run(coroutine):
+    return asyncio.run(asyncio.wait_for(coroutine, 30))
+
+
+def test_keep_alive_serves_several_requests():
+    async def scenario():
+        server, port = await start_server({('POST', '/echo'): echo_handler})
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(post('/echo', b'first') + post('/echo?x=1', b'second'))
+        first, second = await read_response(reader), await read_response(reader)
+        writer.close()
+        server.close()
+        return first, second
+
+    first, second = run(scenario())
+    assert (first[0], first[2]) == (200, b'first')
+    assert (second[0], second[2]) == (200, b'second')
+    assert first[1]['connection'] == 'keep-alive'
+
+
+def test_chunked_body_is_rejected_and_connection_closed():
+    async def scenario():
+        server, port = await start_server({('POST', '/echo'): echo_handler})
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        # Хвост чанкованного тела не должен разобраться как следующий запрос
+        writer.write(b"POST /echo HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n"
+                     b"5\r\nPOST /\r\n0\r\n\r\n")
+        response = await read_response(reader)
+        after = await reader.read()
+        writer.close()
+        server.close()
+        return response, after
+
+    response, after = run(scenario())
+    assert response[0] == 501
+    assert response[1]['connection'] == 'close'
+    assert after == b''
+
+
+def test_handler_exception_returns_500():
+    async def scenario():
+        server, port = await start_server({('POST', '/fail'): failing_handler})
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(post('/fail', b'{}'))
+        response = await read_response(reader)
+        writer.close()
+        server.close()
+        return response
+
+    assert run(scenario())[0] == 500
+
+
+def test_bad_requests_get_an_answer():
+    async def scenario():
+        server, port = await start_server({('POST', '/echo'): echo_handler})
+        statuses = []
+        for raw in (b"garbage\r\n\r\n",
+                    b"POST /echo HTTP/1.1\r\nContent-Length: abc\r\n\r\n",
+                    post('/echo', b'x' * (ba.HTTP_MAX_BODY + 1)),
+                    post('/missing', b'')):
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(raw)
+            statuses.append((await read_response(reader))[0])
+            writer.close()
+        server.close()
+        return statuses
+
+    assert run(scenario()) == [400, 400, 413, 404]
+
+
+def test_idle_and_slow_connections_are_closed(monkeypatch):
+    monkeypatch.setattr(ba, 'HTTP_READ_TIMEOUT', 0.2)
+
+    async def scenario():
+        server, port = await start_server({('POST', '/echo'): echo_handler})
+        idle_reader, idle_writer = await asyncio.open_connection('127.0.0.1', port)
+        slow_reader, slow_writer = await asyncio.open_connection('127.0.0.1', port)
+        # Заголовки приходят, а тело - нет
+        slow_writer.write(b"POST /echo HTTP/1.1\r\nContent-Length: 10\r\n\r\nabc")
+        closed = await asyncio.gather(idle_reader.read(), slow_reader.read())
+        idle_writer.close()
+        slow_writer.close()
+        server.close()
+        return closed
+
+    assert run(scenario()) == [b'', b'']
+
+
+def test_webhook_rejects_bad_json_and_wrong_secret(monkeypatch):
+    submitted = []
+
+    async def submit(data):
+        submitted.append(data)
+
+    async def scenario():
+        handler = ba.webhook_handler(submit, lambda: 0)
+        bad_json = await handler({}, b'{not json')
+        monkeypatch.setattr(ba, 'WEBHOOK_SECRET', 's3cret')
+        wrong_secret = await handler({'x-telegram-bot-api-secret-token': 'nope'}, b'{}')
+        accepted = await handler({'x-telegram-bot-api-secret-token': 's3cret'}, b'{"update_id": 1}')
+        return bad_json[0], wrong_secret[0], accepted[0]
+
+    assert run(scenario()) == (400, 403, 200)
+    assert submitted == [{'update_id': 1}]
+
+
+def test_webhook_update_from_fake_telegram_gets_a_reply(monkeypatch):
+    """Обновление, доставленное на webhook, обрабатывается ботом, а ответ уходит в FakeBotAPI"""
+
+    async def scenario():
+        api = await FakeBotAPI().start()
+        monkeypatch.setattr(ba, 'TELEGRAM_BOT_TOKEN', api.token)
+        monkeypatch.setattr(ba, 'TELEGRAM_API_URL', f"http://127.0.0.1:{api.port}/bot")
+        monkeypatch.setattr(ba, 'TELEGRAM_FILE_URL', f"http://127.0.0.1:{api.port}/file/bot")
+        application = ba.setup_application()
+        async with application:
+            await application.start()
+            server, port = await start_server({
+                ('POST', '/telegram'): ba.webhook_handler(
+                    ba.application_submitter(application), application.update_queue.qsize
+                ),
+            })
+            update = api.user_message(42, text='/start')
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(post('/telegram', json.dumps(update).encode('utf-8'), Content_Type='application/json'))
+            response = await read_response(reader)
+            reply = await asyncio.wait_for(api.messages_for(42).get(), 10)
+            writer.close()
+            server.close()
+            await application.stop()
+        await api.stop()
+        return response, reply
+
+    response, reply = run(scenario())
+    assert response[0] == 200
+    assert reply['chat']['id'] == 42
+    assert reply['text']
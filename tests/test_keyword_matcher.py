@@ -0,0 +1,34 @@
+"""KeywordMatcher: тот же результат, что и последовательный перебор статей"""
+import random
+
+import balance_analyzer as ba
+
+
+def naive_match(items, text):
+    for item, keywords in items.items():
+        if any(keyword in text for keyword in keywords):
+            return item
+    return None
+
+
+def test_overlapping_keywords_follow_item_order():
+    items = {'first': ['bcd'], 'second': ['abc', 'c'], 'third': ['abcde']}
+    matcher = ba.KeywordMatcher(items)
+    assert matcher.match('abcde') == 'first'
+    assert matcher.match('xabcx') == 'second'
+    assert matcher.match('zzc') == 'second'
+    assert matcher.match('abx') is None
+    assert matcher.match('') is None
+
+
+def test_balance_matcher_agrees_with_naive_scan():
+    keywords = [keyword for values in ba.BALANCE_ITEMS.values() for keyword in values]
+    rng = random.Random(3)
+    for _ in range(2000):
+        parts = [rng.choice(keywords)[:rng.randint(1, 12)] for _ in range(rng.randint(0, 3))]
+        text = ' '.join(parts + [rng.choice(['', 'итого', 'прочие', '1200'])])
+        assert ba.BALANCE_MATCHER.match(text) == naive_match(ba.BALANCE_ITEMS, text), text
+
+
+def test_classify_balance_item_strips_numbering():
+    assert ba.classify_balance_item('II. ОБОРОТНЫЕ АКТИВЫ') == ba.classify_balance_item('оборотные активы')
@@ -0,0 +1,54 @@
+"""parse_period_header и detect_periods: форматы заголовков и приоритеты"""
+from datetime import datetime
+
+import pandas as pd
+import pytest
+
+import balance_analyzer as ba
+
+
+@pytest.mark.parametrize('header, expected', [
+    ('31.12.2023', (datetime(2023, 12, 31), '31.12.2023', '31.12.2023')),
+    ('2023-06-30', (datetime(2023, 6, 30), '2023-06-30', '30.06.2023')),
+    ('на 31.03 2024 г.', (datetime(2024, 3, 31), 'на 31.03', '31.03.2024')),
+    ('3 квартал 2022', (datetime(2022, 9, 30), '3 квартал', 'Q3.2022')),
+    ('2-й квартал за 2021', (datetime(2021, 6, 30), '2-й квартал', 'Q2.2021')),
+    ('за 2020 год', (datetime(2020, 12, 31), 'за 2020', '2020')),
+])
+def test_header_formats(header, expected):
+    assert ba.parse_period_header(header) == expected
+
+
+def test_full_date_wins_over_other_forms():
+    assert ba.parse_period_header('за 2023 на 31.12.2022')[0] == datetime(2022, 12, 31)
+    assert ba.parse_period_header('1 квартал, на 30.06.2021')[0] == datetime(2021, 6, 30)
+
+
+def test_partial_date_without_year_uses_current_year():
+    assert ba.parse_period_header('на 01.04')[0] == datetime(datetime.now().year, 4, 1)
+
+
+@pytest.mark.parametrize('header', ['статья', '2023', '31.02.2023', 'на 31.02 2023', 'код 1200'])
+def test_not_a_period(header):
+    assert ba.parse_period_header(header) is None
+
+
+def test_invalid_full_date_falls_back_to_next_match():
+    assert ba.parse_period_header('31.02.2023 31.12.2023')[2] == '31.12.2023'
+
+
+def test_detect_periods_sorted_by_date():
+    df = pd.DataFrame(columns=['Показатель', 'за 2021', '31.12.2023', datetime(2022, 12, 31)])
+    periods = ba.detect_periods(df)
+    assert [period['formatted'] for period in periods] == ['2021', '31.12.2022', '31.12.2023']
+    assert periods[1]['column'] == datetime(2022, 12, 31)
+
+
+def test_benchmark_monthly_headers_are_distinct_month_ends():
+    from benchmark import period_headers
+
+    headers = period_headers(360, 'mixed')
+    df = pd.DataFrame(columns=['Показатель'] + headers)
+    dates = [period['date'] for period in ba.detect_periods(df)]
+    assert len(dates) == len(set(dates)) == 360
+    assert all((date + pd.Timedelta(days=1)).day == 1 for date in dates)
@@ -0,0 +1,89 @@
+"""PeriodsFrame: круговые преобразования и поведение словаря словарей"""
+import pickle
+
+import numpy as np
+import pytest
+
+import balance_analyzer as ba
+
+
+@pytest.fixture
+def periods_data():
+    return {
+        '31.12.2021': {'выручка': 1000.0, 'активы всего': 2000.0, 'капитал': 1200.0},
+        '31.12.2022': {'выручка': 1500.0, 'чистая прибыль': -50.5},
+        '31.12.2023': {},
+        '31.12.2024': {'капитал': 0.0, 'выручка': 1.25e12},
+    }
+
+
+def test_dict_round_trip(periods_data):
+    frame = ba.PeriodsFrame.from_mapping(periods_data)
+    assert frame.to_dict() == periods_data
+    assert list(frame) == list(periods_data)
+    assert ba.PeriodsFrame.from_mapping(frame) is frame
+
+
+def test_frame_behaves_like_mapping(periods_data):
+    frame = ba.PeriodsFrame.from_mapping(periods_data)
+    assert frame == periods_data
+    assert len(frame) == 4 and '31.12.2023' in frame and '2020' not in frame
+    assert list(reversed(frame)) == list(reversed(periods_data))
+
+    column = frame['31.12.2022']
+    assert dict(column) == periods_data['31.12.2022']
+    assert 'чистая прибыль' in column and 'капитал' not in column and 'нет такой' not in column
+    assert column.get('капитал', 0) == 0 and frame['31.12.2024']['капитал'] == 0.0
+    assert len(frame['31.12.2023']) == 0 and not frame['31.12.2023']
+    with pytest.raises(KeyError):
+        frame['31.12.2022']['капитал']
+    with pytest.raises(KeyError):
+        frame['2020']
+
+
+def test_rows_and_series(periods_data):
+    frame = ba.PeriodsFrame.from_mapping(periods_data)
+    assert frame.row_series('выручка') == [('31.12.2021', 1000.0), ('31.12.2022', 1500.0), ('31.12.2024', 1.25e12)]
+    assert frame.row_series('нет такой') == []
+    assert frame.rows(['капитал', 'нет такой']).tolist() == [[1200.0, 0, 0, 0.0], [0, 0, 0, 0]]
+    assert list(frame.nonempty()) == ['31.12.2021', '31.12.2022', '31.12.2024']
+
+
+@pytest.mark.parametrize('as_frame', [False, True])
+def test_encode_decode_round_trip(periods_data, as_frame):
+    source = ba.PeriodsFrame.from_mapping(periods_data) if as_frame else periods_data
+    decoded = ba.decode_periods_data(ba.encode_periods_data(source))
+    assert isinstance(decoded, ba.PeriodsFrame)
+    assert decoded.to_dict() == periods_data
+    assert list(decoded) == list(periods_data)
+
+
+def test_encode_empty():
+    assert ba.decode_periods_data(ba.encode_periods_data({})).to_dict() == {}
+
+
+def test_pickle_round_trip(periods_data):
+    frame = ba.PeriodsFrame.from_mapping(periods_data)
+    restored = pickle.loads(pickle.dumps(frame))
+    assert restored.to_dict() == periods_data
+    assert np.array_equal(restored.matrix, frame.matrix, equal_nan=True)
+
+
+def test_label_tables_are_shared(periods_data):
+    first = ba.PeriodsFrame.from_mapping(periods_data)
+    second = ba.decode_periods_data(ba.encode_periods_data(periods_data))
+    third = pickle.loads(pickle.dumps(first))
+    assert first.periods is second.periods is third.periods
+    assert first.item_index is second.item_index is third.item_index
+
+
+def test_reports_equal_for_dict_and_frame(periods_data):
+    frame = ba.PeriodsFrame.from_mapping(periods_data)
+    for report in (ba.generate_period_analysis_report, ba.generate_liquidity_analysis_report,
+                   ba.generate_profitability_analysis_report, ba.generate_stability_analysis_report,
+                   ba.generate_forecast_report):
+        assert report(frame) == report(periods_data)
+    groups = list(ba.INDICATOR_GROUPS)
+    assert ba.generate_selective_analysis_report(frame, groups) == \
+        ba.generate_selective_analysis_report(periods_data, groups)
+    assert ba.calculate_periods_ratios(frame) == ba.calculate_periods_ratios(periods_data)
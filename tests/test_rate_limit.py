@@ -0,0 +1,107 @@
+"""TokenBucket, RateLimiter и check_rate_limit"""
+import asyncio
+
+import balance_analyzer as ba
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeMessage:
+    def __init__(self):
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+
+class FakeUser:
+    id = 7
+
+
+class FakeUpdate:
+    def __init__(self):
+        self.effective_user = FakeUser()
+        self.message = FakeMessage()
+
+
+def test_bucket_allows_burst_then_refills(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ba.time, 'monotonic', clock)
+    bucket = ba.TokenBucket(3, 60)
+
+    assert [bucket.consume() for _ in range(3)] == [0, 0, 0]
+    assert bucket.consume() == 1.0
+
+    clock.now += 0.5
+    assert bucket.consume() == 0.5
+    clock.now += 0.5
+    assert bucket.consume() == 0
+
+    # Простой не накапливает больше capacity
+    clock.now += 3600
+    assert [bucket.consume() for _ in range(4)][-1] > 0
+
+
+def test_bucket_with_zero_rate_never_refills(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ba.time, 'monotonic', clock)
+    bucket = ba.TokenBucket(1, 0)
+    assert bucket.consume() == 0
+    clock.now += 3600
+    assert bucket.consume() == float('inf')
+
+
+def test_limiter_keys_by_user_and_kind_and_evicts_oldest():
+    limiter = ba.RateLimiter({'parse': (1, 60), 'report': (5, 60)}, max_buckets=2)
+    parse = limiter.bucket(1, 'parse')
+    assert limiter.bucket(1, 'parse') is parse
+    assert limiter.bucket(1, 'report') is not parse
+
+    limiter.bucket(1, 'parse')  # свежее использование
+    limiter.bucket(2, 'parse')
+    assert list(limiter.buckets) == [(1, 'parse'), (2, 'parse')]
+
+
+def test_check_rate_limit_replies_once_per_refill_interval(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ba.time, 'monotonic', clock)
+    monkeypatch.setattr(ba, 'RATE_LIMITER', ba.RateLimiter({'parse': (1, 6)}))
+    update = FakeUpdate()
+
+    async def attempts(count):
+        return [await ba.check_rate_limit(update, 'parse') for _ in range(count)]
+
+    assert asyncio.run(attempts(3)) == [True, False, False]
+    assert update.message.replies == ["🐢 Слишком много запросов, повторите через 11 с"]
+
+    # Токен пополняется за 10 с: внутри интервала отказы без ответа
+    clock.now += 5
+    assert asyncio.run(attempts(1)) == [False]
+    assert len(update.message.replies) == 1
+    assert ba.RATE_LIMITER.rejected['parse'] == 3
+
+    # Интервал прошел - следующий отказ снова получает ответ
+    clock.now += 5
+    assert asyncio.run(attempts(3)) == [True, False, False]
+    assert update.message.replies[1:] == ["🐢 Слишком много запросов, повторите через 11 с"]
+
+
+def test_check_rate_limit_without_refill_replies_once(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ba.time, 'monotonic', clock)
+    monkeypatch.setattr(ba, 'RATE_LIMITER', ba.RateLimiter({'parse': (1, 0)}))
+    update = FakeUpdate()
+
+    async def attempts():
+        return [await ba.check_rate_limit(update, 'parse') for _ in range(2)]
+
+    assert asyncio.run(attempts()) == [True, False]
+    clock.now += 3600
+    assert asyncio.run(attempts()) == [False, False]
+    assert update.message.replies == ["🐢 Слишком много запросов, повторите позже"]
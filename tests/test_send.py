@@ -0,0 +1,101 @@
+"""Отправка длинных отчетов: деление по лимиту Telegram и темп отправки"""
+import asyncio
+import time
+
+import pytest
+from telegram.error import RetryAfter
+
+import balance_analyzer as ba
+
+
+def section(title, lines, width=60):
+    return "\n".join([f"**{title}:**"] + [f"• строка {index} " + "x" * width for index in range(lines)])
+
+
+def test_short_text_is_one_message():
+    assert ba.split_message("📊 Отчет\n\nвсе хорошо") == ["📊 Отчет\n\nвсе хорошо"]
+    assert ba.split_message("  \n") == []
+
+
+def test_default_limit_within_telegram_limit():
+    assert ba.MESSAGE_MAX_LENGTH <= 4096
+
+
+def test_telegram_length_counts_utf16_units():
+    assert ba.telegram_length("абв") == 3
+    assert ba.telegram_length("📈") == 2
+    assert ba.telegram_length("➡️") == 2
+
+
+def test_chunks_fit_4096_utf16_units():
+    # Эмодзи вне BMP занимают две единицы UTF-16: по len() текст помещается, по лимиту - нет
+    text = "\n\n".join(section(f"📈 Раздел {index} 🚀", 20, width=30) + " 💎" * 40 for index in range(30))
+    chunks = ba.split_message(text, limit=4096)
+    assert len(chunks) > 1
+    assert all(ba.telegram_length(chunk) <= 4096 for chunk in chunks)
+    assert any(len(chunk) + 100 < ba.telegram_length(chunk) for chunk in chunks)
+    assert "".join(chunks).replace("\n", "") == text.replace("\n", "")
+
+
+def test_split_prefers_section_boundaries():
+    sections = [section(f"Раздел {index}", 12) for index in range(12)]
+    chunks = ba.split_message("\n\n".join(sections), limit=2000)
+    assert len(chunks) > 1
+    for chunk in chunks:
+        assert chunk.startswith("**Раздел ")
+        assert chunk.split("\n\n") == [part for part in sections if part in chunk]
+
+
+def test_long_section_is_split_by_lines():
+    text = section("Большой раздел", 100)
+    chunks = ba.split_message(text, limit=1000)
+    assert all(ba.telegram_length(chunk) <= 1000 for chunk in chunks)
+    assert "\n".join(chunks) == text
+
+
+def test_long_line_keeps_bold_balanced():
+    line = "**" + " ".join(["жирный"] * 300) + "** и обычный текст"
+    pieces = ba.split_long_line(line, 200)
+    assert len(pieces) > 1
+    for piece in pieces:
+        assert ba.telegram_length(piece) <= 200
+        assert piece.count("**") % 2 == 0
+    assert pieces[0].startswith("**") and pieces[1].startswith("**")
+
+
+def test_long_word_is_cut_by_utf16_units():
+    pieces = ba.split_long_line("😀" * 300, 100)
+    assert all(ba.telegram_length(piece) <= 100 for piece in pieces)
+    assert "".join(pieces) == "😀" * 300
+
+
+def test_wait_send_slot_paces_chat(monkeypatch):
+    monkeypatch.setattr(ba, 'SEND_LIMITER', ba.RateLimiter({'chat': (2, 600), 'global': (100, 6000)}))
+
+    async def send_four():
+        started = time.monotonic()
+        for _ in range(4):
+            await ba.wait_send_slot(42)
+        return time.monotonic() - started
+
+    # Две отправки сразу, затем по одной в 0.1 с
+    assert 0.15 <= asyncio.run(send_four()) < 1
+
+
+def test_rate_limiter_retries_after_flood_control(monkeypatch):
+    monkeypatch.setattr(ba, 'SEND_LIMITER', ba.RateLimiter({'chat': (100, 6000), 'global': (100, 6000)}))
+    calls = []
+
+    async def callback():
+        calls.append(time.monotonic())
+        if len(calls) < 3:
+            raise RetryAfter(0)
+        return True
+
+    limiter = ba.PacedRateLimiter()
+    result = asyncio.run(limiter.process_request(callback, (), {}, 'sendMessage', {'chat_id': 1}, None))
+    assert result is True and len(calls) == 3
+
+    calls.clear()
+    with pytest.raises(RetryAfter):
+        asyncio.run(limiter.process_request(callback, (), {}, 'sendMessage', {'chat_id': 1}, 1))
@@ -0,0 +1,84 @@
+"""Шардирование по user_id: кольцо хэшей, маршрутизатор и процессы-воркеры"""
+import asyncio
+import collections
+
+import balance_analyzer as ba
+from fake_telegram import FakeBotAPI
+
+
+def build_ring(nodes, virtual_nodes=64):
+    ring = ba.HashRing(virtual_nodes)
+    for node in nodes:
+        ring.add_node(node)
+    return ring
+
+
+def test_ring_is_deterministic_and_balanced():
+    ring = build_ring(range(4))
+    owners = collections.Counter(ring.get_node(user_id) for user_id in range(20000))
+    assert set(owners) == {0, 1, 2, 3}
+    assert min(owners.values()) > 20000 / 4 * 0.5
+    assert [build_ring(range(4)).get_node(user_id) for user_id in range(100)] == \
+        [ring.get_node(user_id) for user_id in range(100)]
+
+
+def test_adding_a_node_moves_only_its_share_of_keys():
+    ring = build_ring(range(4))
+    grown = ring.with_node(4)
+    # with_node не меняет исходное кольцо
+    assert 4 not in ring.nodes
+    moved = [user_id for user_id in range(20000) if ring.get_node(user_id) != grown.get_node(user_id)]
+    assert all(grown.get_node(user_id) == 4 for user_id in moved)
+    assert 0 < len(moved) < 20000 / 5 * 1.6
+
+
+def test_remove_node_and_empty_ring():
+    ring = build_ring([0, 1])
+    ring.remove_node(1)
+    assert {ring.get_node(user_id) for user_id in range(100)} == {0}
+    assert ba.HashRing().get_node(1) is None
+
+
+def test_update_user_id():
+    assert ba.update_user_id({'update_id': 1, 'message': {'from': {'id': 7}, 'chat': {'id': 9}}}) == 7
+    assert ba.update_user_id({'update_id': 1, 'my_chat_member': {'chat': {'id': 9}}}) == 9
+    assert ba.update_user_id({'update_id': 1}) == 0
+
+
+def test_router_hands_off_users_and_restarts_killed_worker(monkeypatch):
+    """Воркеры - настоящие процессы (spawn) против FakeBotAPI"""
+
+    async def scenario():
+        api = await FakeBotAPI().start()
+        monkeypatch.setenv('TELEGRAM_BOT_TOKEN', api.token)
+        monkeypatch.setenv('TELEGRAM_API_URL', f"http://127.0.0.1:{api.port}/bot")
+        monkeypatch.setenv('TELEGRAM_FILE_URL', f"http://127.0.0.1:{api.port}/file/bot")
+        monkeypatch.setenv('ANALYSIS_WORKERS', '1')
+        router = ba.ShardRouter(16)
+        users = range(1, 21)
+
+        async def ask(user_id):
+            await router.submit(api.user_message(user_id, text='/start'))
+            return await asyncio.wait_for(api.messages_for(user_id).get(), 60)
+
+        try:
+            await router.add_worker()
+            await asyncio.gather(*(ask(user_id) for user_id in users))
+
+            new_worker = await router.add_worker()
+            owners = {user_id: router.ring.get_node(user_id) for user_id in users}
+            assert set(owners.values()) == {0, new_worker}
+            await asyncio.gather(*(ask(user_id) for user_id in users))
+
+            # Воркер убит, пока ждет очередь (держит ее блокировку чтения)
+            process = router.workers[0][0]
+            process.kill()
+            process.join()
+            router.restart_worker(0)
+            await asyncio.gather(*(ask(user_id) for user_id, owner in owners.items() if owner == 0))
+            return router.pending()
+        finally:
+            router.stop()
+            await api.stop()
+
+    assert asyncio.run(asyncio.wait_for(scenario(), 180)) == 0
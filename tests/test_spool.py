@@ -0,0 +1,64 @@
+"""Временный файл загрузки удаляется только после задач пула, читающих его"""
+import asyncio
+import os
+import time
+import threading
+
+import pytest
+
+import balance_analyzer as ba
+
+
+def read_when_allowed(path, allowed):
+    allowed.wait(5)
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_spool_outlives_jobs_left_after_timeout(tmp_path, monkeypatch):
+    monkeypatch.setattr(ba, 'ANALYSIS_JOB_TIMEOUT', 0.1)
+    path = tmp_path / 'upload.xlsx'
+    path.write_bytes(b'data')
+    allowed = threading.Event()
+    spool = ba.SpoolCleanup(str(path))
+    jobs = []
+
+    async def handler():
+        token = ba._spool_cleanup.set(spool)
+        try:
+            with pytest.raises(asyncio.TimeoutError):
+                await ba.run_in_analysis_pool(read_when_allowed, str(path), allowed)
+        finally:
+            ba._spool_cleanup.reset(token)
+            jobs.extend(spool.pending)
+            spool.release()
+
+    asyncio.run(handler())
+    assert path.exists() and len(jobs) == 1
+
+    allowed.set()
+    assert jobs[0].result(5) == (b'data', [])
+    # Колбэк завершения выполняется в потоке пула сразу после выдачи результата
+    for _ in range(100):
+        if not path.exists():
+            break
+        time.sleep(0.01)
+    assert not path.exists()
+
+
+def test_spool_removed_at_release_when_jobs_finished(tmp_path):
+    path = tmp_path / 'upload.xlsx'
+    path.write_bytes(b'data')
+    spool = ba.SpoolCleanup(str(path))
+
+    async def handler():
+        token = ba._spool_cleanup.set(spool)
+        try:
+            return await ba.run_in_analysis_pool(os.path.getsize, str(path))
+        finally:
+            ba._spool_cleanup.reset(token)
+
+    assert asyncio.run(handler()) == 4
+    assert path.exists()
+    spool.release()
+    assert not path.exists() and not spool.pending
@@ -0,0 +1,69 @@
+"""Компиляция шаблонов отчетов: строки, пороги оценок, секции без данных"""
+import math
+
+import pytest
+
+import balance_analyzer as ba
+
+
+def test_template_matches_str_format():
+    template = "• {period}: {value:,.2f} руб. {{в скобках}} '{period!r}'\n"
+    render = ba.compile_template(template, 'period', 'value')
+    assert render('2023', 1234.5) == template.format(period='2023', value=1234.5)
+    assert ba.compile_template("без полей", 'value')() == "без полей"
+
+
+@pytest.mark.parametrize('template', ["{other}", "{}", "{value.real}", "{value:{width}}"])
+def test_template_rejects_unknown_fields(template):
+    with pytest.raises(ValueError):
+        ba.compile_template(template, 'value')
+
+
+def test_verdict_first_matching_rule_wins():
+    verdict = ba.compile_verdict([(15, 'high'), (5, 'mid')], default='low')
+    assert [verdict(v) for v in (20, 15, 10, 5, 1)] == ['high', 'high', 'mid', 'mid', 'low']
+    assert verdict(math.nan) == 'low'
+
+    strict = ba.compile_verdict([(1.5, 'raise')], op='<')
+    assert strict(1.0) == 'raise' and strict(1.5) is None
+
+
+def test_trend_uses_threshold():
+    assert ba.LIQUIDITY_TREND(0.25) == "  📈 Улучшение +0.25\n"
+    assert ba.LIQUIDITY_TREND(-0.25) == "  📉 Ухудшение -0.25\n"
+    assert ba.LIQUIDITY_TREND(0.05) is None
+
+
+def test_last_ratio_section_without_ratios():
+    verdict = ba.compile_verdict([(1, 'ok\n')])
+    ctx = ba.ReportContext({'2023': {}}, {})
+
+    out = []
+    ba.last_ratio_section('Коэффициент автономии', verdict)(ctx, out)
+    assert out == ["• Нет данных для рекомендаций\n"]
+
+    out = []
+    ba.last_ratio_section('Коэффициент автономии', verdict, empty_text=None)(ctx, out)
+    assert out == []
+
+
+def test_reports_render_without_ratios():
+    periods_data = {'31.12.2023': {'выручка': 100.0}}
+    for report in (ba.generate_liquidity_analysis_report, ba.generate_stability_analysis_report):
+        assert "Нет данных для рекомендаций" in report(periods_data, {})
+
+
+def stage_count(stage):
+    series = ba.STAGE_SECONDS.series.get((stage,))
+    return series[2] if series else 0
+
+
+def test_selective_report_is_timed_and_group_order_is_not():
+    periods_data = {'31.12.2023': {'выручка': 100.0}}
+    before = stage_count('report.selective')
+
+    ba.ordered_groups({'Ликвидность', 'Выручка и прибыль'})
+    assert stage_count('report.selective') == before
+
+    ba.generate_selective_analysis_report(periods_data, ['Выручка и прибыль'])
+    assert stage_count('report.selective') == before + 1
@@ -0,0 +1,79 @@
+"""PerUserUpdateProcessor: порядок внутри пользователя и общие слоты при флуде"""
+import time
+import asyncio
+from datetime import datetime, timezone
+
+from telegram import Update, Message, Chat, User
+
+from balance_analyzer import PerUserUpdateProcessor
+
+
+def make_update(update_id, user_id):
+    user = User(user_id, f"user{user_id}", False)
+    message = Message(update_id, datetime.now(timezone.utc), Chat(user_id, Chat.PRIVATE), from_user=user, text='x')
+    return Update(update_id, message=message)
+
+
+async def process_all(processor, updates, handler):
+    await asyncio.gather(*(processor.process_update(update, handler(update)) for update in updates))
+
+
+def test_updates_of_one_user_run_in_order_and_one_at_a_time():
+    processor = PerUserUpdateProcessor(8)
+    seen = []
+    running = set()
+
+    async def handler(update):
+        user_id = update.effective_user.id
+        assert user_id not in running
+        running.add(user_id)
+        await asyncio.sleep(0.001)
+        seen.append((user_id, update.update_id))
+        running.discard(user_id)
+
+    updates = [make_update(update_id, update_id % 3) for update_id in range(60)]
+    asyncio.run(process_all(processor, updates, handler))
+
+    for user_id in range(3):
+        ids = [update_id for owner, update_id in seen if owner == user_id]
+        assert ids == sorted(ids) and len(ids) == 20
+    assert processor._user_locks == {}
+
+
+def test_flooding_user_does_not_hold_all_slots():
+    processor = PerUserUpdateProcessor(4)
+    finished_at = {}
+
+    async def handler(update):
+        await asyncio.sleep(0.02)
+        finished_at[update.update_id] = time.perf_counter()
+
+    async def scenario():
+        flood = [make_update(update_id, 1) for update_id in range(50)]
+        others = [make_update(1000 + user_id, user_id) for user_id in range(2, 6)]
+        started_at = time.perf_counter()
+        await process_all(processor, flood + others, handler)
+        return max(finished_at[update.update_id] for update in others) - started_at
+
+    # Флуд из 50 сообщений идет ~1 с; остальные пользователи не должны его ждать
+    assert asyncio.run(scenario()) < 0.3
+
+
+def test_wait_idle_returns_after_accepted_updates():
+    processor = PerUserUpdateProcessor(4)
+    done = []
+
+    async def handler(update):
+        await asyncio.sleep(0.01)
+        done.append(update.update_id)
+
+    async def scenario():
+        tasks = [asyncio.create_task(processor.process_update(make_update(i, 7), handler(make_update(i, 7))))
+                 for i in range(5)]
+        await asyncio.sleep(0)
+        await processor.wait_idle([7, 8])
+        result = list(done)
+        await asyncio.gather(*tasks)
+        return result
+
+    assert asyncio.run(scenario()) == [0, 1, 2, 3, 4]
@@ -0,0 +1,65 @@
+"""Обработка загрузки: файловые операции и проверки не выполняются в цикле событий"""
+import asyncio
+import threading
+
+import balance_analyzer as ba
+
+
+class FakeMessage:
+    def __init__(self):
+        self.replies = []
+        self.from_user = type('User', (), {'id': 7})()
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+
+class FakeUpdate:
+    def __init__(self):
+        self.message = FakeMessage()
+        self.effective_user = self.message.from_user
+
+
+class FakeContext:
+    def __init__(self):
+        self.user_data = {}
+
+
+def test_inspection_runs_off_the_event_loop(monkeypatch):
+    threads = {}
+
+    def rejecting_inspect(source, file_name):
+        threads['inspect'] = threading.current_thread()
+        raise ba.UploadRejected("слишком широкий лист")
+
+    monkeypatch.setattr(ba, 'inspect_upload', rejecting_inspect)
+    update = FakeUpdate()
+
+    async def scenario():
+        threads['loop'] = threading.current_thread()
+        await ba.analyze_upload(update, FakeContext(), b'not cached upload', 'report.xlsx')
+
+    asyncio.run(scenario())
+    assert threads['inspect'] is not threads['loop']
+    assert update.message.replies == ["❌ слишком широкий лист"]
+
+
+def test_archived_upload_is_written_off_the_event_loop(monkeypatch):
+    threads = {}
+
+    def record_save(source, user_id, file_name):
+        threads['save'] = threading.current_thread()
+
+    def rejecting_inspect(source, file_name):
+        raise ba.UploadRejected("stop")
+
+    monkeypatch.setattr(ba, 'ARCHIVE_UPLOADS', True)
+    monkeypatch.setattr(ba, 'save_uploaded_file', record_save)
+    monkeypatch.setattr(ba, 'inspect_upload', rejecting_inspect)
+
+    async def scenario():
+        threads['loop'] = threading.current_thread()
+        await ba.analyze_upload(FakeUpdate(), FakeContext(), b'archived upload', 'report.xlsx')
+
+    asyncio.run(scenario())
+    assert threads['save'] is not threads['loop']